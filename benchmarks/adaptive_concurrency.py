@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Slot count and goodput of AIMDController against a simulated upstream.
+
+The upstream serves `--capacity` fetches at once in `--latency` seconds;
+above that, fetches queue and get slower. Past twice the capacity the extra
+fetches time out. The backlog never runs dry, so every slot is always busy.
+Fixed limits are shown for comparison.
+
+    python benchmarks/adaptive_concurrency.py --capacity 40 --latency 0.5 --intervals 60
+"""
+import argparse
+
+from flowder.concurrency import AIMDController
+
+
+def upstream(limit, capacity, latency):
+    """
+    `(mean latency, successes/sec, errors/sec)` with `limit` fetches running
+    """
+    mean = latency * max(1.0, float(limit) / capacity)
+    timed_out = max(0.0, float(limit - 2 * capacity) / limit)
+    rate = limit / mean
+    return mean, rate * (1 - timed_out), rate * timed_out
+
+
+def simulate(controller, opts):
+    goodput = []
+    trace = []
+    for _ in range(opts.intervals):
+        limit = controller.limit
+        mean, successes, errors = upstream(limit, opts.capacity, opts.latency)
+        for _ in range(int(successes * opts.interval)):
+            controller.observe(mean)
+        for _ in range(int(errors * opts.interval)):
+            controller.error()
+        controller.update(saturated=True)
+        goodput.append(successes)
+        trace.append(limit)
+    return trace, goodput
+
+
+def main(opts):
+    best = opts.capacity / opts.latency
+    print("upstream best: %.1f fetches/sec at %s slots" % (best, opts.capacity))
+    print("%14s %10s %14s  %s" % ('limit', 'final', 'fetches/sec', 'slots per interval'))
+    for initial in (opts.capacity // 4, opts.capacity * 4):
+        for adaptive in (False, True):
+            if adaptive:
+                controller = AIMDController(initial, 1, opts.capacity * 10)
+            else:
+                controller = AIMDController(initial, initial, initial)
+            trace, goodput = simulate(controller, opts)
+            # skip the warm up when averaging
+            tail = goodput[len(goodput) // 2:]
+            print("%14s %10s %14.1f  %s" % ('%s %s' % ('adaptive' if adaptive else 'fixed', initial),
+                                            trace[-1], sum(tail) / len(tail),
+                                            ' '.join(str(limit) for limit in trace[::opts.intervals // 12 or 1])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--capacity', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.5, help="seconds per fetch below capacity")
+    parser.add_argument('--interval', type=float, default=5, help="seconds between two decisions")
+    parser.add_argument('--intervals', type=int, default=60)
+    main(parser.parse_args())
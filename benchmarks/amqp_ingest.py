@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+AMQP ingest rate of AmqpService for several prefetch / ack batch settings.
+
+A local broker stand-in pushes messages into the consumer while honouring the
+prefetch window, and every basic.ack takes one simulated round trip before
+the window opens again. `prefetch 1 / ack batch 1` is the old behaviour.
+
+    python benchmarks/amqp_ingest.py --messages 20000 --rtt 1
+"""
+import json
+import time
+import argparse
+from collections import namedtuple
+
+from twisted.internet import defer, reactor
+from twisted.internet.defer import DeferredQueue
+from twisted.application.service import Application, Service
+
+from pygear.twisted.interfaces import ISignalManager
+from pygear.twisted.signal import SignalManager
+
+from flowder.config import FlowderConfig
+from flowder.services.amqp import AmqpService
+
+Method = namedtuple('Method', 'delivery_tag')
+
+
+class FakeBroker(object):
+    """
+    Delivers up to `prefetch` unacked messages, acks take `rtt` seconds
+    """
+
+    def __init__(self, messages, prefetch, rtt):
+        self.queue = DeferredQueue()
+        self.remaining = messages
+        self.prefetch = prefetch
+        self.rtt = rtt
+        self.unacked = 0
+        self.last_tag = 0
+        self.acked_tag = 0
+        self.done = defer.Deferred()
+        self.body = json.dumps({'fetch_uri': 'http://127.0.0.1/a.jpg', 'price_id': 1})
+
+    def deliver(self):
+        while self.remaining and self.unacked < self.prefetch:
+            self.remaining -= 1
+            self.unacked += 1
+            self.last_tag += 1
+            self.queue.put((self, Method(self.last_tag), None, self.body))
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        count = delivery_tag - self.acked_tag if multiple else 1
+        self.acked_tag = delivery_tag
+        reactor.callLater(self.rtt, self._acked, count)
+
+    def _acked(self, count):
+        self.unacked -= count
+        if not self.remaining and not self.unacked:
+            self.done.callback(None)
+        else:
+            self.deliver()
+
+
+class CountingScheduler(Service):
+    name = 'scheduler'
+
+    def schedule(self, task_info):
+        pass
+
+
+class IdleStorage(Service):
+    name = 'task_storage'
+
+    def count_active(self):
+        return 0
+
+
+@defer.inlineCallbacks
+def run(messages, prefetch, ack_batch_size, rtt):
+    app = Application('flowder-bench')
+    app.setComponent(ISignalManager, SignalManager())
+    CountingScheduler().setServiceParent(app)
+    IdleStorage().setServiceParent(app)
+
+    amqp = AmqpService(app, FlowderConfig())
+    amqp.ack_batch_size = ack_batch_size
+    broker = FakeBroker(messages, prefetch, rtt)
+
+    start = time.time()
+    amqp.start_consuming(broker.queue)
+    broker.deliver()
+    yield broker.done
+    elapsed = time.time() - start
+
+    amqp._stopping = True
+    amqp._backlog_checker.stop()
+    defer.returnValue(messages / elapsed)
+
+
+@defer.inlineCallbacks
+def main(opts):
+    rtt = opts.rtt / 1000.0
+    print("%10s %10s %14s" % ('prefetch', 'ack batch', 'messages/sec'))
+    for prefetch, ack_batch_size in ((1, 1), (10, 5), (100, 50), (500, 100)):
+        rate = yield run(opts.messages, prefetch, ack_batch_size, rtt)
+        print("%10s %10s %14.1f" % (prefetch, ack_batch_size, rate))
+    reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--rtt', type=float, default=1, help="broker round trip in milliseconds")
+    opts = parser.parse_args()
+    reactor.callWhenRunning(main, opts)
+    reactor.run()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Result publishing rate of AmqpService for several in-flight windows.
+
+Messages go through the real outbox (ThreadedTaskStorage) and a channel
+stand-in that confirms everything sent so far after one simulated round
+trip. `window 1` is one round trip per result, as without confirms
+batching.
+
+    python benchmarks/amqp_publish.py --messages 20000 --rtt 1
+"""
+import os
+import time
+import argparse
+import tempfile
+from collections import namedtuple
+
+from twisted.internet import defer, reactor, task
+from twisted.application.service import Application, IService
+
+from pygear.twisted.interfaces import ISignalManager
+from pygear.twisted.signal import SignalManager
+
+from flowder.config import FlowderConfig
+from flowder.services.amqp import AmqpService
+from flowder.services.storage import ThreadedTaskStorage
+
+Frame = namedtuple('Frame', 'method')
+
+
+class Ack(namedtuple('Ack', 'delivery_tag multiple')):
+    pass
+
+
+class FakeChannel(object):
+    """
+    Confirms every published message `rtt` seconds after the first one
+    not confirmed yet
+    """
+    is_open = True
+
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.seq = 0
+        self.confirm = None
+        self._pending = None
+
+    def confirm_delivery(self, callback):
+        self.confirm = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.seq += 1
+        if self._pending is None:
+            self._pending = reactor.callLater(self.rtt, self._confirm)
+        return defer.succeed(None)
+
+    def _confirm(self):
+        self._pending = None
+        self.confirm(Frame(Ack(self.seq, True)))
+
+
+@defer.inlineCallbacks
+def run(messages, window, rtt):
+    db_file = tempfile.mktemp(suffix='.db')
+    app = Application('flowder-bench')
+    app.setComponent(ISignalManager, SignalManager())
+    storage = ThreadedTaskStorage(app, db_file)
+    storage.setServiceParent(app)
+    IService(app).startService()
+    # queued behind the migrations
+    yield storage.runQuery("select 1")
+
+    amqp = AmqpService(app, FlowderConfig())
+    amqp.publish_window = window
+    amqp.start_publishing(FakeChannel(rtt))
+
+    start = time.time()
+    yield defer.gatherResults([amqp.publish({'file_uri': 'http://127.0.0.1/files/%s.jpg' % i, 'settings': {}})
+                               for i in range(messages)])
+    while amqp._outbox:
+        yield task.deferLater(reactor, 0.001, lambda: None)
+    elapsed = time.time() - start
+
+    yield IService(app).stopService()
+    os.remove(db_file)
+    defer.returnValue(messages / elapsed)
+
+
+@defer.inlineCallbacks
+def main(opts):
+    rtt = opts.rtt / 1000.0
+    print("%10s %14s" % ('window', 'messages/sec'))
+    for window in (1, 10, 100, 1000):
+        rate = yield run(opts.messages if window > 1 else min(opts.messages, 1000), window, rtt)
+        print("%10s %14.1f" % (window, rate))
+    reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--rtt', type=float, default=1, help="broker round trip in milliseconds")
+    opts = parser.parse_args()
+    reactor.callWhenRunning(main, opts)
+    reactor.run()
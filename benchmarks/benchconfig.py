@@ -0,0 +1,44 @@
+"""
+Configuration for the benchmarks that build real services.
+"""
+from flowder.config import FlowderConfig
+
+
+class BenchConfig(object):
+    """
+    The default configuration with some options replaced: `options` of
+    the flowder section and whole `sections`
+    """
+
+    def __init__(self, options, sections=None):
+        self.config = FlowderConfig()
+        self.options = options
+        self.sections = sections or {}
+
+    def _get(self, method, convert, option, default, section):
+        if section is None and option in self.options:
+            return convert(self.options[option])
+        if section is None:
+            return getattr(self.config, method)(option, default)
+        return getattr(self.config, method)(option, default, section=section)
+
+    def get(self, option, default=None, section=None):
+        return self._get('get', str, option, default, section)
+
+    def getint(self, option, default=None, section=None):
+        return self._get('getint', int, option, default, section)
+
+    def getfloat(self, option, default=None, section=None):
+        return self._get('getfloat', float, option, default, section)
+
+    def getboolean(self, option, default=None, section=None):
+        return self._get('getboolean', lambda v: str(v).lower() in ('1', 'true', 'yes', 'on'),
+                         option, default, section)
+
+    def items(self, section, default=None):
+        if section in self.sections:
+            return list(self.sections[section].items())
+        return self.config.items(section, default)
+
+    def __getattr__(self, name):
+        return getattr(self.config, name)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Tasks/sec scheduled through TaskScheduler one by one vs. `schedule_many`.
+
+Both run against the real ThreadedTaskStorage; a listener stands in for the
+poller and counts the `tasks_updated` signals.
+
+    python benchmarks/bulk_schedule.py --tasks 100000
+"""
+import os
+import time
+import uuid
+import argparse
+import tempfile
+
+from twisted.internet import defer, reactor
+from twisted.application.service import Application, IService
+
+from pygear.twisted.interfaces import ISignalManager
+from pygear.twisted.signal import SignalManager
+
+from flowder import signals
+from flowder.config import FlowderConfig
+from flowder.services.storage import ThreadedTaskStorage
+from flowder.services.scheduler import TaskScheduler
+
+
+def make_tasks(count):
+    return [{'job_id': uuid.uuid1().hex, 'fetch_uri': 'http://host%s/%s.jpg' % (i % 100, i), 'settings': '{}'}
+            for i in range(count)]
+
+
+@defer.inlineCallbacks
+def run(count, bulk):
+    db_file = tempfile.mktemp(suffix='.db')
+    app = Application('flowder-bench')
+    signal_manager = SignalManager()
+    app.setComponent(ISignalManager, signal_manager)
+    storage = ThreadedTaskStorage(app, db_file)
+    storage.setServiceParent(app)
+    scheduler = TaskScheduler(FlowderConfig(), app)
+    scheduler.setServiceParent(app)
+    IService(app).startService()
+    # queued behind the migrations
+    yield storage.runQuery("select 1")
+
+    updates = []
+    signal_manager.connect(lambda: updates.append(1), signal=signals.tasks_updated, weak=False)
+    tasks = make_tasks(count)
+
+    start = time.time()
+    if bulk:
+        yield scheduler.schedule_many(tasks)
+    else:
+        yield defer.gatherResults([scheduler.schedule(task) for task in tasks])
+    elapsed = time.time() - start
+
+    stored = yield storage.count()
+    assert stored == count, stored
+    yield IService(app).stopService()
+    os.remove(db_file)
+    defer.returnValue((count / elapsed, len(updates)))
+
+
+@defer.inlineCallbacks
+def main(opts):
+    print("%10s %10s %12s %10s" % ('path', 'tasks', 'tasks/sec', 'signals'))
+    for name, bulk, count in (('per item', False, min(opts.tasks, opts.per_item_tasks)),
+                              ('bulk', True, opts.tasks)):
+        rate, updates = yield run(count, bulk)
+        print("%10s %10s %12.1f %10s" % (name, count, rate, updates))
+    reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=100000)
+    parser.add_argument('--per-item-tasks', type=int, default=10000,
+                        help="the per item path is slow, cap its task count")
+    opts = parser.parse_args()
+    reactor.callWhenRunning(main, opts)
+    reactor.run()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+End to end load of the whole flowder application.
+
+Starts the service tree of `flowder.app.application` as the daemon does,
+against a local HTTP origin serving images and an in-process AMQP broker
+stand-in. Jobs come in through the broker (AmqpService) and the REST API
+(schedule.json); a job's latency runs from sending it to the broker
+confirming its result. The origin can be slow, fail (HTTP 500) or leave
+a share of the requests hanging for a while, and serves every host name
+on 127.0.0.1 to 127.0.0.N so per host limits come into play.
+
+Every run prints jobs/sec, p50/p95/p99 latency, RSS and database size and
+appends them as one JSON line to --output, with the commit it ran on.
+
+    python benchmarks/e2e_load.py --jobs 5000 --rest-share 0.2 --latency 20 --output e2e.jsonl
+"""
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+from io import BytesIO
+from collections import namedtuple
+from urllib import urlencode
+
+from twisted.internet import defer, reactor, task
+from twisted.internet.defer import DeferredQueue
+from twisted.application.internet import TCPServer
+from twisted.application.service import IService, IServiceCollection
+from twisted.web import resource, server
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+
+from pygear.twisted.signal import get_signal_manager
+
+from flowder import signals
+from flowder.app import application
+from flowder.amqp import amqp_message_decode
+from flowder.monitor import get_rss
+
+from benchconfig import BenchConfig
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+Frame = namedtuple('Frame', 'method')
+Method = namedtuple('Method', 'delivery_tag')
+
+
+class Ack(namedtuple('Ack', 'delivery_tag multiple')):
+    pass
+
+
+class FakeBroker(object):
+    """
+    AMQP connection and channel at once: delivers the messages put in
+    `queue` and confirms every published one `rtt` seconds later
+    """
+    is_open = True
+
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.queue = DeferredQueue()
+        self.delivery_tag = 0
+        self.seq = 0
+        self.confirm = None
+        self.published = []
+
+    def channel(self):
+        return defer.succeed(self)
+
+    def exchange_declare(self, **kwargs):
+        return defer.succeed(None)
+
+    def queue_declare(self, **kwargs):
+        return defer.succeed(None)
+
+    def queue_bind(self, **kwargs):
+        return defer.succeed(None)
+
+    def basic_qos(self, **kwargs):
+        return defer.succeed(None)
+
+    def basic_consume(self, **kwargs):
+        return defer.succeed((self.queue, 'bench'))
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        pass
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        pass
+
+    def deliver(self, message):
+        self.delivery_tag += 1
+        self.queue.put((self, Method(self.delivery_tag), None, json.dumps(message)))
+
+    def confirm_delivery(self, callback):
+        self.confirm = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.seq += 1
+        reactor.callLater(self.rtt, self._confirm, self.seq, body)
+
+    def _confirm(self, seq, body):
+        self.published.append((time.time(), body))
+        self.confirm(Frame(Ack(seq, False)))
+
+
+class Origin(resource.Resource):
+    """
+    Serves `size` bytes of PNG after `latency` seconds, HTTP 500 for
+    `error_rate` of the requests and `slow_latency` seconds late for
+    `slow_rate` of them
+    """
+    isLeaf = True
+
+    def __init__(self, size, latency, error_rate, slow_rate, slow_latency):
+        resource.Resource.__init__(self)
+        self.body = PNG + b'\0' * max(size - len(PNG), 0)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.requests = 0
+
+    def render_GET(self, request):
+        self.requests += 1
+        delay = self.slow_latency if random.random() < self.slow_rate else self.latency
+        error = random.random() < self.error_rate
+        if not delay:
+            return self._body(request, error)
+        call = reactor.callLater(delay, self._respond, request, error)
+        request.notifyFinish().addErrback(lambda _: call.active() and call.cancel())
+        return server.NOT_DONE_YET
+
+    def _body(self, request, error):
+        if error:
+            request.setResponseCode(500)
+            return b'error'
+        request.setHeader(b'content-type', b'image/png')
+        return self.body
+
+    def _respond(self, request, error):
+        request.write(self._body(request, error))
+        request.finish()
+
+
+def listen_origin(origin, hosts):
+    """
+    Listen on 127.0.0.1 to 127.0.0.`hosts` on the same port
+    """
+    site = server.Site(origin)
+    site.noisy = False
+    site.log = lambda request: None
+    port = reactor.listenTCP(0, site, interface='127.0.0.1')
+    number = port.getHost().port
+    ports = [port] + [reactor.listenTCP(number, site, interface='127.0.0.%s' % i) for i in range(2, hosts + 1)]
+    return number, ports
+
+
+def rest_port(app):
+    for service in IServiceCollection(app):
+        if isinstance(service, TCPServer):
+            return service._port.getHost().port
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[int(p * (len(values) - 1))]
+
+
+@defer.inlineCallbacks
+def wait_for(check, timeout, interval=0.05):
+    deadline = time.time() + timeout
+    while not check() and time.time() < deadline:
+        yield task.deferLater(reactor, interval, lambda: None)
+
+
+@defer.inlineCallbacks
+def run(opts):
+    tmp_dir = tempfile.mkdtemp(prefix='flowder-bench-')
+    clients_file = os.path.join(tmp_dir, 'clients.txt')
+    with open(clients_file, 'w') as f:
+        f.write('127.0.0.1|bench|bench\n')
+    options = {
+        'app_id': 'bench',
+        'workers': 1,
+        'rest_port': 0,
+        'rest_bind': '127.0.0.1',
+        'eth': 'lo',
+        'storage_path': os.path.join(tmp_dir, 'files'),
+        'db_file': os.path.join(tmp_dir, 'flowder'),
+        'trusted_clients_file': clients_file,
+        'max_proc': opts.max_proc,
+        'host_rate': opts.host_rate,
+        'host_burst': opts.host_rate,
+        'host_max_concurrency': opts.host_concurrency,
+        'pool_max_per_host': opts.host_concurrency,
+        # one attempt, failures are final
+        'retry_max_attempts': 1,
+        'trace_file': '',
+    }
+    os.makedirs(options['storage_path'])
+    config = BenchConfig(options, {'proxy': {}})
+
+    origin = Origin(opts.size, opts.latency / 1000.0, opts.error_rate, opts.slow_rate, opts.slow_latency)
+    origin_port, origin_ports = listen_origin(origin, opts.hosts)
+
+    app = application(config)
+    services = IServiceCollection(app)
+    broker = FakeBroker(opts.rtt / 1000.0)
+    amqp = services.getServiceNamed('amqp')
+    amqp.do_connect = lambda: amqp.ready(broker)
+
+    results = {}
+    finished = defer.Deferred()
+
+    def job_finished(job_id, result, elapsed):
+        results[result] = results.get(result, 0) + 1
+        if sum(results.values()) == opts.jobs and not finished.called:
+            finished.callback(None)
+
+    get_signal_manager(app).connect(job_finished, signal=signals.job_finished)
+    IService(app).startService()
+    yield wait_for(lambda: '127.0.0.1' in services.getServiceNamed('trusted_clients'), 10)
+
+    rest_uri = 'http://127.0.0.1:%s/schedule.json' % rest_port(app)
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = opts.rest_concurrency
+    agent = Agent(reactor, pool=pool)
+    rest_slots = defer.DeferredSemaphore(opts.rest_concurrency)
+    rest_errors = []
+
+    def post(fields):
+        body = FileBodyProducer(BytesIO(urlencode(fields)))
+        d = agent.request('POST', rest_uri, Headers({'Content-Type': ['application/x-www-form-urlencoded']}), body)
+        d.addCallback(readBody)
+        d.addCallback(lambda body: json.loads(body)['status'] == 'ok' or rest_errors.append(body))
+        d.addErrback(lambda f: rest_errors.append(f.getErrorMessage()))
+        return d
+
+    def send(i):
+        message = {'fetch_uri': 'http://127.0.0.%s:%s/%s.png' % (i % opts.hosts + 1, origin_port, i),
+                   'callback_uri': 'http://127.0.0.1/callback', 'bench_job': str(i), 'sent_at': repr(time.time())}
+        if random.random() < opts.rest_share:
+            rest_slots.run(post, message)
+        else:
+            broker.deliver(message)
+
+    start = time.time()
+    for i in range(opts.jobs):
+        if opts.rate:
+            reactor.callLater(i / opts.rate, send, i)
+        else:
+            send(i)
+
+    timeout = reactor.callLater(opts.timeout, finished.callback, None)
+    yield finished
+    if timeout.active():
+        timeout.cancel()
+    duration = time.time() - start
+    # the last results are still waiting for their confirm
+    yield wait_for(lambda: len(broker.published) >= results.get('success', 0), 10)
+
+    latencies = sorted(at - float(amqp_message_decode(body)['settings']['sent_at']) for at, body in broker.published)
+    rss = get_rss()
+    db_size = sum(os.path.getsize(os.path.join(tmp_dir, name)) for name in os.listdir(tmp_dir)
+                  if name.startswith('flowder') and '.db' in name)
+    files_size = dir_size(options['storage_path'])
+
+    yield IService(app).stopService()
+    yield pool.closeCachedConnections()
+    for port in origin_ports:
+        yield port.stopListening()
+    shutil.rmtree(tmp_dir)
+
+    done = sum(results.values())
+    report = {
+        'commit': git_commit(),
+        'time': start,
+        'options': vars(opts),
+        'jobs': done,
+        'results': results,
+        'rest_errors': len(rest_errors),
+        'origin_requests': origin.requests,
+        'duration': duration,
+        'jobs_per_sec': done / duration,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_p99': percentile(latencies, 0.99),
+        'rss_mb': rss / 1024.0 / 1024.0 if rss is not None else None,
+        'db_mb': db_size / 1024.0 / 1024.0,
+        'files_mb': files_size / 1024.0 / 1024.0,
+    }
+    defer.returnValue(report)
+
+
+def fmt(value, scale=1, unit=''):
+    return '-' if value is None else '%.1f%s' % (value * scale, unit)
+
+
+@defer.inlineCallbacks
+def main(opts):
+    try:
+        report = yield run(opts)
+        print('%(jobs)s/%(total)s jobs in %(duration).2fs: %(rate).0f jobs/s, latency p50 %(p50)s p95 %(p95)s '
+              'p99 %(p99)s, %(results)s, RSS %(rss)s, db %(db)s' % dict(
+                  total=opts.jobs, jobs=report['jobs'], duration=report['duration'], rate=report['jobs_per_sec'],
+                  p50=fmt(report['latency_p50'], 1000, 'ms'), p95=fmt(report['latency_p95'], 1000, 'ms'),
+                  p99=fmt(report['latency_p99'], 1000, 'ms'), results=report['results'],
+                  rss=fmt(report['rss_mb'], unit='MB'), db=fmt(report['db_mb'], unit='MB')))
+        if report['rest_errors']:
+            print('%s REST requests failed' % report['rest_errors'])
+        if opts.output:
+            with open(opts.output, 'a') as f:
+                f.write(json.dumps(report, sort_keys=True) + '\n')
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=0, help="jobs sent per second, 0: all at once")
+    parser.add_argument('--rest-share', type=float, default=0.2, help="share of the jobs sent to schedule.json")
+    parser.add_argument('--rest-concurrency', type=int, default=20, help="REST requests at once")
+    parser.add_argument('--hosts', type=int, default=10, help="origin host names, 127.0.0.1 to 127.0.0.N")
+    parser.add_argument('--size', type=int, default=20000, help="image size in bytes")
+    parser.add_argument('--latency', type=float, default=10, help="origin latency in ms")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of HTTP 500 answers")
+    parser.add_argument('--slow-rate', type=float, default=0.0, help="share of slow answers")
+    parser.add_argument('--slow-latency', type=float, default=5, help="latency of slow answers in seconds")
+    parser.add_argument('--rtt', type=float, default=1, help="broker confirm round trip in ms")
+    parser.add_argument('--max-proc', type=int, default=50)
+    parser.add_argument('--host-rate', type=float, default=1000, help="fetches per second per host")
+    parser.add_argument('--host-concurrency', type=int, default=8, help="fetches at once per host")
+    parser.add_argument('--timeout', type=float, default=300, help="give up after N seconds")
+    parser.add_argument('--output', help="append the results to this file as a JSON line")
+    opts = parser.parse_args()
+    reactor.callWhenRunning(main, opts)
+    reactor.run()
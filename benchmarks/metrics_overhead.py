@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Per job cost of the metrics instrumentation.
+
+Sends the signals a job produces (request received, fetch finished, job
+finished, message published) through the SignalManager with and without
+the MetricsService listening, and times a histogram observation as done by
+the SQLite writer for every statement, the tracing of the stages of a job
+and a full `/metrics` render.
+
+    python benchmarks/metrics_overhead.py --jobs 100000
+"""
+import time
+import argparse
+
+from twisted.internet import defer
+from twisted.application.service import Application, IService, Service
+
+from pygear.twisted.interfaces import ISignalManager
+from pygear.twisted.signal import SignalManager
+
+from flowder import signals
+from flowder.cache import URLResultCache
+from flowder.hostqueue import HostQueue
+from flowder.download import StatsConnectionPool
+from flowder.resolver import CachingResolver
+from flowder.monitor import BlockingCallDetector
+from flowder.services.metrics import MetricsService
+from flowder.tracing import Tracer, SignalExporter
+
+
+class StubPoller(Service):
+    name = 'poller'
+    dq = HostQueue()
+
+
+class StubLauncher(Service):
+    name = 'launcher'
+    threads = {}
+    limit = 50
+    lag_monitor = BlockingCallDetector()
+
+
+class StubFetcher(Service):
+    name = 'fetcher'
+
+    def pool_stats(self):
+        return StatsConnectionPool(None).stats()
+
+
+class StubStorage(Service):
+    name = 'task_storage'
+    url_cache = URLResultCache(maxsize=10, capacity=1000)
+
+
+class StubResolver(Service):
+    name = 'resolver'
+    resolver = CachingResolver()
+
+
+def send_job_signals(signal_manager, jobs):
+    start = time.time()
+    for i in range(jobs):
+        signal_manager.send_catch_log(signal=signals.request_received, jobid=i, source='amqp')
+        signal_manager.send_catch_log(signal=signals.fetch_finished, url='http://127.0.0.1/a.jpg',
+                                      elapsed=0.2, size=50000)
+        signal_manager.send_catch_log(signal=signals.job_finished, job_id=i, result='success', elapsed=0.3)
+        signal_manager.send_catch_log(signal=signals.message_published, message={})
+    return (time.time() - start) / jobs
+
+
+STAGES = ('set_task_running', 'check_cache', 'fetch', 'parse_response', 'save_file',
+          'set_jobid_result_url', 'publish_result', 'set_task_result')
+
+
+def trace_jobs(tracer, jobs):
+    start = time.time()
+    for i in range(jobs):
+        trace = tracer.start(i)
+        for stage in STAGES:
+            trace.track(stage, defer.succeed(None))
+        tracer.finish(trace, result='success')
+    return (time.time() - start) / jobs
+
+
+def main(opts):
+    app = Application('flowder-bench')
+    signal_manager = SignalManager()
+    app.setComponent(ISignalManager, signal_manager)
+    for stub in (StubPoller, StubLauncher, StubFetcher, StubStorage, StubResolver):
+        stub().setServiceParent(app)
+
+    bare = send_job_signals(signal_manager, opts.jobs)
+
+    metrics = MetricsService(app)
+    metrics.setServiceParent(app)
+    IService(app).startService()
+    instrumented = send_job_signals(signal_manager, opts.jobs)
+
+    histogram = metrics.db_statement_duration.labels()
+    start = time.time()
+    for _ in range(opts.jobs):
+        histogram.observe(0.0012)
+    observe = (time.time() - start) / opts.jobs
+
+    # net of the Deferreds the stages return anyway
+    traced = trace_jobs(Tracer([SignalExporter(signal_manager)]), opts.jobs) - trace_jobs(Tracer(), opts.jobs)
+
+    start = time.time()
+    for _ in range(100):
+        body = metrics.render()
+    render = (time.time() - start) / 100
+
+    print("signals per job, no listener  %8.2f us" % (bare * 1e6))
+    print("signals per job, with metrics %8.2f us" % (instrumented * 1e6))
+    print("metrics overhead per job      %8.2f us" % ((instrumented - bare) * 1e6))
+    print("statement latency observe     %8.2f us" % (observe * 1e6))
+    print("job tracing, %s stages         %8.2f us" % (len(STAGES), traced * 1e6))
+    print("/metrics render (%5d bytes)  %8.2f ms" % (len(body), render * 1e3))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=100000)
+    main(parser.parse_args())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Jobs/sec the poller can dispatch for a range of max_proc values.
+
+Runs the real QueuePoller and ThreadedTaskStorage against a launcher stand-in
+whose jobs finish instantly, so the numbers show dispatch overhead only. The
+old one-task-per-tick poller was capped at 1 / poll_interval jobs/sec. Jobs
+are spread over `--hosts` hosts and per-host rate limits are lifted.
+
+    python benchmarks/poller_throughput.py --jobs 5000 --max-proc 1 10 50 100
+"""
+import os
+import time
+import uuid
+import argparse
+import tempfile
+
+from twisted.internet import defer, reactor
+from twisted.application.service import Application, IService, Service
+
+from pygear.twisted.interfaces import ISignalManager
+from pygear.twisted.signal import SignalManager
+
+from flowder.hostqueue import HostQueue
+from flowder.services.poller import QueuePoller
+from flowder.services.storage import ThreadedTaskStorage
+
+
+class InstantLauncher(Service):
+    """
+    Takes tasks from the poller and finishes them right away
+    """
+    name = 'launcher'
+
+    def __init__(self, poller, storage, max_proc, jobs):
+        self.poller = poller
+        self.storage = storage
+        self.max_proc = max_proc
+        self.remaining = jobs
+        self.done = defer.Deferred()
+
+    def startService(self):
+        for slot in range(self.max_proc):
+            self._wait_for_project(slot)
+
+    def _wait_for_project(self, slot):
+        self.poller.next().addCallback(self._run, slot)
+
+    def _run(self, task_info, slot):
+        self.storage.set_task_running(task_info['job_id'])
+        d = self.storage.set_task_finished(task_info['job_id'], self.storage.RESULT_SUCCESS, '')
+        d.addCallback(self._finished, slot)
+
+    def _finished(self, _, slot):
+        self.remaining -= 1
+        if not self.remaining:
+            self.done.callback(None)
+        else:
+            self._wait_for_project(slot)
+
+
+@defer.inlineCallbacks
+def run(max_proc, jobs, poll_size, hosts):
+    db_file = tempfile.mktemp(suffix='.db')
+    app = Application('flowder-bench')
+    app.setComponent(ISignalManager, SignalManager())
+
+    poller = QueuePoller(app, poll_size, HostQueue(rate=jobs, burst=jobs))
+    poller.setServiceParent(app)
+    storage = ThreadedTaskStorage(app, db_file)
+    storage.setServiceParent(app)
+    launcher = InstantLauncher(poller, storage, max_proc, jobs)
+
+    IService(app).startService()
+    yield defer.gatherResults([
+        storage.add({'job_id': uuid.uuid1().hex, 'fetch_uri': 'http://host%s/a.jpg' % (i % hosts), 'settings': '{}'})
+        for i in range(jobs)])
+
+    start = time.time()
+    launcher.startService()
+    yield launcher.done
+    elapsed = time.time() - start
+
+    yield IService(app).stopService()
+    os.remove(db_file)
+    defer.returnValue(jobs / elapsed)
+
+
+@defer.inlineCallbacks
+def main(opts):
+    print("%10s %12s" % ('max_proc', 'jobs/sec'))
+    for max_proc in opts.max_proc:
+        rate = yield run(max_proc, opts.jobs, opts.poll_size, opts.hosts)
+        print("%10s %12.1f" % (max_proc, rate))
+    reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=5000)
+    parser.add_argument('--poll-size', type=int, default=5)
+    parser.add_argument('--hosts', type=int, default=50)
+    parser.add_argument('--max-proc', type=int, nargs='+', default=[1, 5, 10, 50, 100])
+    opts = parser.parse_args()
+    reactor.callWhenRunning(main, opts)
+    reactor.run()
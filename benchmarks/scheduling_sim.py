@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+CPU time per job spent in the scheduling code, on a simulated clock.
+
+Installs a `twisted.internet.task.Clock` as the reactor, so every
+callLater of the real TaskScheduler, QueuePoller, HostQueue, Launcher and
+FileDownloaderTaskStorage (in-memory SQLite) runs in simulated time, and
+fetches take `--latency` simulated seconds without any I/O. Files and
+results go to in-memory stand-ins of the blob store and AMQP. What's left
+is the bookkeeping of a job: signals, dict copies, logging, SQL.
+
+A first run gives the CPU time per job, a second one under cProfile how it
+splits between the components. Builtins and library code count for the
+component calling them; `harness` is the simulation itself.
+
+    python benchmarks/scheduling_sim.py --jobs 1000000 --max-proc 50 --hosts 100
+"""
+from twisted.internet import task
+from twisted.internet.main import installReactor
+
+
+class SimulatedReactor(task.Clock):
+    """
+    Clock with the few other reactor methods the services call
+    """
+
+    def callFromThread(self, f, *args, **kwargs):
+        self.callLater(0, f, *args, **kwargs)
+
+    def callWhenRunning(self, f, *args, **kwargs):
+        self.callLater(0, f, *args, **kwargs)
+
+    def addSystemEventTrigger(self, *args, **kwargs):
+        pass
+
+    def _handleSignals(self):
+        # install_shutdown_handlers asks for the reactor's own handlers first
+        pass
+
+    def _sortCalls(self):
+        # here rather than in twisted, so it counts as harness time
+        self.calls.sort(key=call_time)
+
+
+def call_time(call):
+    return call.getTime()
+
+
+# before anything imports the reactor
+reactor = SimulatedReactor()
+installReactor(reactor)
+
+import os  # noqa: E402
+import json  # noqa: E402
+import pstats  # noqa: E402
+import shutil  # noqa: E402
+import cProfile  # noqa: E402
+import argparse  # noqa: E402
+import resource  # noqa: E402
+import tempfile  # noqa: E402
+from collections import defaultdict  # noqa: E402
+
+from twisted.internet import defer  # noqa: E402
+from twisted.application.service import Application, IService, Service  # noqa: E402
+
+from pygear.twisted.interfaces import ISignalManager  # noqa: E402
+from pygear.twisted.signal import SignalManager  # noqa: E402
+
+from flowder import signals  # noqa: E402
+from flowder.hostqueue import HostQueue  # noqa: E402
+from flowder.launcher import Launcher  # noqa: E402
+from flowder.services.blobstore import BlobStorageService  # noqa: E402
+from flowder.services.poller import QueuePoller  # noqa: E402
+from flowder.services.scheduler import TaskScheduler  # noqa: E402
+from flowder.services.storage import FileDownloaderTaskStorage  # noqa: E402
+
+from benchconfig import BenchConfig  # noqa: E402
+
+# first match of the code's file name wins
+COMPONENTS = (
+    ('/flowder/services/poller.py', 'poller'),
+    ('/flowder/hostqueue.py', 'poller'),
+    ('/flowder/services/scheduler.py', 'scheduler'),
+    ('/flowder/launcher.py', 'launcher'),
+    ('/flowder/tracing.py', 'launcher'),
+    ('/flowder/concurrency.py', 'launcher'),
+    ('/flowder/retry.py', 'launcher'),
+    ('/flowder/httpcache.py', 'launcher'),
+    ('/flowder/services/storage.py', 'storage'),
+    ('/flowder/taskindex.py', 'storage'),
+    ('/flowder/cache.py', 'storage'),
+    ('/flowder/services/blobstore.py', 'storage'),
+    ('pydispatch', 'signals'),
+    ('/pygear/twisted/signal', 'signals'),
+    ('/pygear/logging', 'logging'),
+    ('/twisted/python/log', 'logging'),
+    ('/twisted/logger/', 'logging'),
+    ('/twisted/', 'twisted'),
+    ('/pygear/', 'pygear'),
+    (os.path.basename(__file__), 'harness'),
+    ('benchconfig', 'harness'),
+)
+
+
+class InstantFetcher(Service):
+    """
+    Every download takes `latency` simulated seconds and is never written
+    anywhere
+    """
+    name = 'fetcher'
+
+    def __init__(self, latency, size):
+        self.latency = latency
+        self.size = size
+        self.fetches = 0
+
+    def fetch_to_file(self, url, headers=None):
+        self.fetches += 1
+        d = defer.Deferred()
+        reactor.callLater(self.latency, d.callback, (None, '.png', '%064x' % self.fetches, self.size, {}))
+        return d
+
+    def host_busy(self, hostname):
+        return False
+
+
+class MemoryBlobStorage(BlobStorageService):
+    """
+    Counts the references in the task storage but keeps no file
+    """
+
+    def _link(self, tmp_path, file_name):
+        pass
+
+
+class NullPublisher(Service):
+    name = 'amqp'
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, message):
+        self.published += 1
+        return defer.succeed(None)
+
+
+class NullMonitor(object):
+    """
+    Stands in for the blocking call detector, whose watchdog thread runs
+    on the wall clock
+    """
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def pop_max(self):
+        return 0
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def component(func):
+    filename = func[0]
+    for marker, name in COMPONENTS:
+        if marker in filename:
+            return name
+    return 'other'
+
+
+def split_by_component(profile):
+    """
+    Own time of every component; code of none (builtins, the standard
+    library, json, sqlite3) counts for its callers
+    """
+    stats = pstats.Stats(profile).stats
+    owners = {}
+    totals = defaultdict(float)
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        for name, share in owned_by(func, stats, owners).items():
+            totals[name] += tt * share
+    return totals
+
+
+def owned_by(func, stats, owners, path=()):
+    """
+    Share of the time of `func` that goes to each component
+    """
+    if func not in owners:
+        name = component(func)
+        callers = stats[func][4] if func in stats else {}
+        # own time of `func` when called by each of them
+        weights = dict((caller, timing[2]) for caller, timing in callers.items() if caller not in path)
+        total = sum(weights.values())
+        if name != 'other' or not total:
+            owners[func] = {name: 1.0}
+            return owners[func]
+        shares = defaultdict(float)
+        for caller, weight in weights.items():
+            for owner, share in owned_by(caller, stats, owners, path + (func,)).items():
+                shares[owner] += share * weight / total
+        owners[func] = shares
+    return owners[func]
+
+
+def build(opts, tmp_dir):
+    app = Application('flowder-sim')
+    signal_manager = SignalManager()
+    app.setComponent(ISignalManager, signal_manager)
+    options = {
+        'eth': 'lo',
+        'storage_path': tmp_dir,
+        'max_proc': opts.max_proc,
+        'fetch_mode': 'stream',
+        'trace_file': '',
+    }
+    options.update(opts.set)
+    config = BenchConfig(options)
+
+    fetcher = InstantFetcher(opts.latency, opts.size)
+    fetcher.setServiceParent(app)
+    host_queue = HostQueue(rate=opts.host_rate, burst=max(1, int(opts.host_rate)), host_busy=fetcher.host_busy)
+    QueuePoller(app, config.getint('poll_size', 5), host_queue).setServiceParent(app)
+    FileDownloaderTaskStorage(app).setServiceParent(app)
+    MemoryBlobStorage(app, config).setServiceParent(app)
+    NullPublisher().setServiceParent(app)
+    scheduler = TaskScheduler(config, app)
+    scheduler.setServiceParent(app)
+    launcher = Launcher(app, config)
+    launcher.lag_monitor = NullMonitor()
+    launcher.setServiceParent(app)
+    return app, signal_manager, scheduler
+
+
+def simulate(opts, jobs, profile=None):
+    """
+    Push `jobs` jobs through a fresh service tree; returns the CPU seconds
+    and simulated seconds it took
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='flowder-sim-')
+    app, signal_manager, scheduler = build(opts, tmp_dir)
+    state = {'scheduled': 0, 'finished': 0}
+
+    def job_finished(job_id, result, elapsed):
+        state['finished'] += 1
+
+    signal_manager.connect(job_finished, signal=signals.job_finished)
+    IService(app).startService()
+    reactor.advance(0)
+
+    if profile is not None:
+        profile.enable()
+    start, sim_start = cpu_time(), reactor.seconds()
+    last_progress = (0, sim_start)
+    while state['finished'] < jobs:
+        # keep `backlog` tasks waiting, the way the broker feeds them
+        missing = min(opts.backlog - (state['scheduled'] - state['finished']), jobs - state['scheduled'])
+        if missing >= opts.batch or (missing > 0 and state['scheduled'] + missing == jobs):
+            first = state['scheduled']
+            scheduler.schedule_many([
+                {'job_id': 'job%s' % i, 'fetch_uri': 'http://host%s.example.com/%s.png' % (i % opts.hosts, i),
+                 'settings': json.dumps({'callback_uri': 'http://127.0.0.1/', 'job': i})}
+                for i in range(first, first + missing)])
+            state['scheduled'] += missing
+        reactor.advance(max(0, min(call.getTime() for call in reactor.getDelayedCalls()) - reactor.seconds()))
+        if state['finished'] != last_progress[0]:
+            last_progress = (state['finished'], reactor.seconds())
+        elif reactor.seconds() - last_progress[1] > 600:
+            raise RuntimeError("No job finished for 10 simulated minutes, %s of %s done"
+                               % (state['finished'], jobs))
+    elapsed, sim_elapsed = cpu_time() - start, reactor.seconds() - sim_start
+    if profile is not None:
+        profile.disable()
+
+    IService(app).stopService()
+    reactor.advance(0)
+    shutil.rmtree(tmp_dir)
+    return elapsed, sim_elapsed
+
+
+def main(opts):
+    cpu, sim_time = simulate(opts, opts.jobs)
+    per_job = cpu / opts.jobs
+    print("%s jobs, %.1f simulated jobs/s, %.2fs CPU: %.1f us per job"
+          % (opts.jobs, opts.jobs / sim_time, cpu, per_job * 1e6))
+
+    profile = cProfile.Profile()
+    simulate(opts, opts.profile_jobs, profile)
+    totals = split_by_component(profile)
+    total = sum(totals.values())
+    print("%-10s %8s %10s" % ('component', 'share', 'us/job'))
+    for name, seconds in sorted(totals.items(), key=lambda item: -item[1]):
+        share = seconds / total
+        print("%-10s %7.1f%% %10.1f" % (name, share * 100, share * per_job * 1e6))
+
+
+def option(text):
+    key, _, value = text.partition('=')
+    return key.strip(), value.strip()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=200000)
+    parser.add_argument('--profile-jobs', type=int, default=50000, help="jobs of the profiled run")
+    parser.add_argument('--max-proc', type=int, default=50)
+    parser.add_argument('--hosts', type=int, default=100)
+    parser.add_argument('--host-rate', type=float, default=1000, help="fetches per simulated second per host")
+    parser.add_argument('--latency', type=float, default=0.05, help="simulated fetch time in seconds")
+    parser.add_argument('--size', type=int, default=50000, help="reported download size")
+    parser.add_argument('--backlog', type=int, default=2000, help="tasks scheduled ahead of the launcher")
+    parser.add_argument('--batch', type=int, default=500, help="tasks scheduled at once")
+    parser.add_argument('--set', type=option, action='append', default=[], metavar='OPTION=VALUE',
+                        help="flowder option, e.g. --set tracing=0")
+    opts = parser.parse_args()
+    opts.set = dict(opts.set)
+    main(opts)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Task table query latency before and after the indexed schema.
+
+Builds a `task_list` with the pre-migration (version 1) schema, where almost
+every row is done, times the hot queries, runs the in-place migration and
+times them again.
+
+    python benchmarks/storage_queries.py --rows 10000000 --db /tmp/flowder-bench.db
+"""
+import os
+import time
+import uuid
+import sqlite3
+import argparse
+
+from flowder.services.storage import FileDownloaderTaskStorage
+
+ACTIVE_EVERY = 1000  # one non-done row in every ACTIVE_EVERY rows
+
+# the startup load, with the columns both schemas have; the storage's own
+# query reads columns later versions added
+ACTIVE_TASKS_QUERY = "select id, job_id, status, fetch_uri, result_url, settings from %s " \
+                     "WHERE status != '%s' order by created asc, id asc"
+
+
+def build(conn, storage, rows, batch=100000):
+    storage._migration_1(conn)
+    conn.execute("create table if not exists schema_version (name text primary key, version integer)")
+    conn.execute("insert or replace into schema_version (name, version) values (?, 1)", (storage.table,))
+    q = "insert into %s (job_id, status, fetch_uri, result_url, settings, created, updated, " \
+        "result_type, result_message) values (?,?,?,?,?,?,?,?,?)" % storage.table
+    now = int(time.time()) - rows
+    for start in range(0, rows, batch):
+        args = []
+        for i in range(start, min(start + batch, rows)):
+            active = i % ACTIVE_EVERY == 0
+            status = storage.TASK_STANDBY if active else storage.TASK_DONE
+            result_url = '' if active else '%s.jpg' % i
+            args.append((uuid.uuid1().hex, status, 'http://cdn%s.example.com/%s.jpg' % (i % 8, i),
+                         result_url, '{}', now + i, now + i, storage.RESULT_SUCCESS, ''))
+        conn.executemany(q, args)
+        conn.commit()
+
+
+def sample(conn, storage, rows):
+    mid = rows // 2
+    job_id = conn.execute("select job_id from %s where id=?" % storage.table, (mid,)).fetchone()[0]
+    fetch_uri = 'http://cdn%s.example.com/%s.jpg' % (mid % 8, mid)
+    return job_id, fetch_uri
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def run_queries(conn, storage, job_id, fetch_uri, repeat):
+    t = storage.table
+    queries = [
+        ('job_id update', lambda: conn.execute(
+            "UPDATE %s SET status=?, updated=? WHERE job_id=?;" % t,
+            (storage.TASK_DONE, int(time.time()), job_id))),
+        ('active tasks', lambda: conn.execute(ACTIVE_TASKS_QUERY % (t, storage.TASK_DONE)).fetchall()),
+        ('url already fetched', lambda: conn.execute(
+            "SELECT * from %s where fetch_uri=? and status=? and result_type=? "
+            "and result_url IS NOT NULL AND result_url != '' LIMIT 1" % t,
+            (fetch_uri, storage.TASK_DONE, storage.RESULT_SUCCESS)).fetchone()),
+    ]
+    results = {}
+    for name, func in queries:
+        results[name] = timeit(func, repeat)
+    conn.rollback()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10 * 1000 * 1000)
+    parser.add_argument('--db', default='/tmp/flowder-bench.db')
+    parser.add_argument('--repeat', type=int, default=5)
+    opts = parser.parse_args()
+
+    if os.path.exists(opts.db):
+        os.remove(opts.db)
+
+    storage = FileDownloaderTaskStorage(None, opts.db)
+    conn = sqlite3.connect(opts.db)
+
+    start = time.time()
+    build(conn, storage, opts.rows)
+    print("Built %s rows in %.1fs" % (opts.rows, time.time() - start))
+
+    job_id, fetch_uri = sample(conn, storage, opts.rows)
+    before = run_queries(conn, storage, job_id, fetch_uri, opts.repeat)
+
+    start = time.time()
+    storage.migrate(conn)
+    print("Migrated to schema version %s in %.1fs" % (storage.SCHEMA_VERSION, time.time() - start))
+
+    after = run_queries(conn, storage, job_id, fetch_uri, opts.repeat)
+
+    print("%-22s %14s %14s" % ('query (median ms)', 'schema v1', 'schema v%s' % storage.SCHEMA_VERSION))
+    for name in sorted(before):
+        print("%-22s %14.3f %14.3f" % (name, before[name], after[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,5 +19,3 @@ def get_application(config=None):
     app_path = config.get('application', 'flowder.app.application')
     app_func = load_object(app_path)
     return app_func(config)
-
-application = get_application()
@@ -0,0 +1,76 @@
+import socket
+import struct
+
+
+def ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def parse_network(network):
+    """
+    `(address, prefix length)` of an `a.b.c.d/n` network or a single IP,
+    with the host bits of the address cleared
+    """
+    address, _, prefix = network.partition('/')
+    prefix = int(prefix) if prefix else 32
+    if not 0 <= prefix <= 32:
+        raise ValueError("Invalid network %s" % network)
+    mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+    return ip_to_int(address) & mask, prefix
+
+
+class TrustedClients(object):
+    """
+    Trusted client details indexed by IP.
+
+    Single addresses are found with one dict lookup. Networks are kept in
+    a dict per prefix length, so a lookup costs one masked lookup per
+    prefix length in use, longest first. Clients given by name are also
+    indexed by hostname for callback URLs.
+    """
+
+    def __init__(self):
+        self.addresses = {}
+        self.networks = {}
+        self.prefixes = []
+        self.hosts = {}
+
+    def __len__(self):
+        return len(self.addresses) + sum(len(nets) for nets in self.networks.values())
+
+    def __contains__(self, ip):
+        return self.get(ip) is not None
+
+    def add(self, network, details):
+        if '/' not in network:
+            self.addresses[network] = details
+            return
+        address, prefix = parse_network(network)
+        if prefix == 32:
+            self.addresses[socket.inet_ntoa(struct.pack('!I', address))] = details
+            return
+        if prefix not in self.networks:
+            self.networks[prefix] = {}
+            self.prefixes = sorted(self.networks, reverse=True)
+        self.networks[prefix][address] = details
+
+    def add_host(self, hostname, details):
+        self.hosts[hostname] = details
+
+    def get(self, ip):
+        details = self.addresses.get(ip)
+        if details is not None or not self.prefixes:
+            return details
+        try:
+            address = ip_to_int(ip)
+        except (socket.error, TypeError):
+            return None
+        for prefix in self.prefixes:
+            mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+            details = self.networks[prefix].get(address & mask)
+            if details is not None:
+                return details
+        return None
+
+    def get_host(self, hostname):
+        return self.hosts.get(hostname)
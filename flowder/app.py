@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import os
+import socket
+
 from twisted.application.service import Application
 from twisted.python import log
 from twisted.web import server
@@ -8,15 +11,36 @@ from pygear.system.loading import load_object
 from pygear.twisted.interfaces import ISignalManager
 from pygear.twisted.signal import SignalManager
 
+from .cache import URLResultCache
+from .hostqueue import HostQueue
 from .services.website import Root
 from .services.poller import QueuePoller
 from .services.fetcher import FetcherService
-from .services.storage import FileDownloaderTaskStorage
+from .services.blobstore import BlobStorageService
+from .services.archiver import TaskArchiverService
 from .services.scheduler import TaskScheduler
 from .services.amqp import AmqpService
+from .services.metrics import MetricsService
+from .services.resolver import ResolverService
+from .services.clients import TrustedClientsService
+from .supervisor import WorkerSupervisor, WorkerMonitor, AdoptedTCPServer, get_workers, get_worker_id, \
+    REST_FD_ENV
+
+
+def supervisor_application(config, workers):
+    app = Application("Flowder supervisor")
+    supervisor = WorkerSupervisor(config, workers)
+    supervisor.setServiceParent(app)
+    log.msg("Starting %s Flowder workers" % workers)
+    return app
 
 
 def application(config):
+    workers = get_workers(config)
+    worker_id = get_worker_id()
+    if workers > 1 and worker_id is None:
+        return supervisor_application(config, workers)
+
     app = Application("Flowder")
     app_id = config.get('app_id', 'fw0')
     logfile = config.get('logfile', '/var/log/flowder.log')
@@ -25,22 +49,55 @@ def application(config):
     db_file = config.get('db_file', 'flowder')
     rest_port = config.getint('rest_port', 4000)
     rest_bind = config.get('rest_bind', '0.0.0.0')
-    poll_interval = config.getfloat('poll_interval', 1)
+    poll_interval = config.getfloat('poll_interval', 5)  # fallback, the poller is event driven
     poll_size = config.getint("poll_size", 5)
 
+    blob_namespace = ''
+    if worker_id is not None:
+        # every worker has its own database shard and files
+        app_id = '%s-%s' % (app_id, worker_id)
+        db_file = '%s-%s' % (db_file, worker_id)
+        blob_namespace = 'w%s' % worker_id
+        WorkerMonitor().setServiceParent(app)
+
     signalmanager = SignalManager()
     app.setComponent(ISignalManager, signalmanager)
 
+    resolver = ResolverService(config)
+    resolver.setServiceParent(app)
+
+    trusted_clients = TrustedClientsService(app, config)
+    trusted_clients.setServiceParent(app)
+
     fetcher = FetcherService(config)
     fetcher.setServiceParent(app)
 
-    poller = QueuePoller(app, poll_size)
+    host_rates = dict((host, float(rate)) for host, rate in config.items('host_rates', ()))
+    host_queue = HostQueue(rate=config.getfloat('host_rate', 10),
+                           burst=config.getint('host_burst', 10),
+                           host_depth=config.getint('host_queue_depth', 2),
+                           host_rates=host_rates,
+                           backoff_max=config.getint('host_backoff_max', 300),
+                           host_busy=fetcher.host_busy)
+    poller = QueuePoller(app, poll_size, host_queue)
     poller.setServiceParent(app)
 
     db_file = '%s.db' % db_file
-    task_storage = FileDownloaderTaskStorage(app, db_file)
+    url_cache = URLResultCache(maxsize=config.getint('url_cache_size', 100000),
+                               capacity=config.getint('url_bloom_capacity', 10000000),
+                               error_rate=config.getfloat('url_bloom_error_rate', 0.01))
+    storage_cls = load_object(config.get('task_storage', 'flowder.services.storage.ThreadedTaskStorage'))
+    task_storage = storage_cls.from_config(app, config, database=db_file, url_cache=url_cache,
+                                           owner='%s@%s:%s' % (app_id, socket.gethostname(), os.getpid()),
+                                           node='%s@%s' % (app_id, socket.gethostname()))
     task_storage.setServiceParent(app)
 
+    blob_storage = BlobStorageService(app, config, blob_namespace)
+    blob_storage.setServiceParent(app)
+
+    archiver = TaskArchiverService(app, config)
+    archiver.setServiceParent(app)
+
     timer = TimerService(poll_interval, poller.poll)
     timer.setServiceParent(app)
 
@@ -52,10 +109,18 @@ def application(config):
     launcher = laucls(app, config)
     launcher.setServiceParent(app)
 
-    restService = TCPServer(rest_port, server.Site(Root(app, config)), interface=rest_bind)
+    metrics = MetricsService(app)
+    metrics.setServiceParent(app)
+
+    site = server.Site(Root(app, config))
+    if REST_FD_ENV in os.environ:
+        restService = AdoptedTCPServer(int(os.environ[REST_FD_ENV]), site)
+    else:
+        restService = TCPServer(rest_port, site, interface=rest_bind)
     restService.setServiceParent(app)
 
     amqp_publisher = AmqpService(app, config)
+    amqp_publisher.app_id = app_id
     amqp_publisher.setServiceParent(app)
 
     log.msg("Starting Flowder services (;-)")
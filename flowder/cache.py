@@ -0,0 +1,150 @@
+import math
+import struct
+import hashlib
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Size bounded mapping that drops the least recently used key first
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def items(self):
+        return list(self._data.items())
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def discard(self, key):
+        self._data.pop(key, None)
+
+
+class BloomFilter(object):
+    """
+    Set membership with no false negatives and about `error_rate` false
+    positives up to `capacity` keys.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        # double hashing: h1 + i * h2 gives every position we need
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class URLResultCache(object):
+    """
+    Front cache for `check_url_already_fetched`.
+
+    Hot URLs are answered from an LRU of fetch_uri -> result_url. A Bloom
+    filter of every URL with a result answers "never fetched" for new URLs,
+    so only the rest have to go to the database. Until `warm_up` is called
+    every miss goes to the database.
+    """
+
+    def __init__(self, maxsize=100000, capacity=10000000, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.lru = LRUCache(maxsize)
+        self.bloom = self.new_bloom()
+        self.warmed_up = False
+
+        self.hits = 0
+        self.misses = 0
+        self.db_lookups = 0
+
+    def get(self, url):
+        """
+        Return the result url, `None` when `url` has surely never been
+        fetched, or raise `KeyError` when the database has to be asked.
+        """
+        result_url = self.lru.get(url)
+        if result_url is not None:
+            self.hits += 1
+            return result_url
+        if self.warmed_up and url not in self.bloom:
+            self.misses += 1
+            return None
+        self.db_lookups += 1
+        raise KeyError(url)
+
+    def maybe_fetched(self, url):
+        """
+        False when `url` has surely never been fetched
+        """
+        return not self.warmed_up or url in self.bloom
+
+    def set(self, url, result_url):
+        self.lru.set(url, result_url)
+        self.bloom.add(url)
+
+    def discard(self, url):
+        """
+        Forget the result of `url`, whose file may be gone; the database
+        is asked next time
+        """
+        self.lru.discard(url)
+
+    def new_bloom(self):
+        return BloomFilter(self.capacity, self.error_rate)
+
+    def warm_up(self, bloom, items):
+        """
+        Switch to a Bloom filter built from the database, keeping the URLs
+        set meanwhile, and load `items` (oldest first) into the LRU.
+        """
+        recent = self.lru.items()
+        for url, result_url in items:
+            self.lru.set(url, result_url)
+        for url, result_url in recent:
+            bloom.add(url)
+            self.lru.set(url, result_url)
+        self.bloom = bloom
+        self.warmed_up = True
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'db_lookups': self.db_lookups,
+            'size': len(self.lru),
+            'bloom_keys': self.bloom.count,
+        }
@@ -0,0 +1,75 @@
+class AIMDController(object):
+    """
+    Number of launcher slots in use, adjusted once per interval.
+
+    The limit grows by `increase` when every slot was busy and nothing
+    looked overloaded, and is multiplied by `decrease` when the process
+    uses more than `max_rss` bytes, the reactor lagged more than `max_lag`
+    seconds, more than `max_error_rate` of the fetches timed out, or the
+    mean fetch latency went above `latency_tolerance` times its baseline.
+    The baseline is the lowest mean latency seen, slowly following the
+    latencies of healthy intervals.
+    """
+
+    def __init__(self, initial, min_limit=1, max_limit=None, increase=1, decrease=0.75,
+                 latency_tolerance=2.0, max_error_rate=0.1, max_lag=0.5, max_rss=0, min_samples=10):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit or initial)
+        self.limit = min(max(initial, self.min_limit), self.max_limit)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.max_error_rate = max_error_rate
+        self.max_lag = max_lag
+        self.max_rss = max_rss
+        self.min_samples = min_samples
+        self.baseline = None
+        self.reason = None
+        self._reset()
+
+    def _reset(self):
+        self.successes = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+
+    @property
+    def fixed(self):
+        return self.min_limit == self.max_limit
+
+    def observe(self, latency):
+        self.successes += 1
+        self.latency_sum += latency
+
+    def error(self):
+        self.errors += 1
+
+    def update(self, saturated, lag=0, rss=0):
+        """
+        New limit after an interval; `saturated` tells whether all the
+        slots were busy at some point of it
+        """
+        samples = self.successes + self.errors
+        mean = self.latency_sum / self.successes if self.successes else None
+        if self.max_rss and rss > self.max_rss:
+            self.reason = "memory %.0fMB" % (rss / 1048576.0)
+        elif self.max_lag and lag > self.max_lag:
+            self.reason = "reactor lag %.3fs" % lag
+        elif samples >= self.min_samples and self.errors > samples * self.max_error_rate:
+            self.reason = "%s of %s fetches failed" % (self.errors, samples)
+        elif self.successes >= self.min_samples and self.baseline is not None and \
+                mean > self.baseline * self.latency_tolerance:
+            self.reason = "latency %.3fs, baseline %.3fs" % (mean, self.baseline)
+        else:
+            self.reason = None
+            if self.successes >= self.min_samples:
+                if self.baseline is None or mean < self.baseline:
+                    self.baseline = mean
+                else:
+                    self.baseline += (mean - self.baseline) * 0.05
+
+        if self.reason is not None:
+            self.limit = max(self.min_limit, int(self.limit * self.decrease))
+        elif saturated:
+            self.limit = min(self.max_limit, self.limit + self.increase)
+        self._reset()
+        return self.limit
@@ -0,0 +1,220 @@
+import time
+import sqlite3
+import threading
+
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+from pygear.logging import log
+from pygear.core.six.moves import queue
+
+from flowder.exceptions import WriterStopped
+
+
+_STOP = object()
+# what's queued: a read, a write in the group transaction, or a call on its own
+_READ = object()
+_WRITE = object()
+_EXCLUSIVE = object()
+
+
+class SQLiteWriter(threading.Thread):
+    """
+    A dedicated thread owning a single SQLite connection.
+
+    Every statement is queued from the reactor thread and executed here, so
+    disk I/O never blocks the reactor. Writes are committed in groups, either
+    when `commit_size` statements are pending or `commit_interval` seconds
+    after the first uncommitted one. Deferreds returned by `write` fire once
+    the commit is durable, those of `execute` and `read` as soon as the
+    statement has run.
+
+    Every write runs in a savepoint of the group transaction: when it
+    raises, what it changed so far is rolled back and the rest of the group
+    is still committed.
+    """
+
+    def __init__(self, database, commit_interval=0.05, commit_size=100):
+        threading.Thread.__init__(self, name='flowder-sqlite-writer')
+        self.daemon = True
+        self.database = database
+        self.commit_interval = commit_interval
+        self.commit_size = commit_size
+
+        self._queue = queue.Queue()
+        self._pending = []
+        self._uncommitted = 0
+        self._first_pending = None
+        self._in_transaction = False
+        self._stopped = defer.Deferred()
+        self._closed = False
+        self.conn = None
+        # anything with `observe(seconds)`, called for every statement
+        self.statement_latency = None
+
+    def read(self, func, *args, **kwargs):
+        return self._submit(_READ, False, func, args, kwargs)
+
+    def write(self, func, *args, **kwargs):
+        return self._submit(_WRITE, True, func, args, kwargs)
+
+    def execute(self, func, *args, **kwargs):
+        """
+        Like `write`, but don't wait for the group commit to report back
+        """
+        return self._submit(_WRITE, False, func, args, kwargs)
+
+    def exclusive(self, func, *args, **kwargs):
+        """
+        Commit what's pending, then run `func` on its own, committing and
+        starting transactions the way `sqlite3` does by default. For code
+        that commits itself or runs statements that can't be in a
+        transaction, like migrations and VACUUM.
+        """
+        return self._submit(_EXCLUSIVE, False, func, args, kwargs)
+
+    def _submit(self, kind, durable, func, args, kwargs):
+        # nothing queued after the stop would ever run
+        if self._closed:
+            return defer.fail(WriterStopped("The database writer of %s is stopped" % self.database))
+        d = defer.Deferred()
+        self._queue.put((kind, durable, func, args, kwargs, d))
+        return d
+
+    def backlog(self):
+        """
+        Number of statements queued and not run yet
+        """
+        return self._queue.qsize()
+
+    def stop(self):
+        """
+        Flush and commit everything queued so far, then close the connection.
+        Returns a Deferred fired when the thread has finished; anything
+        queued afterwards fails with `WriterStopped`.
+        """
+        self._closed = True
+        self._queue.put(_STOP)
+        return self._stopped
+
+    def run(self):
+        # transactions are begun and committed here, not by `sqlite3`, whose
+        # implicit commits would end the group at every savepoint on py2
+        self.conn = sqlite3.connect(self.database, check_same_thread=False, isolation_level=None)
+        while True:
+            try:
+                item = self._queue.get(timeout=self._get_timeout())
+            except queue.Empty:
+                self._commit()
+                continue
+
+            if item is _STOP:
+                self._commit()
+                break
+
+            kind, durable, func, args, kwargs, d = item
+            started = time.time()
+            if kind is _WRITE:
+                result = self._run_write(func, args, kwargs)
+            elif kind is _EXCLUSIVE:
+                self._commit()
+                result = self._run_exclusive(func, args, kwargs)
+            else:
+                result = self._run(func, args, kwargs)
+            if self.statement_latency is not None:
+                self.statement_latency.observe(time.time() - started)
+            if isinstance(result, Failure):
+                reactor.callFromThread(d.errback, result)
+                if not self._uncommitted:
+                    # nothing else in the transaction, don't hold it open
+                    self._commit()
+                continue
+
+            if durable:
+                self._pending.append((d, result))
+            else:
+                reactor.callFromThread(d.callback, result)
+
+            if kind is _WRITE:
+                if not self._uncommitted:
+                    self._first_pending = time.time()
+                self._uncommitted += 1
+                if self._uncommitted >= self.commit_size:
+                    self._commit()
+
+        self.conn.close()
+        reactor.callFromThread(self._stopped.callback, None)
+
+    def _run(self, func, args, kwargs):
+        try:
+            return func(self.conn, *args, **kwargs)
+        except Exception:
+            return Failure()
+
+    def _run_write(self, func, args, kwargs):
+        try:
+            if not self._in_transaction:
+                # take the write lock now, upgrading a read lock later fails at once
+                # when another process writes to the database
+                self.conn.execute("BEGIN IMMEDIATE")
+                self._in_transaction = True
+            self.conn.execute("SAVEPOINT interaction")
+            result = self._run(func, args, kwargs)
+            if isinstance(result, Failure):
+                self.conn.execute("ROLLBACK TO interaction")
+            self.conn.execute("RELEASE interaction")
+        except sqlite3.Error as e:
+            # sqlite gave up the whole transaction (disk full, I/O error)
+            log.err("Group transaction failed: %s" % e)
+            result = Failure()
+            self._rollback(result)
+        return result
+
+    def _run_exclusive(self, func, args, kwargs):
+        self.conn.isolation_level = ''
+        try:
+            result = self._run(func, args, kwargs)
+            if isinstance(result, Failure):
+                self.conn.rollback()
+            else:
+                self.conn.commit()
+        except Exception:
+            result = Failure()
+        finally:
+            self.conn.isolation_level = None
+        return result
+
+    def _get_timeout(self):
+        if not self._uncommitted:
+            return None
+        return max(0, self._first_pending + self.commit_interval - time.time())
+
+    def _commit(self):
+        if not self._in_transaction:
+            return
+        count, self._uncommitted = self._uncommitted, 0
+        try:
+            self.conn.execute("COMMIT")
+        except Exception as e:
+            log.err("Group commit of %s statements failed: %s" % (count, e))
+            self._rollback(Failure())
+        else:
+            pending, self._pending = self._pending, []
+            self._in_transaction = False
+            for d, result in pending:
+                reactor.callFromThread(d.callback, result)
+
+    def _rollback(self, failure):
+        """
+        Drop the group transaction, failing the writes waiting for it
+        """
+        pending, self._pending = self._pending, []
+        self._uncommitted = 0
+        self._in_transaction = False
+        try:
+            self.conn.execute("ROLLBACK")
+        except sqlite3.Error:
+            # already rolled back by sqlite
+            pass
+        for d, _ in pending:
+            reactor.callFromThread(d.errback, failure)
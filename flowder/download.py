@@ -0,0 +1,213 @@
+import os
+import hashlib
+import tempfile
+import mimetypes
+
+from twisted.internet import defer, protocol
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone, PotentialDataLoss, HTTPConnectionPool
+
+from pygear.logging import log
+from pygear.system.magic import get_buffer_extension
+
+from .exceptions import NoResponseContent, InvalidResponse, InvalidResponseRetry, ResponseTooLarge, HostThrottled
+
+# answers telling us to slow down
+THROTTLE_STATUSES = (429, 503)
+# failed answers worth another try later, besides 5xx; other ones are final
+RETRY_STATUSES = (408,)
+
+# Content-Type values servers use besides the registered one
+CONTENT_TYPE_ALIASES = {
+    'jpg': ('image/jpg', 'image/pjpeg'),
+    'jpeg': ('image/jpg', 'image/pjpeg'),
+    'png': ('image/x-png',),
+}
+# sent for any kind of file, the first bytes of the body decide
+GENERIC_CONTENT_TYPES = ('application/octet-stream', 'binary/octet-stream', 'application/download',
+                         'application/force-download')
+
+
+def check_throttled(url, status, retry_after=None):
+    """
+    Raise `HostThrottled` when `status` asks us to slow down; `retry_after`
+    is the raw Retry-After header, only the delay in seconds form is used
+    """
+    if status not in THROTTLE_STATUSES:
+        return
+    try:
+        retry_after = int(retry_after)
+    except (TypeError, ValueError):
+        retry_after = None
+    raise HostThrottled("Host throttled %s with status %s" % (url, status), retry_after)
+
+
+def valid_content_types(extensions):
+    """
+    Content-Type values a file with one of `extensions` may be served with
+    """
+    types = set(GENERIC_CONTENT_TYPES)
+    for ext in extensions:
+        ext = ext.strip().lstrip('.').lower()
+        if '.' + ext in mimetypes.types_map:
+            types.add(mimetypes.types_map['.' + ext])
+        types.update(CONTENT_TYPE_ALIASES.get(ext, ()))
+    return frozenset(types)
+
+
+def check_response(url, status, content_type, length, valid_types, max_size):
+    """
+    Raise when the status or headers of a response show its body isn't a
+    file we keep: `InvalidResponseRetry` for server errors that may go
+    away, `InvalidResponse` or `ResponseTooLarge` otherwise. `content_type`
+    is the raw header and `length` the announced size, both may be None.
+    """
+    if not 200 <= status < 300:
+        if status >= 500 or status in RETRY_STATUSES:
+            raise InvalidResponseRetry("Status %s for %s, retry!" % (status, url))
+        raise InvalidResponse("Status %s for %s" % (status, url))
+
+    if content_type:
+        mime = content_type.split(';')[0].strip().lower()
+        if mime not in valid_types:
+            raise InvalidResponse("Content-Type %s of %s isn't a valid file type" % (mime, url))
+
+    if max_size and length is not None and length > max_size:
+        raise ResponseTooLarge("Response max size exceeded!")
+
+
+class FileBodyReceiver(protocol.Protocol):
+    """
+    Streams a response body into a temporary file under `storage_path`.
+
+    The file type is sniffed from the first `SNIFF_SIZE` bytes and
+    `max_size` is enforced as data arrives, so at most one chunk of the body
+    is held in memory. The content is hashed while it is written.
+    `finished` fires with `(tmp_path, extension, hexdigest, size)` once the
+    whole body is on disk; the caller moves the file into place.
+    """
+    SNIFF_SIZE = 1024
+
+    def __init__(self, finished, storage_path, max_size, valid_extensions, hash_name='sha256'):
+        self.finished = finished
+        self.max_size = max_size
+        self.valid_extensions = valid_extensions
+        self.size = 0
+        self.extension = None
+        self.hash = hashlib.new(hash_name)
+        self._head = b''
+
+        fd, self.tmp_path = tempfile.mkstemp(dir=storage_path, suffix='.part')
+        self.file = os.fdopen(fd, 'wb')
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            return self.abort(ResponseTooLarge("Response max size exceeded!"))
+
+        if self.extension is None:
+            self._head += data
+            if len(self._head) < self.SNIFF_SIZE:
+                return
+            data, self._head = self._head, b''
+            if not self.sniff(data):
+                return
+
+        self.write(data)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self.finished.called:
+            return
+
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            return self.abort(reason, lost=True)
+
+        if self.extension is None:
+            if not self._head:
+                return self.abort(NoResponseContent("Response has no body!"), lost=True)
+            if not self.sniff(self._head, lost=True):
+                return
+            self.write(self._head)
+
+        self.file.close()
+        self.finished.callback((self.tmp_path, self.extension, self.hash.hexdigest(), self.size))
+
+    def write(self, data):
+        self.hash.update(data)
+        self.file.write(data)
+
+    def sniff(self, data, lost=False):
+        self.extension = get_buffer_extension(data)
+        if self.extension.lstrip('.') not in self.valid_extensions:
+            self.abort(InvalidResponse("Invalid content type!"), lost)
+            return False
+        return True
+
+    def abort(self, reason, lost=False):
+        """
+        Drop the partial file and stop downloading the rest of the body
+        """
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError as e:
+            log.err("Can't remove partial download %s: %s" % (self.tmp_path, e))
+
+        if not self.finished.called:
+            if not isinstance(reason, Failure):
+                reason = Failure(reason)
+            self.finished.errback(reason)
+        if not lost and self.transport is not None:
+            self.transport.stopProducing()
+
+    def cancel(self, _=None):
+        self.abort(defer.CancelledError())
+
+
+class DiscardBody(protocol.Protocol):
+    """
+    Drops a response body we don't want, along with its connection
+    """
+
+    def makeConnection(self, transport):
+        transport.stopProducing()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        pass
+
+
+class StatsConnectionPool(HTTPConnectionPool):
+    """
+    Persistent connection pool that counts how its connections are used
+    """
+
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.requests = 0
+        self.new_connections = 0
+        self.idle_evictions = 0
+
+    def getConnection(self, key, endpoint):
+        self.requests += 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        self.new_connections += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def _removeConnection(self, key, connection):
+        # only called once a cached connection stayed idle too long
+        self.idle_evictions += 1
+        return HTTPConnectionPool._removeConnection(self, key, connection)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'hits': max(0, self.requests - self.new_connections),
+            'new_connections': self.new_connections,
+            'idle_evictions': self.idle_evictions,
+            'idle_connections': sum(len(c) for c in self._connections.values()),
+        }
@@ -12,6 +12,13 @@ class InvalidResponseRetry(Exception):
     pass
 
 
+class InvalidResponse(Exception):
+    """
+    When the response can't be a file we keep, so retrying won't help
+    """
+    pass
+
+
 class InvalidAMQPMessage(Exception):
     def __repr__(self):
         return 'The incoming AMQP message has not a valid format.'
@@ -19,4 +26,39 @@ class InvalidAMQPMessage(Exception):
 
 class EncodingError(Exception):
     def __repr__(self):
-        return 'can\'t encode given message.'
\ No newline at end of file
+        return 'can\'t encode given message.'
+
+
+class ResponseTooLarge(Exception):
+    """
+    When the response body grows past `max_file_size`
+    """
+    pass
+
+
+class NotModified(Exception):
+    """
+    When a revalidated response didn't change, `headers` are its cache
+    headers
+    """
+
+    def __init__(self, message, headers=None):
+        super(NotModified, self).__init__(message)
+        self.headers = headers or {}
+
+
+class HostThrottled(Exception):
+    """
+    When the host answers 429 or 503, so we should slow down and retry
+    """
+
+    def __init__(self, message, retry_after=None):
+        super(HostThrottled, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class WriterStopped(Exception):
+    """
+    When a statement is queued on a database writer that was stopped
+    """
+    pass
@@ -0,0 +1,196 @@
+from collections import deque
+
+from twisted.internet import defer
+
+from pygear.logging import log
+from pygear.core.six.moves.urllib.parse import urlparse
+
+
+def get_url_host(url):
+    return urlparse(url).hostname or ''
+
+
+def get_task_host(task):
+    return get_url_host(task['fetch_uri'])
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` takes per second on average, and bursts of `burst`
+    """
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self, now):
+        """
+        Seconds until the next token is available
+        """
+        self._refill(now)
+        if self.tokens >= 1 or not self.rate:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class HostQueue(object):
+    """
+    Per-host politeness stage between the poller and the launcher slots.
+
+    Tasks are queued per host and handed to waiting slots round-robin
+    across the hosts that are ready: having a token in their bucket, not
+    backing off and below the fetcher's per-host cap. Hosts answering with
+    429/503 or timing out are backed off exponentially.
+    """
+
+    MAX_IDLE_HOSTS = 10000
+
+    def __init__(self, rate=10, burst=10, host_depth=2, host_rates=None,
+                 backoff_base=1, backoff_max=300, clock=None, host_busy=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst
+        self.host_depth = host_depth
+        self.host_rates = host_rates or {}
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.host_busy = host_busy or (lambda host: False)
+
+        self.queues = {}
+        self.ring = deque()
+        self.buckets = {}
+        self.backoff = {}
+        self.backoff_until = {}
+        self.waiting = []
+        self.size = 0
+        self._wakeup = None
+
+    def __len__(self):
+        return self.size
+
+    def put(self, task):
+        host = get_task_host(task)
+        queue = self.queues.get(host)
+        if queue is None:
+            if len(self.buckets) > self.MAX_IDLE_HOSTS:
+                self._forget_idle_hosts()
+            queue = self.queues[host] = deque()
+            self.ring.append(host)
+        queue.append(task)
+        self.size += 1
+        self.dispatch()
+
+    def get(self):
+        d = defer.Deferred(canceller=self.waiting.remove)
+        self.waiting.append(d)
+        self.dispatch()
+        return d
+
+    def queued(self):
+        """
+        Number of tasks queued per host
+        """
+        return dict((host, len(queue)) for host, queue in self.queues.items())
+
+    def full_hosts(self):
+        """
+        Hosts it's no use claiming more tasks for right now
+        """
+        now = self.clock.seconds()
+        hosts = set(host for host, queue in self.queues.items() if len(queue) >= self.host_depth)
+        hosts.update(host for host, until in self.backoff_until.items() if until > now)
+        return hosts
+
+    def dispatch(self):
+        now = self.clock.seconds()
+        delay = None
+        checked = 0
+        while self.waiting and self.ring and checked < len(self.ring):
+            host = self.ring.popleft()
+            wait = self._host_delay(host, now)
+            if wait:
+                self.ring.append(host)
+                checked += 1
+                if wait > 0:
+                    delay = wait if delay is None else min(delay, wait)
+                continue
+
+            checked = 0
+            queue = self.queues[host]
+            task = queue.popleft()
+            self.size -= 1
+            if queue:
+                self.ring.append(host)
+            else:
+                del self.queues[host]
+            self.waiting.pop(0).callback(task)
+
+        if self.waiting and self.ring and delay is not None:
+            self._schedule(delay)
+
+    def _host_delay(self, host, now):
+        """
+        0 when `host` may run a task now, seconds to wait otherwise, or -1
+        when it's busy and we can't tell for how long
+        """
+        until = self.backoff_until.get(host)
+        if until is not None:
+            if until > now:
+                return until - now
+            del self.backoff_until[host]
+
+        if self.host_busy(host):
+            return -1
+
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            rate = self.host_rates.get(host, self.rate)
+            bucket = self.buckets[host] = TokenBucket(rate, max(self.burst, rate), now)
+        if bucket.take(now):
+            return 0
+        return bucket.delay(now) or -1
+
+    def _schedule(self, delay):
+        if self._wakeup is not None and self._wakeup.active():
+            if self._wakeup.getTime() <= self.clock.seconds() + delay:
+                return
+            self._wakeup.cancel()
+        self._wakeup = self.clock.callLater(delay, self.dispatch)
+
+    def penalize(self, host, reason='', retry_after=None):
+        """
+        Stop handing out tasks for `host` for an exponentially growing time,
+        or as long as the host asked for in `retry_after`
+        """
+        backoff = min(self.backoff_max, self.backoff.get(host, self.backoff_base / 2.0) * 2)
+        self.backoff[host] = backoff
+        if retry_after is not None:
+            backoff = min(self.backoff_max, max(backoff, retry_after))
+        self.backoff_until[host] = self.clock.seconds() + backoff
+        log.msg("Backing off %s for %ss: %s" % (host, backoff, reason))
+
+    def succeeded(self, host):
+        self.backoff.pop(host, None)
+
+    def _forget_idle_hosts(self):
+        now = self.clock.seconds()
+        for host in list(self.buckets):
+            if host not in self.queues and host not in self.backoff_until:
+                bucket = self.buckets[host]
+                if bucket.delay(now) == 0 and bucket.tokens >= bucket.burst:
+                    del self.buckets[host]
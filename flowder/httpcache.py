@@ -0,0 +1,94 @@
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+# what a job may ask for in its `cache_policy` field
+REVALIDATE = 'revalidate'  # reuse fresh responses, revalidate stale ones
+REFRESH = 'refresh'        # revalidate even fresh responses
+RELOAD = 'reload'          # always download in full
+FOREVER = 'forever'        # reuse any response, never revalidate
+POLICIES = (REVALIDATE, REFRESH, RELOAD, FOREVER)
+
+# response headers the cache keeps or computes freshness from
+CACHE_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Expires', 'Date')
+
+
+def cache_headers(get):
+    """
+    The cache headers of a response, lowercased; `get(name)` returns the
+    raw value of a header or None
+    """
+    headers = {}
+    for name in CACHE_HEADERS:
+        value = get(name)
+        if value:
+            headers[name.lower()] = value
+    return headers
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in (value or '').split(','):
+        name, _, arg = directive.partition('=')
+        if name.strip():
+            directives[name.strip().lower()] = arg.strip().strip('"')
+    return directives
+
+
+def parse_http_date(value):
+    parsed = parsedate_tz(value) if value else None
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+def freshness(headers, default_ttl):
+    """
+    Seconds a response with `headers` stays fresh: from Cache-Control, then
+    Expires, else `default_ttl`
+    """
+    directives = parse_cache_control(headers.get('cache-control'))
+    if 'no-store' in directives or 'no-cache' in directives:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        try:
+            return max(0, int(directives[name]))
+        except (KeyError, ValueError):
+            pass
+    if 'expires' in headers:
+        # an invalid date means already expired
+        expires = parse_http_date(headers['expires'])
+        if expires is None:
+            return 0
+        return max(0, expires - (parse_http_date(headers.get('date')) or time.time()))
+    return default_ttl
+
+
+def cache_entry(headers, default_ttl, previous=None, now=None):
+    """
+    Validators and expiry to keep for a response with `headers`; a 304
+    leaves out the validators that didn't change, those of `previous` stay
+    """
+    previous = previous or {}
+    now = time.time() if now is None else now
+    return {
+        'etag': headers.get('etag') or previous.get('etag'),
+        'last_modified': headers.get('last-modified') or previous.get('last_modified'),
+        'expires': int(now + freshness(headers, default_ttl)),
+    }
+
+
+def is_fresh(entry, now=None):
+    return entry['expires'] > (time.time() if now is None else now)
+
+
+def conditional_headers(entry):
+    """
+    Request headers that turn a fetch of a cached response into a
+    revalidation
+    """
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
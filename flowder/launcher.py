@@ -1,25 +1,34 @@
 import os
 import time
 import signal
+import tempfile
+from collections import deque
 from multiprocessing import cpu_count
 
 from twisted.internet.defer import CancelledError
-from twisted.internet import reactor, defer, threads
+from twisted.internet import reactor, defer, threads, task
 from twisted.application.service import Service, IService, IServiceCollection
 from twisted.web._newclient import ResponseNeverReceived, ResponseFailed
-from twisted.internet.error import TimeoutError, ConnectionRefusedError
+from twisted.internet.error import TimeoutError, ConnectionRefusedError, TCPTimedOutError
 
 from pygear.logging import log
 from pygear.text.encoding import stringify_dict
-from pygear.twisted.reactor import CallLaterOnce
 from pygear.system.magic import get_buffer_extension
-from pygear.core.six.moves.urllib.parse import urlparse
-from pygear.twisted.signal import install_shutdown_handlers, signal_names
+from pygear.core.six.moves.urllib.parse import urljoin
+from pygear.twisted.signal import install_shutdown_handlers, signal_names, get_signal_manager
 
-from .exceptions import NoResponseContent, InvalidResponseRetry
+from .exceptions import NoResponseContent, InvalidResponse, InvalidResponseRetry, ResponseTooLarge, HostThrottled, \
+    NotModified
 from .utils import get_serve_uri
+from .supervisor import get_worker_id, get_workers
+from .concurrency import AIMDController
+from .retry import RetryPolicy
+from .monitor import BlockingCallDetector, get_rss
+from .tracing import Tracer, JSONLinesExporter, SignalExporter
+from .httpcache import POLICIES, RELOAD, REVALIDATE, FOREVER, cache_entry, cache_headers, conditional_headers, \
+    is_fresh
 from .amqp import amqp_message_decode
-from flowder import __version__
+from flowder import __version__, signals
 
 
 class Launcher(Service):
@@ -27,23 +36,44 @@ class Launcher(Service):
     Launching scheduled jobs
     """
     name = 'launcher'
-    VALID_RESPONSE_EXT = ['.png', '.gif', '.jpeg', '.jpg', '.svg']
+    # failures that mean we ask more than the network or the servers can take
+    OVERLOAD_ERRORS = (TimeoutError, TCPTimedOutError, ResponseNeverReceived)
 
     def __init__(self, app, config):
         self.app = app
         self.threads = {}
-        self.finished = []
+        # the last finished jobs, older ones are let go
+        self.finished = deque(maxlen=100)
         self.job_results = {}
         self.task_slots = {}
+        self.started = {}
+        self.waiting = {}
         self.max_proc = self._get_max_proc(config)
+        self.concurrency = self._get_concurrency(config)
+        self.concurrency_interval = config.getfloat('concurrency_interval', 5)
+        self.lag_monitor = BlockingCallDetector(config.getfloat('reactor_block_threshold', 1.0))
+        self.busy_peak = 0
+        self._adjust = None
         self.storage_path = config.get('storage_path', '/tmp')
         self.serve_uri = get_serve_uri(config)
-        self.max_retry = 10
-        self.retry_counter = {}
+        self.retry_policy = RetryPolicy.from_config(config)
+        # failed attempts of the running jobs, kept by the storage
+        self.attempts = {}
+        self.tracing = config.getboolean('tracing', True)
+        self.trace_file = config.get('trace_file', '')
+        self.trace_sample_rate = config.getfloat('trace_sample_rate', 1.0)
+        self.tracer = Tracer()
+        self.traces = {}
         install_shutdown_handlers(self._signal_shutdown)
-        self.all_threads_killed = CallLaterOnce(self._all_threads_killed)
-        self.all_threads_killed.delay = 0
+        self.stopping = False
+        # fired once the jobs cancelled by `stop` stored their result
+        self._drained = None
         self.default_callback_field = config.get('callback_field', 'price_img')
+        self.fetch_mode = config.get('fetch_mode', 'stream')
+        # fetched URLs are reused while fresh, then revalidated; jobs may ask
+        # for another policy in their `cache_policy` field
+        self.cache_policy = config.get('http_cache_policy', REVALIDATE)
+        self.cache_ttl = config.getint('http_cache_ttl', 86400)
 
     def check_storage_path(self):
         if not os.path.exists(self.storage_path):
@@ -63,84 +93,261 @@ class Launcher(Service):
         self.fetcher = app.getServiceNamed('fetcher')
         self.amqp = app.getServiceNamed('amqp')
         self.task_storage = app.getServiceNamed('task_storage')
+        self.blobs = app.getServiceNamed('blob_storage')
+        self.signal_manager = get_signal_manager(self.app)
         self.check_storage_path()
+        self.tracer = self._get_tracer()
 
-        for slot in range(self.max_proc):
+        for slot in range(self.limit):
             self._wait_for_project(slot)
+        self.lag_monitor.start()
+        if not self.concurrency.fixed:
+            self._adjust = task.LoopingCall(self.adjust_concurrency)
+            self._adjust.start(self.concurrency_interval, now=False)
         log.msg(format='Flowder %(version)s started: max_proc=%(max_proc)r',
-                version=__version__, max_proc=self.max_proc, system='Launcher')
+                version=__version__, max_proc=self.limit, system='Launcher')
+
+    def stopService(self):
+        if self._adjust is not None and self._adjust.running:
+            self._adjust.stop()
+        self.lag_monitor.stop()
+        self.tracer.close()
+        return Service.stopService(self)
+
+    def _get_tracer(self):
+        exporters = []
+        if self.tracing:
+            exporters.append(SignalExporter(self.signal_manager))
+            if self.trace_file:
+                exporters.append(JSONLinesExporter(self.trace_file))
+        return Tracer(exporters, self.trace_sample_rate)
+
+    @property
+    def limit(self):
+        """
+        Number of slots in use, slots above it are parked
+        """
+        return self.concurrency.limit
+
+    def adjust_concurrency(self):
+        old = self.limit
+        saturated = self.busy_peak >= old
+        self.busy_peak = len(self.threads)
+        new = self.concurrency.update(saturated, self.lag_monitor.pop_max(), get_rss())
+        if new != old:
+            log.msg(format='Concurrency %(old)s -> %(new)s: %(reason)s', old=old, new=new,
+                    reason=self.concurrency.reason or 'all slots busy', system='Launcher')
+        else:
+            log.debug("Concurrency stays at %s (%s)" % (new, self.concurrency.reason or
+                                                        ('all slots busy' if saturated else 'slots left')))
+        if new > old:
+            for slot in range(old, new):
+                if slot not in self.threads and slot not in self.waiting:
+                    self._wait_for_project(slot)
+        elif new < old:
+            # slots busy with a job are parked once it's done
+            for slot in range(new, old):
+                if slot in self.waiting:
+                    self.waiting.pop(slot).cancel()
 
     def _wait_for_project(self, slot):
-        self.poller.next().addCallback(self._spawn_thread, slot)
+        if slot >= self.limit or self.stopping:
+            return
+        d = self.waiting[slot] = self.poller.next()
+        d.addCallbacks(self._spawn_thread, self._wait_cancelled, callbackArgs=(slot,))
+
+    def _wait_cancelled(self, failure):
+        failure.trap(CancelledError)
 
     def _spawn_thread(self, task_info, slot):
+        self.waiting.pop(slot, None)
         task_info = stringify_dict(task_info, keys_only=False)
         job_id = task_info['job_id']
         self.task_slots[job_id] = slot
         self.run_task(slot, task_info)
 
-    def fetch_if_new(self, result, task_info):
-        job_id = task_info['job_id']
-        if result:
+    def get_cache_policy(self, task_info):
+        policy = amqp_message_decode(task_info['settings']).get('cache_policy') or self.cache_policy
+        if policy not in POLICIES:
+            log.warn("Unknown cache policy %r of job %s, using %s" % (policy, task_info['job_id'], self.cache_policy))
+            return self.cache_policy
+        return policy
+
+    def check_cache(self, url, policy):
+        """
+        The cached response of `url`, or None when it has to be fetched in full
+        """
+        if policy == RELOAD:
+            return defer.succeed(None)
+        d = self.task_storage.get_http_cache(url)
+        d.addCallback(self._check_fetched_before, url)
+        return d
+
+    def _check_fetched_before(self, entry, url):
+        if entry is not None:
+            return entry
+        # fetched before the cache kept responses, or by another job meanwhile
+        d = self.poller.check_url_already_fetched(url)
+        d.addCallback(self._cache_fetched, url)
+        return d
+
+    def _cache_fetched(self, result, url):
+        if not result:
+            return None
+        # no validators, fresh for `http_cache_ttl` then fetched in full
+        entry = {'result_url': result['result_url'], 'etag': None, 'last_modified': None,
+                 'expires': int(time.time() + self.cache_ttl)}
+        self._set_cache(url, **entry)
+        return entry
+
+    def _set_cache(self, url, result_url, **entry):
+        d = self.task_storage.set_http_cache(url, result_url, **entry)
+        d.addErrback(lambda f: log.err("Caching the response of %s failed: %s" % (url, f.getErrorMessage())))
+        return d
+
+    def fetch_if_new(self, entry, task_info, policy=REVALIDATE):
+        job_id, url = task_info['job_id'], task_info['fetch_uri']
+        trace = self.traces[job_id]
+        if entry and (policy == FOREVER or policy == REVALIDATE and is_fresh(entry)):
             log.debug("Task Result already exists: %s" % job_id)
-            file_name = result['result_url']
-            self.task_storage.set_jobid_result_url(job_id, file_name)
-            dfd = defer.maybeDeferred(self.publish_result, file_name, task_info)
+            return self.reuse_result(entry['result_url'], task_info)
+
+        # a stale response is only downloaded again when it changed
+        headers = conditional_headers(entry) if entry else {}
+        if self.fetch_mode == 'stream':
+            # body is written to disk as it arrives
+            dfd = defer.maybeDeferred(trace.wrap('fetch', self.fetcher.fetch_to_file), url, headers)
+            dfd.addCallback(self._fetched, url, time.time(), lambda download: download[3])
+            dfd.addCallback(trace.wrap('save_file', self.save_file_download), job_id, url)
+            dfd.addCallback(trace.wrap('publish_result', self.publish_result), task_info)
         else:
-            dfd = defer.maybeDeferred(self.fetcher.fetch, task_info['fetch_uri'])
+            response_headers = {}
+            dfd = defer.maybeDeferred(trace.wrap('fetch', self.fetcher.fetch), url, headers)
+            dfd.addCallback(self._fetched, url, time.time(), lambda response: len(response.body))
+            dfd.addCallback(self._keep_cache_headers, response_headers)
 
             # get file response body
-            dfd.addCallbacks(self.parse_response, self.failed,
-                             callbackArgs=(job_id,), errbackArgs=(job_id,))
+            dfd.addCallback(trace.wrap('parse_response', self.parse_response), job_id)
 
             # Save File
-            dfd.addCallbacks(self.save_file_content, self.failed,
-                             callbackArgs=(job_id,), errbackArgs=(job_id,))
+            dfd.addCallback(trace.wrap('save_file', self.save_file_content), job_id, url, response_headers)
 
             # Callback to URI
-            dfd.addCallbacks(self.publish_result, self.failed,
-                             callbackArgs=(task_info,), errbackArgs=(job_id,))
+            dfd.addCallback(trace.wrap('publish_result', self.publish_result), task_info)
+        if headers:
+            dfd.addErrback(self._not_modified, entry, task_info)
+        # failures are handled once by run_task
+        return dfd
+
+    def reuse_result(self, file_name, task_info):
+        """
+        Publish the stored `file_name` as the result of the task
+        """
+        job_id = task_info['job_id']
+        trace = self.traces[job_id]
+        self.blobs.reference(file_name)
+        trace.track('set_jobid_result_url',
+                    self.task_storage.set_jobid_result_url(job_id, file_name, task_info['fetch_uri']))
+        return defer.maybeDeferred(trace.wrap('publish_result', self.publish_result), file_name, task_info)
+
+    def _not_modified(self, failure, entry, task_info):
+        failure.trap(NotModified)
+        log.debug("%s, reusing %s: %s" % (failure.getErrorMessage(), entry['result_url'], task_info['job_id']))
+        self._set_cache(task_info['fetch_uri'], entry['result_url'],
+                        **cache_entry(failure.value.headers, self.cache_ttl, entry))
+        return self.reuse_result(entry['result_url'], task_info)
+
+    def _keep_cache_headers(self, response, headers):
+        headers.update(cache_headers(response.headers.get))
+        return response
+
+    def _fetched(self, result, url, started, get_size):
+        elapsed = time.time() - started
+        self.concurrency.observe(elapsed)
+        self.signal_manager.send_catch_log(signal=signals.fetch_finished, url=url,
+                                           elapsed=elapsed, size=get_size(result))
+        return result
 
     def run_task(self, slot, task_info):
         job_id = task_info['job_id']
+        self.started[job_id] = time.time()
+        self.attempts[job_id] = int(task_info.get('attempts') or 0)
+        trace = self.traces[job_id] = self.tracer.start(job_id)
 
         log.debug("Running task: %s" % task_info)
-        self.poller.set_task_running(job_id)
+        trace.track('set_task_running', self.poller.set_task_running(job_id))
 
-        dfd = self.poller.check_url_already_fetched(task_info['fetch_uri'])
+        policy = self.get_cache_policy(task_info)
+        dfd = trace.track('check_cache', self.check_cache(task_info['fetch_uri'], policy))
         self.threads[slot] = dfd
-        dfd.addCallback(self.fetch_if_new, task_info)
+        self.busy_peak = max(self.busy_peak, len(self.threads))
+        dfd.addCallback(self.fetch_if_new, task_info, policy)
+        dfd.addCallbacks(self._host_succeeded, self._host_failed,
+                         callbackArgs=(task_info,), errbackArgs=(task_info,))
         dfd.addErrback(self.failed, job_id)
 
         dfd.addBoth(self._thread_finished, job_id)
 
+    def _host_succeeded(self, result, task_info):
+        self.poller.host_succeeded(task_info['fetch_uri'])
+        return result
+
+    def _host_failed(self, failure, task_info):
+        if failure.check(*self.OVERLOAD_ERRORS):
+            self.concurrency.error()
+        if failure.check(HostThrottled):
+            self.poller.host_throttled(task_info['fetch_uri'], failure.getErrorMessage(),
+                                       failure.value.retry_after)
+        elif failure.check(TimeoutError):
+            self.poller.host_throttled(task_info['fetch_uri'], "request timed out")
+        return failure
+
     def publish_result(self, file_name, task_info):
         # Build result message to be published on AMQP
         message = dict()
         settings = amqp_message_decode(task_info['settings'])
         message['settings'] = settings
         message['timestamp'] = time.time()
-        message['file_uri'] = urlparse.urljoin(self.serve_uri, file_name)
-        self.amqp.publish(message)
+        message['file_uri'] = urljoin(self.serve_uri, file_name)
+        return self.amqp.publish(message)
 
-    def save_file_content(self, content, job_id):
+    def save_file_content(self, content, job_id, fetch_uri=None, headers=None):
         # @TODO add new service to call periodically failed requests
         # to the callback_uri
         if not content:
             raise NoResponseContent("Response has no body!")
         ext = get_buffer_extension(content)
-        if ext not in self.VALID_RESPONSE_EXT:
-            raise InvalidResponseRetry("Invalid content type, retry!")
+        if ext.lstrip('.') not in self.fetcher.valid_extensions:
+            raise InvalidResponse("Invalid content type!")
 
-        file_name = '{name}{ext}'.format(name=job_id, ext=ext)
-        log.debug("Save file: %s" % file_name)
-
-        save_path = os.path.join(self.storage_path, file_name)
-        with open(save_path, 'wb+') as file:
+        fd, tmp_path = tempfile.mkstemp(dir=self.storage_path, suffix='.part')
+        with os.fdopen(fd, 'wb') as file:
             file.write(content)
+        digest = self.blobs.new_hash()
+        digest.update(content)
+        return self.save_file_download((tmp_path, ext, digest.hexdigest(), len(content), headers), job_id,
+                                       fetch_uri)
+
+    def save_file_download(self, download, job_id, fetch_uri=None):
+        """
+        Store a downloaded file; `download` may end with the cache headers
+        of its response, to keep it in the HTTP cache of `fetch_uri`
+        """
+        tmp_path, ext, digest, size = download[:4]
+        headers = download[4] if len(download) > 4 else None
+        dfd = self.blobs.store(tmp_path, digest, ext)
+        dfd.addCallback(self._file_saved, job_id, fetch_uri, headers)
+        return dfd
+
+    def _file_saved(self, file_name, job_id, fetch_uri, headers=None):
+        log.debug("Save file: %s" % file_name)
 
         # Save jobID result URL
-        self.task_storage.set_jobid_result_url(job_id, file_name)
+        d = self.task_storage.set_jobid_result_url(job_id, file_name, fetch_uri)
+        if job_id in self.traces:
+            self.traces[job_id].track('set_jobid_result_url', d)
+        if fetch_uri is not None and headers is not None:
+            self._set_cache(fetch_uri, file_name, **cache_entry(headers, self.cache_ttl))
         return file_name
 
     def parse_response(self, response, job_id):
@@ -149,30 +356,30 @@ class Launcher(Service):
         return response.body
 
     def job_failed(self, message, job_id):
-        self.job_results[job_id] = ('FAILED', message)
+        self.job_results[job_id] = ('FAILED', message, None)
         log.err(message)
 
-    def job_failed_retry(self, message, job_id):
-        # TODO add retry max number to prevent dogpile effect
-        self.job_results[job_id] = ('RETRY', message)
-
-        if job_id not in self.retry_counter:
-            self.retry_counter[job_id] = 0
-        else:
-            self.retry_counter[job_id] += 1
-
-        log.err(message)
+    def job_failed_retry(self, message, job_id, failure_class='default', retry_after=None):
+        attempts = self.attempts.get(job_id, 0) + 1
+        if self.retry_policy.exhausted(attempts):
+            return self.job_failed("Max retry has been reached! job id: %s!" % job_id, job_id)
+        delay = self.retry_policy.delay(failure_class, attempts, retry_after)
+        self.job_results[job_id] = ('RETRY', message, delay)
+        log.err("%s (attempt %s, next in %.0fs)" % (message, attempts, delay))
 
     def failed(self, failure, job_id):
-        if failure.check(CancelledError):
+        if failure.check(CancelledError, ResponseTooLarge):
             self.job_failed("Response max size exceeded! job id: %s!" % job_id, job_id)
 
+        elif failure.check(InvalidResponse, NotModified):
+            self.job_failed("%s job id: %s!" % (failure.getErrorMessage(), job_id), job_id)
+
         elif failure.check(InvalidResponseRetry):
-            ex = failure.value
-            if job_id in self.retry_counter and self.retry_counter[job_id] == self.max_retry:
-                self.job_failed("Max retry has been reached! job id: %s!" % job_id, job_id)
-            else:
-                self.job_failed_retry(ex.message, job_id)
+            self.job_failed_retry(failure.value.message, job_id, 'invalid')
+
+        elif failure.check(HostThrottled):
+            self.job_failed_retry("%s, retry .... %s!" % (failure.getErrorMessage(), job_id), job_id,
+                                  'throttled', failure.value.retry_after)
 
         elif failure.check(ResponseNeverReceived):
             self.job_failed("No response from the server! job id: %s!" % job_id, job_id)
@@ -185,15 +392,10 @@ class Launcher(Service):
             self.job_failed("Response has no content .... %s!" % job_id, job_id)
 
         elif failure.check(TimeoutError):
-            if job_id in self.retry_counter and self.retry_counter[job_id] == self.max_retry:
-                self.job_failed("Max retry has been reached! job id: %s!" % job_id, job_id)
-            else:
-                self.job_failed_retry("Request timeout .... %s!" % job_id, job_id)
+            self.job_failed_retry("Request timeout .... %s!" % job_id, job_id, 'timeout')
+
         elif failure.check(ConnectionRefusedError):
-            if job_id in self.retry_counter and self.retry_counter[job_id] == self.max_retry:
-                self.job_failed("Max retry has been reached! job id: %s!" % job_id, job_id)
-            else:
-                self.job_failed_retry("Connection refused .... %s!" % job_id, job_id)
+            self.job_failed_retry("Connection refused .... %s!" % job_id, job_id, 'refused')
 
         else:
             ex = failure.value
@@ -201,7 +403,7 @@ class Launcher(Service):
             failure.printTraceback()
 
     def _thread_finished(self, _, job_id):
-        slot = self.task_slots[job_id]
+        slot = self.task_slots.pop(job_id)
         """
         When a Crawl process finishes her job,
         :param _:
@@ -213,23 +415,32 @@ class Launcher(Service):
         def _do_cleanup(_, slot):
             thread = self.threads.pop(slot)
             self.finished.append(thread)
+            self.tracer.finish(self.traces.pop(job_id), result=result)
+            if self._drained is not None and not self.threads:
+                self._drained.callback(None)
             # In case of shutdown
             self._wait_for_project(slot)  # add another
 
-        if job_id in self.job_results.keys():
-            result_type, result_message = self.job_results.pop(job_id)
+        result = 'success'
+        self.attempts.pop(job_id, None)
+        if job_id in self.job_results:
+            result_type, result_message, delay = self.job_results.pop(job_id)
 
             if result_type == 'FAILED':
+                result = 'failed'
                 d = defer.maybeDeferred(self.poller.set_task_failed, job_id, result_message)
-                if job_id in self.retry_counter:
-                    del self.retry_counter[job_id]
 
             elif result_type == 'RETRY':
-                d = defer.maybeDeferred(self.poller.set_task_retry, job_id, result_message)
-            del self.job_results[job_id]
+                result = 'retry'
+                d = defer.maybeDeferred(self.poller.set_task_retry, job_id, result_message, delay)
         else:
             d = defer.maybeDeferred(self.poller.set_task_succesfull, job_id, 'task finished successfully!')
 
+        elapsed = time.time() - self.started.pop(job_id)
+        self.signal_manager.send_catch_log(signal=signals.job_finished, job_id=job_id, result=result,
+                                           elapsed=elapsed)
+
+        self.traces[job_id].track('set_task_result', d)
         d.addBoth(_do_cleanup, slot)
 
 
@@ -241,7 +452,27 @@ class Launcher(Service):
             except NotImplementedError:
                 cpus = 1
             max_proc = cpus * config.getint('max_proc_per_cpu', 4)
-        return max_proc
+        return self._per_worker(max_proc, config)
+
+    def _get_concurrency(self, config):
+        if not config.getboolean('adaptive_concurrency', False):
+            return AIMDController(self.max_proc, self.max_proc, self.max_proc)
+        max_limit = config.getint('concurrency_max', 0) or self.max_proc * 4
+        return AIMDController(self.max_proc,
+                              min_limit=self._per_worker(config.getint('concurrency_min', 1), config),
+                              max_limit=self._per_worker(max_limit, config),
+                              latency_tolerance=config.getfloat('concurrency_latency_tolerance', 2),
+                              max_error_rate=config.getfloat('concurrency_max_error_rate', 0.1),
+                              max_lag=config.getfloat('max_reactor_lag', 0.5),
+                              max_rss=config.getint('max_rss', 0) * 1024 * 1024)
+
+    @staticmethod
+    def _per_worker(slots, config):
+        if get_worker_id() is not None:
+            # slots are shared out between the worker processes
+            workers = get_workers(config)
+            slots = max(1, (slots + workers - 1) // workers)
+        return slots
 
     def _signal_shutdown(self, signum, _):
         install_shutdown_handlers(self._signal_kill)
@@ -257,20 +488,28 @@ class Launcher(Service):
                 level=log.INFO, signame=signame)
         reactor.callFromThread(self._stop_reactor)
 
-    def all_services_stoped(self, result):
-        for dfd in self.threads.values():
+    def stop(self):
+        """
+        Cancel the running jobs and wait for their results to be stored,
+        then give the claimed tasks back and stop the services, the
+        storage writer with them
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        for dfd in list(self.waiting.values()):
+            dfd.cancel()
+        self._drained = defer.Deferred()
+        if not self.threads:
+            self._drained.callback(None)
+        for dfd in list(self.threads.values()):
             dfd.cancel()
-        self.all_threads_killed.schedule()
+        self._drained.addCallback(self.all_threads_killed)
 
-    def stop(self):
-        self.poller.reset_all_tasks()
+    def all_threads_killed(self, _):
+        self.poller.release_tasks()
         d = IService(self.app).stopService()
-        d.addCallback(self.all_services_stoped)
-
-    def _all_threads_killed(self):
-        if self.threads:
-            return self.all_threads_killed.schedule()
-        reactor.stop()
+        d.addBoth(self._stop_reactor)
 
     @staticmethod
     def _stop_reactor(_=None):
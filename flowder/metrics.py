@@ -0,0 +1,166 @@
+"""
+Minimal metrics in the Prometheus text exposition format
+"""
+from bisect import bisect_left
+
+
+# seconds, from a cached lookup to a slow download
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                             for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+    return repr(value)
+
+
+class Metric(object):
+    """
+    Base of the metric types. Values are updated as events happen, or by
+    `collect` at render time: it returns the current value, or a dict of
+    label values tuple -> value.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._children = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError("%s needs labels %s" % (self.name, ', '.join(self.labelnames)))
+        return self.labels()
+
+    def _render_child(self, values, child):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, values), _format_value(child.value))]
+
+    def render(self):
+        if self.collect is not None:
+            values = self.collect()
+            if not isinstance(values, dict):
+                values = {(): values}
+            for labels, value in values.items():
+                self.labels(*labels).set(value)
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    type = 'counter'
+    _new_child = _Value
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+    _new_child = _Value
+
+    def set(self, value):
+        self._default().set(value)
+
+
+class _HistogramValue(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        buckets = [(_format_value(float(bound)), count) for bound, count in zip(child.buckets, child.counts)]
+        # everything above the last bound only shows up in the total count
+        buckets.append(('+Inf', child.count - sum(child.counts)))
+        for le, count in buckets:
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, [('le', le)])
+            lines.append('%s_bucket%s %s' % (self.name, labels, cumulative))
+        lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labelnames, values), _format_value(child.sum)))
+        lines.append('%s_count%s %s' % (self.name, _format_labels(self.labelnames, values), child.count))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), collect=None):
+        return self.register(Counter(name, documentation, labelnames, collect))
+
+    def gauge(self, name, documentation, labelnames=(), collect=None):
+        return self.register(Gauge(name, documentation, labelnames, collect))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
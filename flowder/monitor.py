@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import resource
+import threading
+import traceback
+
+from twisted.internet import reactor
+
+from pygear.logging import log
+
+
+def get_rss():
+    """
+    Resident memory of this process in bytes
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        # peak instead of current outside of Linux, in KB there
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ReactorLagMonitor(object):
+    """
+    Measures how late the reactor runs a call scheduled every `interval`
+    seconds, which is how long callbacks and I/O keep it busy.
+    """
+
+    def __init__(self, interval=0.1, clock=reactor):
+        self.interval = interval
+        self.clock = clock
+        self.lag = 0
+        self.max_lag = 0
+        self._expected = None
+        self._call = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def pop_max(self):
+        """
+        Largest lag since the last call
+        """
+        max_lag, self.max_lag = self.max_lag, self.lag
+        return max_lag
+
+    def _schedule(self):
+        self._expected = self.clock.seconds() + self.interval
+        self._call = self.clock.callLater(self.interval, self._tick)
+
+    def _tick(self):
+        self.lag = max(0, self.clock.seconds() - self._expected)
+        self.max_lag = max(self.max_lag, self.lag)
+        self._schedule()
+
+
+class BlockingCallDetector(ReactorLagMonitor):
+    """
+    Lag monitor that also tells where the reactor is stuck: a thread
+    watches its ticks and, once one is `threshold` seconds late, takes the
+    stack of the reactor thread. It's logged with how long the reactor was
+    blocked when it gets back to the tick.
+    """
+
+    def __init__(self, threshold=1.0, interval=0.1, clock=reactor):
+        ReactorLagMonitor.__init__(self, interval, clock)
+        self.threshold = threshold
+        # reactor blocks seen
+        self.blocked = 0
+        self._beat = None
+        self._stack = None
+        self._reactor_thread = None
+        self._stopped = None
+        self._watcher = None
+
+    def start(self):
+        ReactorLagMonitor.start(self)
+        self._beat = time.time()
+        if not self.threshold:
+            return
+        self._reactor_thread = threading.current_thread().ident
+        self._stopped = threading.Event()
+        self._watcher = threading.Thread(target=self._watch, args=(self._stopped,), name='flowder-reactor-watchdog')
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def stop(self):
+        ReactorLagMonitor.stop(self)
+        if self._stopped is not None:
+            # wakes the watcher up right away
+            self._stopped.set()
+            self._watcher.join()
+            self._stopped = self._watcher = None
+
+    def _tick(self):
+        ReactorLagMonitor._tick(self)
+        now = time.time()
+        blocked = now - self._beat - self.interval
+        stack, self._stack = self._stack, None
+        # a stack taken just as this tick came is stale
+        if stack is not None and blocked >= self.threshold:
+            self.blocked += 1
+            log.msg("Reactor blocked for %.3fs in:\n%s" % (blocked, stack))
+        self._beat = now
+
+    def _watch(self, stopped):
+        reported = None
+        while not stopped.wait(self.interval):
+            beat = self._beat
+            if beat == reported or time.time() - beat < self.interval + self.threshold:
+                continue
+            frame = sys._current_frames().get(self._reactor_thread)
+            if frame is not None:
+                self._stack = ''.join(traceback.format_stack(frame))
+            reported = beat
@@ -0,0 +1,126 @@
+import time
+
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.internet.error import DNSLookupError
+from twisted.internet.interfaces import IResolverSimple
+from twisted.names import client, dns
+from twisted.python import failure
+
+from pygear.logging import log
+
+from flowder.cache import LRUCache
+from flowder.utils import ip_re
+
+
+class DNSEntry(object):
+    __slots__ = ('address', 'error', 'expires', 'used')
+
+    def __init__(self, address, error, expires, used):
+        self.address = address
+        self.error = error
+        self.expires = expires
+        self.used = used
+
+
+@implementer(IResolverSimple)
+class CachingResolver(object):
+    """
+    `IResolverSimple` keeping answers for their DNS TTL, bounded by
+    `min_ttl` and `max_ttl`. Lookups of a name already being resolved wait
+    for the same query, and failures are kept for `negative_ttl` seconds.
+
+    `refresh` resolves again the names used since the last refresh that
+    expire before the next one, so hot names are never looked up on the
+    request path.
+    """
+
+    def __init__(self, resolver=None, maxsize=10000, min_ttl=30, max_ttl=3600, negative_ttl=30,
+                 refresh_interval=10, clock=time.time):
+        self.resolver = resolver
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.entries = LRUCache(maxsize)
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self._last_refresh = clock()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+    def getHostByName(self, name, timeout=None):
+        if ip_re.match(name):
+            return defer.succeed(name)
+        now = self.clock()
+        entry = self.entries.get(name)
+        if entry is not None and entry.expires > now:
+            self.hits += 1
+            entry.used = now
+            if entry.error is not None:
+                return defer.fail(entry.error)
+            return defer.succeed(entry.address)
+        self.misses += 1
+        return self._resolve(name, timeout)
+
+    def cached(self, name):
+        """
+        Address of `name` if it's cached and still valid, else None
+        """
+        if ip_re.match(name):
+            return name
+        entry = self.entries.get(name)
+        if entry is not None and entry.expires > self.clock() and entry.error is None:
+            return entry.address
+
+    def refresh(self):
+        now = self.clock()
+        horizon = now + self.refresh_interval
+        names = [name for name, entry in self.entries.items()
+                 if entry.used >= self._last_refresh and entry.expires <= horizon and entry.error is None]
+        self._last_refresh = now
+        for name in names:
+            if name not in self.pending:
+                self._resolve(name).addErrback(lambda _: None)
+        return len(names)
+
+    def _resolve(self, name, timeout=None):
+        d = defer.Deferred()
+        waiters = self.pending.get(name)
+        if waiters is not None:
+            waiters.append(d)
+            return d
+        self.pending[name] = [d]
+        if self.resolver is None:
+            self.resolver = client.createResolver()
+        args = (name,) if timeout is None else (name, timeout)
+        query = self.resolver.lookupAddress(*args)
+        query.addCallbacks(self._answered, self._failed, (name,), errbackArgs=(name,))
+        return d
+
+    def _answered(self, result, name):
+        answers = result[0]
+        records = [record for record in answers if record.type == dns.A]
+        if not records:
+            return self._failed(failure.Failure(DNSLookupError(name)), name)
+        ttl = min(max(min(record.ttl for record in records), self.min_ttl), self.max_ttl)
+        address = records[0].payload.dottedQuad()
+        for d in self._store(name, DNSEntry(address, None, self.clock() + ttl, self.clock())):
+            d.callback(address)
+
+    def _failed(self, reason, name):
+        if not reason.check(DNSLookupError):
+            reason = failure.Failure(DNSLookupError("%s: %s" % (name, reason.getErrorMessage())))
+        log.debug("Resolving %s failed: %s" % (name, reason.getErrorMessage()))
+        for d in self._store(name, DNSEntry(None, reason, self.clock() + self.negative_ttl, self.clock())):
+            d.errback(reason)
+
+    def _store(self, name, entry):
+        old = self.entries.get(name)
+        if old is not None:
+            entry.used = old.used
+        self.entries.set(name, entry)
+        return self.pending.pop(name, [])
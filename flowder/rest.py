@@ -1,9 +1,16 @@
+import json
 import uuid
 
+from twisted.internet import defer
+from twisted.web import server
+
+from pygear.logging import log
+from pygear.core.six import string_types
 from pygear.twisted.resource import WsResource
 from pygear.twisted.signal import get_signal_manager
 
 from flowder import signals
+from flowder.amqp import amqp_message_encode
 
 
 class Schedule(WsResource):
@@ -21,24 +28,109 @@ class Schedule(WsResource):
 
         task_info = dict((k, v[0]) for k, v in txrequest.args.items())
         try:
-            if 'callback_uri' not in task_info:
-                raise ValueError('Given message has no callback_uri value.')
-
-            if 'fetch_uri' not in task_info:
-                raise ValueError('Given message has no fetch_uri value.')
-
+            # the other fields are sent back with the result, as for AMQP messages
+            task_info = ScheduleBulk.make_task(task_info, txrequest.getClientIP())
         except ValueError as e:
             return {"status": "error", "message": e.message}
-        task_info['fetch_uri'] = task_info['fetch_uri'].replace(' ', '+')
-        task_info['client_uri'] = txrequest.getClientIP()
-        jobid = uuid.uuid1().hex
-        task_info['job_id'] = jobid
+        jobid = task_info['job_id']
         self.root.scheduler.schedule(task_info)
         signal_manager = get_signal_manager(self.root.app)
-        signal_manager.send_catch_log(signal=signals.request_received, jobid=jobid)
+        signal_manager.send_catch_log(signal=signals.request_received, jobid=jobid, source='rest')
         return {"node_name": self.root.nodename, "status": "ok", "job_id": jobid}
 
 
+class ScheduleBulk(WsResource):
+    """
+    Schedule many tasks at once, from a JSON array or one JSON object per
+    line (NDJSON). Every task needs `fetch_uri` and `callback_uri`; its
+    other fields are sent back with the result, as for AMQP messages.
+    """
+
+    def render(self, txrequest):
+        # POST writes its response itself, once the tasks are stored
+        if txrequest.method == 'POST':
+            return self.render_POST(txrequest)
+        return WsResource.render(self, txrequest)
+
+    def render_POST(self, txrequest):
+        d = defer.maybeDeferred(self.schedule, txrequest)
+        d.addErrback(self.schedule_failed)
+        d.addCallback(self.write_response, txrequest)
+        return server.NOT_DONE_YET
+
+    @defer.inlineCallbacks
+    def schedule(self, txrequest):
+        if not self.root.request_permitted(txrequest):
+            defer.returnValue({
+                "node_name": self.root.nodename,
+                "status": "error",
+                "message": "Request not permitted, your ip address will be logged!"
+            })
+
+        try:
+            items = self.parse_body(txrequest.content.read())
+        except ValueError as e:
+            defer.returnValue({"status": "error", "message": "Invalid JSON body: %s" % e})
+
+        client_uri = txrequest.getClientIP()
+        tasks, job_ids, errors = [], [], []
+        for index, item in enumerate(items):
+            try:
+                tasks.append(self.make_task(item, client_uri))
+            except ValueError as e:
+                job_ids.append(None)
+                errors.append({"index": index, "message": str(e)})
+            else:
+                job_ids.append(tasks[-1]['job_id'])
+
+        if tasks:
+            signal_manager = get_signal_manager(self.root.app)
+            signal_manager.send_catch_log(signal=signals.request_received, jobid=None, source='rest',
+                                          count=len(tasks))
+            yield self.root.scheduler.schedule_many(tasks)
+        defer.returnValue({"node_name": self.root.nodename, "status": "ok" if not errors else "partial",
+                           "job_ids": job_ids, "errors": errors})
+
+    def schedule_failed(self, failure):
+        log.err("Scheduling tasks failed: %s" % failure.getErrorMessage())
+        return {"node_name": self.root.nodename, "status": "error",
+                "message": "Scheduling tasks failed: %s" % failure.getErrorMessage()}
+
+    @staticmethod
+    def write_response(result, txrequest):
+        if txrequest._disconnected:
+            # the client went away meanwhile
+            return
+        txrequest.setHeader('Content-Type', 'application/json')
+        txrequest.write(json.dumps(result) + "\n")
+        txrequest.finish()
+
+    @staticmethod
+    def parse_body(body):
+        body = body.strip()
+        if body.startswith('['):
+            return json.loads(body)
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+    @staticmethod
+    def make_task(item, client_uri):
+        if not isinstance(item, dict):
+            raise ValueError('Task is not a JSON object.')
+        if 'callback_uri' not in item:
+            raise ValueError('Given message has no callback_uri value.')
+        if not isinstance(item.get('fetch_uri'), string_types):
+            raise ValueError('Given message has no fetch_uri value.')
+
+        settings = dict(item)
+        fetch_uri = settings.pop('fetch_uri').replace(' ', '+')
+        settings['client_uri'] = client_uri
+        return {
+            'job_id': uuid.uuid1().hex,
+            'fetch_uri': fetch_uri,
+            'settings': amqp_message_encode(settings),
+        }
+
+
 class Cancel(WsResource):
     def render_POST(self, txrequest):
         pass
@@ -0,0 +1,51 @@
+import random
+
+# first retry delay in seconds per failure class, doubled on every attempt
+RETRY_DELAYS = {
+    'timeout': 30,
+    'refused': 60,
+    'throttled': 60,
+    'invalid': 10,
+    'default': 30,
+}
+
+
+class RetryPolicy(object):
+    """
+    Delay before the next attempt of a failed task.
+
+    The delay of a failure class starts at its base and doubles with each
+    attempt up to `max_delay`. With `jitter` at 0.5 it's then drawn between
+    half and all of that, so tasks that failed together (a whole host going
+    down) come back spread out instead of all at once.
+    """
+
+    def __init__(self, delays=None, max_delay=3600, max_attempts=10, jitter=0.5, factor=2):
+        self.delays = dict(RETRY_DELAYS)
+        self.delays.update(delays or {})
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.jitter = jitter
+        self.factor = factor
+
+    @classmethod
+    def from_config(cls, config):
+        delays = dict((failure, float(delay)) for failure, delay in config.items('retry_delays', ()))
+        return cls(delays,
+                   max_delay=config.getint('retry_max_delay', 3600),
+                   max_attempts=config.getint('retry_max_attempts', 10),
+                   jitter=config.getfloat('retry_jitter', 0.5))
+
+    def exhausted(self, attempts):
+        return attempts >= self.max_attempts
+
+    def delay(self, failure, attempts, retry_after=None):
+        """
+        Seconds to wait after the `attempts`-th failed attempt (from 1)
+        """
+        base = self.delays.get(failure, self.delays['default'])
+        delay = min(self.max_delay, base * self.factor ** max(0, attempts - 1))
+        delay *= 1 - self.jitter * random.random()
+        if retry_after:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
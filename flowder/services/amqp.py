@@ -1,6 +1,7 @@
 import time
 import uuid
 import threading
+from collections import deque, OrderedDict
 
 from twisted.application import service
 from twisted.internet import defer, reactor, protocol, task
@@ -11,8 +12,10 @@ from pika.adapters import twisted_connection
 from pika.connection import ConnectionParameters
 from pika import credentials as pika_credentials, BasicProperties
 from pika.exceptions import AMQPError, ChannelClosed, ConnectionClosed
+from pika.spec import Basic
 
 from pygear.logging import log
+from pygear.twisted.reactor import CallLaterOnce
 from pygear.twisted.signal import get_signal_manager
 
 from flowder import signals
@@ -52,11 +55,40 @@ class AmqpService(service.Service):
 
         self._lock = threading.Lock()
         self._in_retry = dict()
-        self._cached_messages = []
         self.conn_retry_interval = 0
 
+        self._queue_obj = None
+        self._reading = False
+        self._backlog_checker = None
+        self._paused = False
+        self._unacked = 0
+        self._last_delivery_tag = None
+        self._ack_channel = None
+        # [channel, delivery tag, settled, stored] of the messages not acked
+        # yet, in delivery order: acks only cover the stored prefix
+        self._deliveries = deque()
+        self._ack_timer = CallLaterOnce(self.flush_acks)
+
+        # outgoing results: persisted in the outbox, sent with publisher
+        # confirms and removed from the outbox once the broker has them
+        self._batch = []
+        self._batch_timer = CallLaterOnce(self.flush_batch)
+        self._outbox = OrderedDict()
+        self._unsent = deque()
+        self._inflight = OrderedDict()
+        self._publish_seq = 0
+        self._publish_channel = None
+
         self.app_id = settings.get('app_id', 'fw0')
-        self.consume_interval = settings.getint("consume_interval", 2, section='amqp')
+        self.prefetch_count = settings.getint("prefetch_count", 100, section='amqp')
+        self.ack_batch_size = settings.getint("ack_batch_size", 50, section='amqp')
+        self._ack_timer.delay = settings.getint("ack_interval", 200, section='amqp') / 1000.0
+        self.backlog_high = settings.getint("backlog_high", 5000, section='amqp')
+        self.backlog_low = settings.getint("backlog_low", 1000, section='amqp')
+        self.backlog_check_interval = settings.getfloat("backlog_check_interval", 1, section='amqp')
+        self.publish_window = settings.getint("publish_window", 1000, section='amqp')
+        self.publish_batch_size = settings.getint("publish_batch_size", 100, section='amqp')
+        self._batch_timer.delay = settings.getint("publish_batch_interval", 0, section='amqp') / 1000.0
         self.exchange_name = settings.get("exchange_name", 'flowder-ex', section='amqp')
         self.queue_in_name = settings.get("queue_in_name", 'flowder-in-queue', section='amqp')
         self.queue_in_routing_key = settings.get("queue_in_routing_key", 'flowder.in', section='amqp')
@@ -67,6 +99,10 @@ class AmqpService(service.Service):
     def scheduler(self):
         return self.IApp.getServiceNamed('scheduler')
 
+    @property
+    def task_storage(self):
+        return self.IApp.getServiceNamed('task_storage')
+
     def startService(self):
         params = {}
         if self.settings.get("username", None, section='amqp') \
@@ -88,6 +124,9 @@ class AmqpService(service.Service):
             twisted_connection.TwistedProtocolConnection,
             parameters)
 
+        d = self.task_storage.outbox_pending()
+        d.addCallback(self._restore_outbox)
+        d.addErrback(lambda f: log.err("Loading the AMQP outbox failed: %s" % f.getErrorMessage()))
         self.do_connect()
 
     def do_connect(self):
@@ -157,7 +196,8 @@ class AmqpService(service.Service):
             queue=self.queue_out_name,
             routing_key=self.queue_out_routing_key)
 
-        yield self._channel.basic_qos(prefetch_count=1)
+        yield self._channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.start_publishing(self._channel)
 
         self._running = True
 
@@ -166,47 +206,244 @@ class AmqpService(service.Service):
 
         # Consume queue_in queue
         queue_obj, consumer_tag = yield self._channel.basic_consume(queue=self.queue_in_name, no_ack=False)
-        l = task.LoopingCall(self.read, queue_obj)
-        l.start(0.01)
+        self.start_consuming(queue_obj)
+
+    def start_consuming(self, queue_obj):
+        # delivery tags of the previous channel are meaningless now
+        self._unacked = 0
+        self._last_delivery_tag = None
+        self._deliveries = deque()
+        self._paused = False
+        self._reading = False
+        self._queue_obj = queue_obj
+
+        if self._backlog_checker is None or not self._backlog_checker.running:
+            self._backlog_checker = task.LoopingCall(self.check_backlog)
+            self._backlog_checker.start(self.backlog_check_interval, now=False)
+        self.read_next()
+
+    def read_next(self):
+        if self._reading or self._paused or self._stopping:
+            return
+        self._reading = True
+        queue_obj = self._queue_obj
+        d = self.read(queue_obj)
+        d.addCallbacks(self._read_finished, self._read_failed,
+                       callbackArgs=(queue_obj,), errbackArgs=(queue_obj,))
+
+    def _read_finished(self, _, queue_obj):
+        if queue_obj is not self._queue_obj:
+            return
+        self._reading = False
+        reactor.callLater(0, self.read_next)
+
+    def _read_failed(self, failure, queue_obj):
+        if queue_obj is not self._queue_obj:
+            return
+        # the channel went away, consuming starts over once it's back
+        self._reading = False
+        self.failed(failure)
 
     @defer.inlineCallbacks
     def read(self, queue_obj):
         ch, method, properties, msg = yield queue_obj.get()
-
-        msg = amqp_message_decode(msg)
-        log.debug("Consuming msg %s" % msg)
         self._message_number_in += 1
-        self.process_in_message(msg)
-        time.sleep(self.consume_interval)
-        yield ch.basic_ack(delivery_tag=method.delivery_tag)
-        log.debug('Acknowledging message #%s' % self._message_number_in)
+        delivery = [ch, method.delivery_tag, False, False]
+        self._deliveries.append(delivery)
+
+        try:
+            msg = amqp_message_decode(msg)
+            log.debug("Consuming msg %s" % msg)
+            d = self.process_in_message(msg)
+        except (ValueError, InvalidAMQPMessage, EncodingError) as e:
+            log.err("Dropping AMQP message #%s: %r" % (self._message_number_in, e))
+            d = defer.succeed(None)
+        # acked once its task is stored, reading goes on meanwhile
+        d.addCallbacks(self._message_stored, self._message_failed,
+                       callbackArgs=(delivery,), errbackArgs=(delivery, self._message_number_in))
+
+    def _message_stored(self, _, delivery):
+        delivery[2] = delivery[3] = True
+        self._settle()
+
+    def _message_failed(self, failure, delivery, number):
+        log.err("Storing AMQP message #%s failed, requeue it: %s" % (number, failure.getErrorMessage()))
+        delivery[2] = True
+        try:
+            delivery[0].basic_nack(delivery_tag=delivery[1], multiple=False, requeue=True)
+        except (ChannelClosed, ConnectionClosed):
+            # unacked messages are redelivered by the broker anyway
+            pass
+        self._settle()
+
+    def _settle(self):
+        """
+        Count the messages settled in delivery order for the next ack
+        """
+        while self._deliveries and self._deliveries[0][2]:
+            ch, tag, _, stored = self._deliveries.popleft()
+            if stored:
+                # a nacked tag can't be acked, not even as the last of many
+                self._ack_channel = ch
+                self._last_delivery_tag = tag
+                self._unacked += 1
+        if self._unacked >= self.ack_batch_size:
+            self.flush_acks()
+        elif self._unacked:
+            self._ack_timer.schedule()
+
+    def flush_acks(self):
+        """
+        Acknowledge every message received so far with a single basic.ack
+        """
+        if not self._unacked:
+            return
+        log.debug('Acknowledging %s messages up to #%s' % (self._unacked, self._message_number_in))
+        tag, self._last_delivery_tag, self._unacked = self._last_delivery_tag, None, 0
+        try:
+            self._ack_channel.basic_ack(delivery_tag=tag, multiple=True)
+        except (ChannelClosed, ConnectionClosed):
+            # unacked messages are redelivered by the broker
+            self.retry_channel()
+
+    def check_backlog(self):
+        """
+        Stop reading while too many tasks wait to be run; the broker stops
+        delivering once the prefetch window is full.
+        """
+        d = defer.maybeDeferred(self.task_storage.count_active)
+        d.addCallback(self._check_backlog)
+        d.addErrback(lambda f: log.err("Checking task backlog failed: %s" % f.getErrorMessage()))
+        return d
+
+    def _check_backlog(self, backlog):
+        if not self._paused and backlog >= self.backlog_high:
+            log.msg("Task backlog %s above %s, pause consuming" % (backlog, self.backlog_high))
+            self._paused = True
+            self.flush_acks()
+        elif self._paused and backlog <= self.backlog_low:
+            log.msg("Task backlog %s below %s, resume consuming" % (backlog, self.backlog_low))
+            self._paused = False
+            self.read_next()
 
-    @defer.inlineCallbacks
     def publish(self, message):
+        """
+        Queue `message` for publishing. Returns a Deferred fired once it is
+        in the outbox, from where it is sent until the broker confirms it.
+        """
         self._message_number_out += 1
 
         amqp_message_update_meta(message, self.get_meta())
         amqp_msg = amqp_message_encode(message)
         log.debug("Publish message #%s, AMQP message: %s" % (self._message_number_out, amqp_msg))
+        d = defer.Deferred()
+        self._batch.append((amqp_msg, d))
+        if len(self._batch) >= self.publish_batch_size:
+            self.flush_batch()
+        else:
+            self._batch_timer.schedule()
+        return d
+
+    def flush_batch(self):
+        """
+        Write the queued messages to the outbox in one go and send them
+        """
+        if not self._batch:
+            return defer.succeed(None)
+        batch, self._batch = self._batch, []
+        d = self.task_storage.outbox_add([body for body, _ in batch])
+        d.addCallbacks(self._batch_stored, self._batch_failed, callbackArgs=(batch,), errbackArgs=(batch,))
+        return d
+
+    def _batch_stored(self, ids, batch):
+        for id, (body, d) in zip(ids, batch):
+            self._outbox[id] = body
+            self._unsent.append(id)
+        self.send_unsent()
+        for body, d in batch:
+            d.callback(None)
+
+    def _batch_failed(self, failure, batch):
+        log.err("Storing %s messages in the outbox failed: %s" % (len(batch), failure.getErrorMessage()))
+        for body, d in batch:
+            d.errback(failure)
+
+    def _restore_outbox(self, rows):
+        restored = 0
+        for id, body in rows:
+            if id not in self._outbox:
+                self._outbox[id] = body
+                self._unsent.append(id)
+                restored += 1
+        if restored:
+            log.msg("Republishing %s unconfirmed messages from the outbox" % restored)
+            self.send_unsent()
+
+    def start_publishing(self, channel):
+        # sequence numbers of confirms start over with every channel
+        self._unsent.extendleft(reversed(list(self._inflight.values())))
+        self._inflight.clear()
+        self._publish_seq = 0
+        self._publish_channel = channel
+        channel.confirm_delivery(self._on_delivery_confirmation)
+        self.send_unsent()
+
+    def send_unsent(self):
+        """
+        Send outbox messages while less than `publish_window` are waiting
+        for a confirm
+        """
+        channel = self._publish_channel
+        if channel is None or not channel.is_open:
+            # everything unconfirmed is sent again on the next channel
+            return
         properties = BasicProperties(
             app_id=self.app_id,
             content_type='application/json',
             content_encoding='utf-8',
             delivery_mode=2,  # persistent
         )
-        try:
-            yield self._channel.basic_publish(
-                self.exchange_name,
-                self.queue_out_routing_key,
-                amqp_msg,
-                properties=properties,
-            )
-        except ChannelClosed:
+        while self._unsent and len(self._inflight) < self.publish_window:
+            id = self._unsent.popleft()
+            try:
+                channel.basic_publish(
+                    self.exchange_name,
+                    self.queue_out_routing_key,
+                    self._outbox[id],
+                    properties=properties,
+                )
+            except (ChannelClosed, ConnectionClosed, AMQPError) as e:
+                self._unsent.appendleft(id)
+                self._publishing_failed(e)
+                return
+            self._publish_seq += 1
+            self._inflight[self._publish_seq] = id
+
+    def _publishing_failed(self, error):
+        self._publish_channel = None
+        if isinstance(error, ChannelClosed):
             self.retry_channel()
-            self._cached_messages.append(message)
-        except AMQPError:
+        else:
             self.retry_connect()
-            self._cached_messages.append(message)
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        if method.multiple:
+            seqs = [seq for seq in self._inflight if seq <= method.delivery_tag]
+        else:
+            seqs = [method.delivery_tag] if method.delivery_tag in self._inflight else []
+        ids = [self._inflight.pop(seq) for seq in seqs]
+
+        if isinstance(method, Basic.Nack):
+            log.warn("Broker rejected %s messages, publishing them again" % len(ids))
+            self._unsent.extendleft(reversed(ids))
+        elif ids:
+            for id in ids:
+                body = self._outbox.pop(id)
+                self.signal_manager.send_catch_log(signal=signals.message_published, message=body)
+            d = self.task_storage.outbox_remove(ids)
+            d.addErrback(lambda f: log.err("Removing confirmed messages failed: %s" % f.getErrorMessage()))
+        self.send_unsent()
 
     def retry_connect(self):
         with self._lock:
@@ -254,22 +491,20 @@ class AmqpService(service.Service):
             # @TODO define a more specific exception handling here
             raise EncodingError("Can't encode message info. %s" % message)
 
-        self.scheduler.schedule(_message)
-        self.signal_manager.send_catch_log(signal=signals.request_received, jobid=jobid)
+        d = defer.maybeDeferred(self.scheduler.schedule, _message)
+        self.signal_manager.send_catch_log(signal=signals.request_received, jobid=jobid, source='amqp')
+        return d
 
     def stopService(self):
         self._stopping = True
-        if not self._cached_messages:
-            return self.really_stop_service(None)
-        log.warn("Cached messages found, try to publish them before shut down!")
-        dfds = []
-        for slot, c in enumerate(self._cached_messages):
-            dfd = defer.maybeDeferred(self._publish, c, slot)
-            dfds.append(dfd)
-
-        dfd_list = defer.DeferredList(dfds)
-        dfd_list.addBoth(self.really_stop_service)
-        return dfd_list
+        if self._backlog_checker is not None and self._backlog_checker.running:
+            self._backlog_checker.stop()
+        if self._running:
+            self.flush_acks()
+        # unconfirmed messages stay in the outbox for the next start
+        d = self.flush_batch()
+        d.addBoth(self.really_stop_service)
+        return d
 
     def really_stop_service(self, _):
         service.Service.stopService(self)
@@ -0,0 +1,63 @@
+import time
+
+from twisted.application import service
+from twisted.internet import task
+
+from pygear.logging import log
+
+
+class TaskArchiverService(service.Service):
+    """
+    Keeps the task table small: every `archive_interval` seconds the tasks
+    done more than `archive_after` seconds ago move to the archive table,
+    `archive_batch_size` rows per transaction so other statements get in
+    between, then up to `vacuum_pages` free pages go back to the file
+    system.
+    """
+    name = 'task_archiver'
+
+    def __init__(self, app, config):
+        self.app = app
+        self.interval = config.getfloat('archive_interval', 600)
+        self.retention = config.getfloat('archive_after', 86400)
+        self.batch_size = config.getint('archive_batch_size', 1000)
+        self.vacuum_pages = config.getint('vacuum_pages', 1000)
+        self._loop = None
+
+    def startService(self):
+        app = service.IServiceCollection(self.app, self.app)
+        self.task_storage = app.getServiceNamed('task_storage')
+        self._loop = task.LoopingCall(self.archive)
+        self._loop.start(self.interval, now=False)
+        service.Service.startService(self)
+
+    def stopService(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        service.Service.stopService(self)
+
+    def archive(self):
+        return self._archive(int(time.time() - self.retention), 0)
+
+    def _archive(self, before, total):
+        d = self.task_storage.archive_tasks(before, self.batch_size)
+        d.addCallback(self._archived, before, total)
+        d.addErrback(lambda f: log.err("Archiving done tasks failed: %s" % f.getErrorMessage()))
+        return d
+
+    def _archived(self, count, before, total):
+        total += count
+        if count == self.batch_size and self.running:
+            return self._archive(before, total)
+        if total:
+            log.msg("Archived %s done tasks" % total)
+        return self.vacuum()
+
+    def vacuum(self):
+        d = self.task_storage.vacuum(self.vacuum_pages)
+        d.addCallback(self._vacuumed)
+        return d
+
+    def _vacuumed(self, pages):
+        if pages:
+            log.msg("Vacuumed %s free database pages" % pages)
@@ -0,0 +1,107 @@
+import os
+import errno
+import hashlib
+from functools import partial
+
+from twisted.application import service
+from twisted.internet import task
+
+from pygear.logging import log
+
+
+class BlobStorageService(service.Service):
+    """
+    Content addressed store for downloaded files.
+
+    Every file is kept once under `storage_path`, at a path sharded by the
+    hash of its content (`ab/cd/abcd...ext`), so identical downloads of any
+    number of jobs share one file and one stable URL. Tasks reference files
+    through their `result_url`; the task storage counts those references and
+    files nobody references any more are removed periodically.
+
+    Worker processes each keep their own references, so each stores its
+    files under its own `namespace` directory.
+    """
+    name = 'blob_storage'
+
+    HASH = 'sha256'
+    SHARD_DEPTH = 2
+    SHARD_WIDTH = 2
+
+    def __init__(self, app, config, namespace=''):
+        self.app = app
+        self.namespace = namespace
+        self.storage_path = config.get('storage_path', '/tmp')
+        self.gc_interval = config.getfloat('blob_gc_interval', 3600)
+        self.gc_batch_size = config.getint('blob_gc_batch_size', 1000)
+        self._gc = None
+
+    def startService(self):
+        app = service.IServiceCollection(self.app, self.app)
+        self.task_storage = app.getServiceNamed('task_storage')
+        self._gc = task.LoopingCall(self.collect_garbage)
+        self._gc.start(self.gc_interval, now=False)
+        service.Service.startService(self)
+
+    def stopService(self):
+        if self._gc is not None and self._gc.running:
+            self._gc.stop()
+        service.Service.stopService(self)
+
+    @classmethod
+    def new_hash(cls):
+        return hashlib.new(cls.HASH)
+
+    def blob_path(self, digest, ext):
+        shards = [digest[i * self.SHARD_WIDTH:(i + 1) * self.SHARD_WIDTH] for i in range(self.SHARD_DEPTH)]
+        return '/'.join(([self.namespace] if self.namespace else []) + shards + [digest + ext])
+
+    def store(self, tmp_path, digest, ext):
+        """
+        Move a finished download into the store; returns a Deferred firing
+        with its path relative to `storage_path`.
+        """
+        file_name = self.blob_path(digest, ext)
+        d = self.task_storage.add_blob_ref(file_name, partial(self._link, tmp_path, file_name))
+        d.addCallback(lambda _: file_name)
+        return d
+
+    def reference(self, file_name):
+        """
+        One more task uses an already stored file
+        """
+        return self.task_storage.add_blob_ref(file_name)
+
+    def _link(self, tmp_path, file_name):
+        path = os.path.join(self.storage_path, file_name)
+        if os.path.exists(path):
+            log.debug("Blob %s already stored" % file_name)
+            os.remove(tmp_path)
+            return
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # same filesystem, so the file shows up complete or not at all
+        os.rename(tmp_path, path)
+
+    def _unlink(self, file_name):
+        try:
+            os.remove(os.path.join(self.storage_path, file_name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def collect_garbage(self):
+        d = self.task_storage.collect_blobs(self._unlink, self.gc_batch_size)
+        d.addCallback(self._collected)
+        d.addErrback(lambda f: log.err("Removing unreferenced files failed: %s" % f.getErrorMessage()))
+        return d
+
+    def _collected(self, count):
+        if count:
+            log.msg("Removed %s unreferenced files" % count)
+        if count == self.gc_batch_size:
+            return self.collect_garbage()
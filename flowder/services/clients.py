@@ -0,0 +1,55 @@
+from twisted.application import service
+from twisted.internet import task
+
+from pygear.logging import log
+
+from flowder.acl import TrustedClients
+from flowder.utils import parse_clients_list, get_callback_auth_details
+
+
+class TrustedClientsService(service.Service):
+    """
+    Clients allowed to use the REST API, with their callback credentials.
+
+    The list is read from `trusted_clients_file` and read again every
+    `trusted_clients_refresh` seconds so clients given by name follow
+    their DNS. Each reload builds a new index and swaps it in, lookups
+    never wait for it.
+    """
+    name = 'trusted_clients'
+
+    def __init__(self, app, config):
+        self.app = app
+        self.file_path = config.get('trusted_clients_file', 'clients.txt')
+        self.refresh_interval = config.getfloat('trusted_clients_refresh', 300)
+        self.clients = TrustedClients()
+        self._reload = None
+
+    def startService(self):
+        app = service.IServiceCollection(self.app, self.app)
+        self.resolver = app.getServiceNamed('resolver')
+        self._reload = task.LoopingCall(self.reload)
+        self._reload.start(self.refresh_interval)
+        service.Service.startService(self)
+
+    def stopService(self):
+        if self._reload is not None and self._reload.running:
+            self._reload.stop()
+        service.Service.stopService(self)
+
+    def reload(self):
+        d = parse_clients_list(self.file_path, self.resolver)
+        d.addCallback(self._loaded)
+        d.addErrback(lambda f: log.err("Loading trusted clients failed: %s" % f.getErrorMessage()))
+        return d
+
+    def _loaded(self, clients):
+        if len(clients) != len(self.clients):
+            log.msg("%s trusted clients" % len(clients))
+        self.clients = clients
+
+    def __contains__(self, ip):
+        return ip in self.clients
+
+    def auth_details(self, url):
+        return get_callback_auth_details(url, self.clients, self.resolver)
@@ -1,4 +1,10 @@
 from twisted.application import service
+from twisted.python import failure
+from twisted.internet import defer, reactor
+from twisted.internet.error import TimeoutError
+from twisted.web.client import Agent, ResponseDone
+from twisted.web.iweb import UNKNOWN_LENGTH
+from twisted.web.http_headers import Headers
 
 from scrapy.http.request import Request
 from scrapy.utils.defer import mustbe_deferred
@@ -10,6 +16,12 @@ from pygear.logging import log
 from pygear.net.http import get_proxy
 from pygear.core.six.moves.urllib.request import getproxies, proxy_bypass
 
+from flowder import __version__
+from flowder.download import FileBodyReceiver, StatsConnectionPool, DiscardBody, check_throttled, \
+    check_response, valid_content_types
+from flowder.exceptions import NoResponseContent, NotModified
+from flowder.httpcache import cache_headers
+
 
 class FetcherService(service.Service):
     name = 'fetcher'
@@ -21,21 +33,157 @@ class FetcherService(service.Service):
         self.downloader = HTTPDownloadHandler(self.settings)
         self.proxies = {}
         self.valid_extensions = config.getlist('file_valid_extensions', "jpg, png")
+        self.valid_types = valid_content_types(self.valid_extensions)
         _proxies = config.items('proxy', ())
         for proxy_type, proxy in _proxies:
             self.proxies[proxy_type] = get_proxy(proxy, proxy_type)
 
+        self.download_timeout = 60
+        self.max_file_size = config.getint('max_file_size', 1024 * 1024 * 2)
+        self.storage_path = config.get('storage_path', '/tmp')
+        self.user_agent = 'Flowder/%s' % __version__
+
+        # keep-alive connections shared by every job, streamed or buffered
+        self.pool = StatsConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = config.getint('pool_max_per_host', 8)
+        self.pool.cachedConnectionTimeout = config.getint('pool_idle_timeout', 120)
+        self.agent = Agent(reactor, connectTimeout=self.download_timeout, pool=self.pool)
+        if hasattr(self.downloader, '_pool'):
+            self.downloader._pool = self.pool
+
+        self.host_max_concurrency = config.getint('host_max_concurrency', 8)
+        self.host_slots = {}
+
     def startService(self):
         log.msg("Starting Fetcher service ...")
 
-    def fetch(self, url):
+    def stopService(self):
+        return self.pool.closeCachedConnections()
+
+    def pool_stats(self):
+        stats = self.pool.stats()
+        stats['busy_hosts'] = len(self.host_slots)
+        return stats
+
+    def host_busy(self, hostname):
+        """
+        Whether `hostname` already has `host_max_concurrency` fetches running
+        """
+        slot = self.host_slots.get(hostname)
+        return slot is not None and not slot.tokens
+
+    def _run_for_host(self, request, func, *args):
+        """
+        Run `func` once the host of `request` is below its concurrency cap
+        """
+        hostname = urlparse_cached(request).hostname
+        slot = self.host_slots.get(hostname)
+        if slot is None:
+            slot = self.host_slots[hostname] = defer.DeferredSemaphore(self.host_max_concurrency)
+
+        def _release(result):
+            slot.release()
+            if slot.tokens == slot.limit and not slot.waiting:
+                del self.host_slots[hostname]
+            return result
+
+        d = slot.acquire()
+        d.addCallback(lambda _: defer.maybeDeferred(func, *args).addBoth(_release))
+        return d
+
+    def fetch(self, url, headers=None):
         log.debug("Fetch URL %s" % url)
+        request = Request(url=url, headers=headers)
+        self.process_request(request)
+        d = self._run_for_host(request, mustbe_deferred, self.downloader.download_request, request, None)
+        d.addCallback(self._check_response)
+        return d
+
+    def _check_response(self, response):
+        if response.status == 304:
+            raise NotModified("%s not modified" % response.url, cache_headers(response.headers.get))
+        # the body is already there, scrapy enforced max_file_size on it
+        check_throttled(response.url, response.status, response.headers.get('Retry-After'))
+        check_response(response.url, response.status, response.headers.get('Content-Type'), None,
+                       self.valid_types, self.max_file_size)
+        return response
+
+    def fetch_to_file(self, url, headers=None):
+        """
+        Download `url` straight into a temporary file under `storage_path`.
+
+        Returns a Deferred firing with `(tmp_path, extension, hexdigest, size,
+        cache_headers)`, or failing with `NotModified` when conditional
+        `headers` were sent and the file didn't change. Proxied requests go
+        through the buffering downloader and are written out once complete.
+        """
         request = Request(url=url)
         self.process_request(request)
-        return mustbe_deferred(self.downloader.download_request, request, None)
+        if 'proxy' in request.meta:
+            d = self.fetch(url, headers)
+            d.addCallback(self._write_body)
+            return d
+
+        d = self._run_for_host(request, self._stream, request, headers or {})
+        self._set_timeout(d, url)
+        return d
+
+    def _stream(self, request, extra_headers):
+        log.debug("Stream URL %s" % request.url)
+        headers = Headers({'User-Agent': [self.user_agent]})
+        for name, value in extra_headers.items():
+            headers.setRawHeaders(name, [value])
+        d = self.agent.request('GET', request.url, headers)
+        d.addCallback(self._receive_body)
+        return d
+
+    def _new_receiver(self):
+        finished = defer.Deferred(lambda _: receiver.cancel())
+        receiver = FileBodyReceiver(finished, self.storage_path, self.max_file_size, self.valid_extensions)
+        return receiver
+
+    def _receive_body(self, response):
+        url = response.request.absoluteURI
+        headers = response.headers
+        length = None if response.length == UNKNOWN_LENGTH else response.length
+        response_cache_headers = cache_headers(lambda name: headers.getRawHeaders(name, [None])[0])
+        if response.code == 304:
+            # no body, the connection goes back to the pool by itself
+            raise NotModified("%s not modified" % url, response_cache_headers)
+        try:
+            check_throttled(url, response.code, headers.getRawHeaders('retry-after', [None])[0])
+            check_response(url, response.code, headers.getRawHeaders('content-type', [None])[0], length,
+                           self.valid_types, self.max_file_size)
+        except Exception:
+            # drop the connection rather than download a body we won't keep
+            response.deliverBody(DiscardBody())
+            raise
+
+        receiver = self._new_receiver()
+        response.deliverBody(receiver)
+        return receiver.finished.addCallback(lambda download: download + (response_cache_headers,))
+
+    def _write_body(self, response):
+        if not response.body:
+            raise NoResponseContent("Response has no body!")
+        receiver = self._new_receiver()
+        receiver.dataReceived(response.body)
+        receiver.connectionLost(failure.Failure(ResponseDone()))
+        return receiver.finished.addCallback(lambda download: download + (cache_headers(response.headers.get),))
+
+    def _set_timeout(self, d, url):
+        timeout_call = reactor.callLater(self.download_timeout, d.cancel)
+
+        def _check_timeout(result):
+            if timeout_call.active():
+                timeout_call.cancel()
+            elif isinstance(result, failure.Failure) and result.check(defer.CancelledError):
+                raise TimeoutError("Getting %s took longer than %s seconds." % (url, self.download_timeout))
+            return result
+        d.addBoth(_check_timeout)
 
     def process_request(self, request):
-        request.meta['download_timeout'] = 60
+        request.meta['download_timeout'] = self.download_timeout
 
         parsed = urlparse_cached(request)
         scheme = parsed.scheme
@@ -49,4 +197,4 @@ class FetcherService(service.Service):
         creds, proxy = self.proxies[scheme]
         request.meta['proxy'] = proxy
         if creds:
-            request.headers['Proxy-Authorization'] = 'Basic ' + creds
\ No newline at end of file
+            request.headers['Proxy-Authorization'] = 'Basic ' + creds
@@ -0,0 +1,124 @@
+from twisted.application import service
+
+from pygear.twisted.signal import get_signal_manager
+
+from flowder import signals
+from flowder.metrics import Registry
+
+
+class MetricsService(service.Service):
+    """
+    Collects the application metrics exported on `/metrics`.
+
+    Events are counted from the signals sent through the signal manager;
+    queue depths, slots and cache or pool statistics are read from the
+    services when the metrics are rendered. Statement latencies are
+    observed by the SQLite writer thread itself.
+    """
+    name = 'metrics'
+
+    def __init__(self, app):
+        self.app = app
+        self.registry = registry = Registry()
+
+        self.jobs_scheduled = registry.counter(
+            'flowder_jobs_scheduled_total', 'Jobs received', ['source'])
+        self.jobs_finished = registry.counter(
+            'flowder_jobs_finished_total', 'Jobs finished by result', ['result'])
+        self.job_duration = registry.histogram(
+            'flowder_job_duration_seconds', 'Time from slot assignment to job result')
+        self.fetch_duration = registry.histogram(
+            'flowder_fetch_duration_seconds', 'Time to download a file')
+        self.bytes_downloaded = registry.counter(
+            'flowder_downloaded_bytes_total', 'Bytes of downloaded files')
+        self.messages_published = registry.counter(
+            'flowder_amqp_published_total', 'Result messages published on AMQP')
+        self.job_stage_duration = registry.histogram(
+            'flowder_job_stage_duration_seconds', 'Time spent in each stage of a traced job', ['stage'])
+        self.db_statement_duration = registry.histogram(
+            'flowder_db_statement_duration_seconds', 'Time to run a database statement')
+
+        registry.gauge('flowder_queue_depth', 'Tasks claimed and waiting for a launcher slot',
+                       collect=lambda: len(self.poller.dq))
+        registry.gauge('flowder_launcher_slots', 'Launcher slots by state', ['state'],
+                       collect=self._launcher_slots)
+        registry.gauge('flowder_concurrency_limit', 'Launcher slots in use, set by the concurrency controller',
+                       collect=lambda: self.launcher.limit)
+        registry.gauge('flowder_reactor_lag_seconds', 'Delay of the last reactor lag probe',
+                       collect=lambda: self.launcher.lag_monitor.lag)
+        registry.counter('flowder_reactor_blocked_total', 'Times a callback blocked the reactor too long',
+                         collect=lambda: self.launcher.lag_monitor.blocked)
+        registry.gauge('flowder_db_backlog', 'Database statements queued on the writer thread',
+                       collect=self._db_backlog)
+        registry.counter('flowder_url_cache_lookups_total', 'Fetched URL lookups by outcome', ['result'],
+                         collect=self._url_cache_lookups)
+        registry.counter('flowder_http_pool_requests_total', 'HTTP requests by connection reuse', ['connection'],
+                         collect=self._pool_requests)
+        registry.gauge('flowder_http_pool_idle_connections', 'Keep-alive connections cached',
+                       collect=lambda: self.fetcher.pool_stats()['idle_connections'])
+        registry.counter('flowder_dns_lookups_total', 'DNS lookups by cache outcome', ['result'],
+                         collect=self._dns_lookups)
+
+    def startService(self):
+        app = service.IServiceCollection(self.app, self.app)
+        self.poller = app.getServiceNamed('poller')
+        self.launcher = app.getServiceNamed('launcher')
+        self.fetcher = app.getServiceNamed('fetcher')
+        self.task_storage = app.getServiceNamed('task_storage')
+        self.resolver = app.getServiceNamed('resolver').resolver
+
+        writer = getattr(self.task_storage, 'writer', None)
+        if writer is not None:
+            writer.statement_latency = self.db_statement_duration.labels()
+
+        self.signal_manager = get_signal_manager(self.app)
+        self.signal_manager.connect(self.request_received, signal=signals.request_received)
+        self.signal_manager.connect(self.job_finished, signal=signals.job_finished)
+        self.signal_manager.connect(self.fetch_finished, signal=signals.fetch_finished)
+        self.signal_manager.connect(self.message_published, signal=signals.message_published)
+        self.signal_manager.connect(self.job_traced, signal=signals.job_traced)
+        service.Service.startService(self)
+
+    def render(self):
+        return self.registry.render()
+
+    def request_received(self, source='unknown', count=1):
+        self.jobs_scheduled.labels(source).inc(count)
+
+    def job_finished(self, result, elapsed):
+        self.jobs_finished.labels(result).inc()
+        self.job_duration.observe(elapsed)
+
+    def fetch_finished(self, elapsed, size):
+        self.fetch_duration.observe(elapsed)
+        self.bytes_downloaded.inc(size)
+
+    def message_published(self):
+        self.messages_published.inc()
+
+    def job_traced(self, trace):
+        for span in trace['stages']:
+            self.job_stage_duration.labels(span['stage']).observe(span['duration'])
+
+    def _launcher_slots(self):
+        busy = len(self.launcher.threads)
+        return {('busy',): busy, ('free',): max(0, self.launcher.limit - busy)}
+
+    def _db_backlog(self):
+        writer = getattr(self.task_storage, 'writer', None)
+        return writer.backlog() if writer is not None else 0
+
+    def _url_cache_lookups(self):
+        url_cache = self.task_storage.url_cache
+        if url_cache is None:
+            return {}
+        stats = url_cache.stats()
+        return {('hit',): stats['hits'], ('miss',): stats['misses'], ('database',): stats['db_lookups']}
+
+    def _dns_lookups(self):
+        stats = self.resolver.stats()
+        return {('hit',): stats['hits'], ('miss',): stats['misses']}
+
+    def _pool_requests(self):
+        stats = self.fetcher.pool_stats()
+        return {('reused',): stats['hits'], ('new',): stats['new_connections']}
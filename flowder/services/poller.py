@@ -1,23 +1,46 @@
+import time
+
 from zope.interface import implementer
 
 from twisted.application import service
-from twisted.internet.defer import DeferredQueue, inlineCallbacks, maybeDeferred, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, maybeDeferred, returnValue
 
 from pygear.logging import log
+from pygear.twisted.reactor import CallLaterOnce
 from pygear.twisted.signal import get_signal_manager
 
 from flowder import signals
+from flowder.hostqueue import HostQueue, get_url_host
 from flowder.interfaces import IPoller
 
 
 @implementer(IPoller)
 class QueuePoller(service.Service):
+    """
+    Feeds the launcher slots with standby tasks.
+
+    The poller wakes up whenever tasks are updated or a launcher slot asks
+    for its next task, and claims as many tasks as there are free slots in a
+    single storage call. The periodic `poll` from the application timer is
+    only a fallback.
+
+    Claimed tasks go through a `HostQueue`, which decides which host the
+    next free slot works for; tasks of hosts that already have enough queued
+    are left in storage for later.
+    """
     name = 'poller'
 
-    def __init__(self, app, poll_size=5):
+    def __init__(self, app, poll_size=5, queue=None):
         self.app = app
-        self.dq = DeferredQueue(size=poll_size)
+        self.poll_size = poll_size
+        self.dq = queue if queue is not None else HostQueue()
         self.queue = None
+        self.task_storage = None
+        self._claiming = False
+        self.wakeup = CallLaterOnce(self.poll)
+        self.wakeup.delay = 0
+        self._due_call = None
 
     def startService(self):
         log.msg("Start pooler ...")
@@ -28,21 +51,63 @@ class QueuePoller(service.Service):
 
         self.update_tasks()
 
-    @inlineCallbacks
+    def stopService(self):
+        if self._due_call is not None and self._due_call.active():
+            self._due_call.cancel()
+        service.Service.stopService(self)
+
+    def free_slots(self):
+        """
+        Number of tasks that can be handed out right now: slots waiting on
+        `next` plus room left in the queue. A host with tasks queued takes
+        one place whatever its backlog, which the claim caps per host.
+        """
+        return len(self.dq.waiting) + self.poll_size - len(self.dq.queues)
+
     def poll(self):
-        if self.dq.pending or \
+        if self._claiming or \
                 not self.task_storage or \
                 not self.task_storage.ready:
             return
-        c = yield maybeDeferred(self.task_storage.count)
-        if c:
-            for task in self.tasks_list:
-                if task['status'] != self.task_storage.TASK_STANDBY:
-                    continue
-                task['status'] = self.task_storage.TASK_HOLD
-                log.msg("add task to queue %s." % task['job_id'])
-                self.put(task)
-                break
+        limit = self.free_slots()
+        if limit <= 0:
+            return
+
+        self._claiming = True
+        dfd = maybeDeferred(self.task_storage.claim_tasks, limit, self.dq.full_hosts(),
+                            self.dq.host_depth, self.dq.queued())
+        dfd.addCallback(self._queue_tasks, limit)
+        dfd.addErrback(self.failed)
+        dfd.addBoth(self._claim_finished)
+        return dfd
+
+    def _queue_tasks(self, tasks, limit):
+        for task in tasks:
+            log.msg("add task to queue %s." % task['job_id'])
+            self.dq.put(task)
+
+        if len(tasks) == limit:
+            # there may be more standby tasks waiting for a slot
+            self.wakeup.schedule()
+
+    def _claim_finished(self, _):
+        self._claiming = False
+        self._schedule_due()
+
+    def _schedule_due(self):
+        """
+        Poll again when the next task waiting for a retry is due
+        """
+        due = self.task_storage.next_due()
+        if due is None:
+            return
+        delay = max(0, due - time.time())
+        if self._due_call is not None and self._due_call.active():
+            if self._due_call.getTime() <= reactor.seconds() + delay:
+                return
+            self._due_call.reset(delay)
+        else:
+            self._due_call = reactor.callLater(delay, self.poll)
 
     @inlineCallbacks
     def put(self, task):
@@ -50,11 +115,24 @@ class QueuePoller(service.Service):
         self.dq.put(task)
 
     def next(self):
-        return self.dq.get()
+        dfd = self.dq.get()
+        # a launcher slot just became free, top the queue up
+        if self.free_slots() > 0:
+            self.wakeup.schedule()
+        return dfd
+
+    def host_succeeded(self, url):
+        self.dq.succeeded(get_url_host(url))
+
+    def host_throttled(self, url, reason='', retry_after=None):
+        """
+        The host of `url` asked us to slow down or didn't keep up
+        """
+        self.dq.penalize(get_url_host(url), reason, retry_after)
 
     def update_tasks(self):
         log.debug("Poller > Updating tasks")
-        self.tasks_list = self.task_storage.tasks
+        self.wakeup.schedule()
 
     def failed(self, why):
         ex = why.value
@@ -83,9 +161,13 @@ class QueuePoller(service.Service):
         result_type = self.task_storage.RESULT_FAILED
         return self.set_task_finished(job_id, result_type, result_message)
 
-    def set_task_retry(self, job_id, result_message):
+    def set_task_retry(self, job_id, result_message, delay=0):
+        """
+        Back to standby, not to be claimed before `delay` seconds
+        """
         result_type = self.task_storage.RESULT_RETRY
-        dfd = maybeDeferred(self.task_storage.set_task_standby, job_id, result_type, result_message)
+        dfd = maybeDeferred(self.task_storage.set_task_retry, job_id, int(time.time() + delay),
+                            result_type, result_message)
         dfd.addErrback(self.failed)
         return dfd
 
@@ -94,6 +176,11 @@ class QueuePoller(service.Service):
         dfd.addErrback(self.failed)
         return dfd
 
+    def release_tasks(self):
+        dfd = maybeDeferred(self.task_storage.release_leases)
+        dfd.addErrback(self.failed)
+        return dfd
+
     def reset_all_tasks(self):
         dfd = maybeDeferred(self.task_storage.reset_all_tasks)
         dfd.addErrback(self.failed)
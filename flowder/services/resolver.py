@@ -0,0 +1,42 @@
+from twisted.application import service
+from twisted.internet import reactor, task
+
+from pygear.logging import log
+
+from flowder.resolver import CachingResolver
+
+
+class ResolverService(service.Service):
+    """
+    Installs a CachingResolver as the reactor resolver, so the fetcher's
+    connections, callback auth and the trusted clients list share one DNS
+    cache, and keeps the names in use refreshed in the background.
+    """
+    name = 'resolver'
+
+    def __init__(self, config):
+        self.resolver = CachingResolver(maxsize=config.getint('dns_cache_size', 10000),
+                                        min_ttl=config.getint('dns_min_ttl', 30),
+                                        max_ttl=config.getint('dns_max_ttl', 3600),
+                                        negative_ttl=config.getint('dns_negative_ttl', 30),
+                                        refresh_interval=config.getfloat('dns_refresh_interval', 10))
+        self._previous = None
+        self._refresh = None
+
+    def startService(self):
+        log.msg("Starting DNS cache ...")
+        self._previous = reactor.installResolver(self.resolver)
+        self._refresh = task.LoopingCall(self.resolver.refresh)
+        self._refresh.start(self.resolver.refresh_interval, now=False)
+        service.Service.startService(self)
+
+    def stopService(self):
+        if self._refresh is not None and self._refresh.running:
+            self._refresh.stop()
+        if self._previous is not None:
+            reactor.installResolver(self._previous)
+            self._previous = None
+        service.Service.stopService(self)
+
+    def getHostByName(self, name, timeout=None):
+        return self.resolver.getHostByName(name, timeout)
@@ -28,7 +28,10 @@ class TaskScheduler(service.Service):
         self.update_tasks()  # same as pooler > pools list of projects
 
     def schedule(self, task_info):
-        self.task_storage.add(task_info)
+        return self.task_storage.add(task_info)
+
+    def schedule_many(self, tasks):
+        return self.task_storage.add_many(tasks)
 
     def cancel(self, task_id):
         return self.tasks_list.remove(task_id)
@@ -39,4 +42,4 @@ class TaskScheduler(service.Service):
     def update_tasks(self):
         log.debug("Scheduler > Updating tasks")
         self.tasks_list = self.task_storage.tasks
-        log.debug("Current tasks count: %s" % len(self.task_storage))
+        log.debug("Current tasks count: %s" % len(self.tasks_list))
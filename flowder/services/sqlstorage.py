@@ -0,0 +1,310 @@
+import time
+
+from twisted.enterprise import adbapi
+
+from pygear.logging import log
+
+from flowder.services.storage import FileDownloaderTaskStorage
+
+
+class SQLConnection(object):
+    """
+    The part of `sqlite3.Connection` the task storage uses, on top of an
+    adbapi connection: statements are written with `?` placeholders and
+    turned into the ones of the driver.
+    """
+
+    def __init__(self, connection, paramstyle):
+        self.connection = connection
+        self.translate = paramstyle in ('format', 'pyformat')
+
+    def _query(self, q):
+        if self.translate:
+            return q.replace('%', '%%').replace('?', '%s')
+        return q
+
+    def execute(self, q, args=()):
+        cursor = self.connection.cursor()
+        if args:
+            cursor.execute(self._query(q), tuple(args))
+        else:
+            # without arguments the driver doesn't expand any placeholder
+            cursor.execute(q)
+        return cursor
+
+    def executemany(self, q, args):
+        cursor = self.connection.cursor()
+        cursor.executemany(self._query(q), [tuple(row) for row in args])
+        return cursor
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+
+class AdbapiTaskStorage(FileDownloaderTaskStorage):
+    """
+    Task storage in a database shared by several flowder nodes, PostgreSQL
+    or SQLite, through a `twisted.enterprise.adbapi` connection pool. Every
+    call runs and commits on a pool thread before its Deferred fires.
+
+    Nothing is kept in memory, the table is the queue: claims lease the
+    oldest due standby rows in one statement. On PostgreSQL it's prepared
+    once per connection and skips the rows other nodes are claiming
+    (`FOR UPDATE SKIP LOCKED`), so nodes never wait on each other. SQLite
+    has one writer at a time anyway, and `sqlite3` caches its statements.
+    """
+
+    CLAIM_COLUMNS = "id, job_id, fetch_uri, host, result_url, settings, attempts, next_attempt_at"
+
+    def __init__(self, app, driver='psycopg2', connargs=None, table="task_list", url_cache=None, owner=None,
+                 lease_ttl=60, min_connections=3, max_connections=5, convert_auto_vacuum=False, node=None):
+        connargs = dict(connargs or {})
+        FileDownloaderTaskStorage.__init__(self, app, connargs.get('database'), table, url_cache, owner, lease_ttl,
+                                           shared=True, convert_auto_vacuum=convert_auto_vacuum, node=node)
+        self.driver = driver
+        self.connargs = connargs
+        self.dialect = 'sqlite' if driver == 'sqlite3' else 'postgresql'
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.claim_statement = 'flowder_claim_%s' % table
+        self.pool = None
+        self.paramstyle = None
+        # ids of the pool connections the claim is prepared on
+        self._prepared = set()
+        self._next_due = None
+
+    @classmethod
+    def from_config(cls, app, config, database=None, url_cache=None, owner=None, node=None):
+        driver = config.get('db_driver', 'psycopg2')
+        connargs = dict(config.items('database', ()))
+        if not connargs and driver == 'sqlite3':
+            connargs = {'database': database}
+        return cls(app, driver, connargs, url_cache=url_cache, owner=owner,
+                   lease_ttl=config.getint('lease_ttl', 60),
+                   min_connections=config.getint('db_pool_min', 3),
+                   max_connections=config.getint('db_pool_max', 5),
+                   convert_auto_vacuum=config.getboolean('db_convert_auto_vacuum', False), node=node)
+
+    def create_connection(self):
+        kwargs = dict(self.connargs)
+        if self.dialect == 'sqlite':
+            # a single connection, sqlite serializes the writers anyway
+            kwargs.update(check_same_thread=False, cp_min=1, cp_max=1)
+        else:
+            kwargs.update(cp_min=self.min_connections, cp_max=self.max_connections)
+        self.pool = adbapi.ConnectionPool(self.driver, cp_openfun=self._connection_opened, cp_reconnect=True,
+                                          cp_noisy=False, **kwargs)
+        self.paramstyle = self.pool.dbapi.paramstyle
+        self.ready = True
+
+    def _connection_opened(self, connection):
+        # a new connection may get the id of a closed one
+        self._prepared.discard(id(connection))
+
+    def stopService(self):
+        FileDownloaderTaskStorage.stopService(self)
+        self.ready = False
+        if self.pool is not None:
+            self.pool.close()
+
+    def runInteraction(self, func, *args, **kwargs):
+        return self.pool.runWithConnection(self._run_interaction, func, *args, **kwargs)
+
+    def _run_interaction(self, connection, func, *args, **kwargs):
+        # the pool commits, or rolls back if `func` raised
+        return func(SQLConnection(connection, self.paramstyle), *args, **kwargs)
+
+    def runQuery(self, q, args=()):
+        return self.runInteraction(self._run_query, q, args)
+
+    def migrate(self, conn):
+        """
+        Create the tables at the current schema version in one go on an
+        empty database, migrate older SQLite files step by step
+        """
+        self._init_auto_vacuum(conn)
+        if self._schema_version(conn) == 0:
+            log.msg("Creating %s at schema version %s ..." % (self.table, self.SCHEMA_VERSION))
+            self._create_schema(conn)
+            self._set_schema_version(conn, self.SCHEMA_VERSION)
+        version = FileDownloaderTaskStorage.migrate(self, conn)
+        # claims: due standby tasks in dispatch order, and when the next one is due
+        conn.execute("create index if not exists %(t)s_standby on %(t)s (created, id) where status = '%(s)s'"
+                     % {'t': self.table, 's': self.TASK_STANDBY})
+        conn.execute("create index if not exists %(t)s_next_attempt on %(t)s (next_attempt_at) "
+                     "where status = '%(s)s'" % {'t': self.table, 's': self.TASK_STANDBY})
+        return version
+
+    def _create_schema(self, conn):
+        """
+        Tables and indexes of `SCHEMA_VERSION`, columns in the order the
+        migrations leave them
+        """
+        if self.dialect == 'postgresql':
+            types = {'id': 'bigserial primary key', 'int': 'bigint', 'blob': 'bytea'}
+        else:
+            types = {'id': 'integer primary key', 'int': 'integer', 'blob': 'blob'}
+        names = dict(types, t=self.table, b=self.blob_table, o=self.outbox_table, a=self.archive_table,
+                     c=self.http_cache_table,
+                     done=self.TASK_DONE, success=self.RESULT_SUCCESS, leased=self._leased_clause())
+        for q in (
+                "create table %(t)s (id %(id)s, job_id text, status text, fetch_uri text, result_url text, "
+                "settings text, created %(int)s, updated %(int)s, result_type text, result_message text, "
+                "host text, attempts integer not null default 0, next_attempt_at %(int)s not null default 0, "
+                "lease_owner text, lease_expires %(int)s)",
+                "create index %(t)s_job_id on %(t)s (job_id)",
+                "create index %(t)s_active on %(t)s (created, id) where status != '%(done)s'",
+                "create index %(t)s_fetch_uri on %(t)s (fetch_uri, status, result_type, result_url)",
+                "create index %(t)s_lease_expires on %(t)s (lease_expires) where %(leased)s",
+                "create index %(t)s_lease_owner on %(t)s (lease_owner) where %(leased)s",
+                "create index %(t)s_done on %(t)s (updated) where status = '%(done)s'",
+                "create table %(b)s (path text primary key, refcount integer not null, created %(int)s)",
+                "create index %(b)s_unreferenced on %(b)s (path) where refcount <= 0",
+                "create table %(o)s (id %(id)s, body %(blob)s not null, created %(int)s, node text)",
+                "create index %(o)s_node on %(o)s (node, id)",
+                "create table %(a)s (id %(id)s, task_id %(int)s, job_id text, fetch_uri text, result_url text, "
+                "settings text, created %(int)s, updated %(int)s, result_type text, result_message text, "
+                "host text, attempts integer)",
+                "create index %(a)s_fetch_uri on %(a)s (fetch_uri) where result_type = '%(success)s'",
+                "create table %(c)s (fetch_uri text primary key, result_url text, etag text, last_modified text, "
+                "expires %(int)s, updated %(int)s)"):
+            conn.execute(q % names)
+
+    def _add_column(self, conn, column, table=None):
+        if self.dialect == 'sqlite':
+            return FileDownloaderTaskStorage._add_column(self, conn, column, table)
+        conn.execute("alter table %s add column if not exists %s" % (table or self.table, column))
+
+    def _init_auto_vacuum(self, conn):
+        if self.dialect == 'sqlite':
+            FileDownloaderTaskStorage._init_auto_vacuum(self, conn)
+
+    def _check_auto_vacuum(self, conn):
+        if self.dialect == 'sqlite':
+            FileDownloaderTaskStorage._check_auto_vacuum(self, conn)
+
+    def load_tasks(self, _=None):
+        # the table is the queue, just let the poller claim
+        self._send_tasks_updated(None, None)
+
+    def _index_tasks(self, result, tasks):
+        return result
+
+    def count_active(self):
+        q = "select count(*) from %s where status != '%s'" % (self.table, self.TASK_DONE)
+        d = self.runQuery(q)
+        d.addCallback(lambda rows: rows[0][0])
+        return d
+
+    def next_due(self):
+        """
+        When the next task waiting for a retry was due at the last claim
+        """
+        return self._next_due
+
+    def claim_tasks(self, limit, exclude_hosts=(), per_host=None, queued=None):
+        """
+        Lease up to `limit` due standby tasks, oldest first, skipping the
+        tasks of `exclude_hosts`; at most `per_host` of a host, less the
+        tasks `queued` counts for it already
+        """
+        d = self.runInteraction(self._claim_tasks, limit, list(exclude_hosts),
+                                limit if per_host is None else per_host, queued or {})
+        d.addCallback(self._claimed)
+        return d
+
+    def _claim_tasks(self, conn, limit, exclude_hosts, per_host, queued):
+        _time = int(time.time())
+        args = (self.TASK_HOLD, _time, self.owner, _time + self.lease_ttl, self.TASK_STANDBY)
+        hosts = sorted(queued)
+        if self.dialect == 'postgresql':
+            self._prepare_claim(conn)
+            q = "EXECUTE %s (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % self.claim_statement
+            rows = conn.execute(q, args + (exclude_hosts, limit, per_host, hosts,
+                                           [queued[host] for host in hosts])).fetchall()
+        else:
+            queued_case = "case coalesce(host, '') %s else 0 end" % ' '.join(['when ? then ?'] * len(hosts)) \
+                if hosts else '0'
+            q = self._claim_query(['?', '?', '?', '?', '?', '?'], ','.join('?' * len(exclude_hosts)), '?',
+                                  '?', queued_case)
+            host_args = tuple(arg for host in hosts for arg in (host, queued[host]))
+            rows = conn.execute(q, args + (_time,) + tuple(exclude_hosts) + host_args + (per_host, limit)).fetchall()
+        q = "select min(next_attempt_at) from %s where status = '%s' and next_attempt_at > ?" % \
+            (self.table, self.TASK_STANDBY)
+        next_due = conn.execute(q, (_time,)).fetchone()[0]
+        return sorted(rows), next_due
+
+    def _claim_query(self, marks, exclude, limit, per_host, queued):
+        # tasks are ranked per host to cap them, postgres can't lock rows
+        # in a query using a window function so they're locked a level up
+        marks = dict([(str(i + 1), mark) for i, mark in enumerate(marks)])
+        pick = "SELECT id FROM (SELECT id, host, created, row_number() OVER " \
+               "(PARTITION BY coalesce(host, '') ORDER BY created, id) AS host_rank " \
+               "FROM %(t)s WHERE status = %(5)s and next_attempt_at <= %(6)s and coalesce(host, '') %(exclude)s) " \
+               "ranked WHERE host_rank + %(queued)s <= %(per_host)s ORDER BY created, id LIMIT %(limit)s" % dict(
+                   marks, t=self.table, limit=limit, per_host=per_host, queued=queued,
+                   exclude="<> ALL(%s)" % exclude if self.dialect == 'postgresql' else "not in (%s)" % exclude)
+        if self.dialect == 'postgresql':
+            pick = "SELECT id FROM %s WHERE id in (%s) and status = %s FOR UPDATE SKIP LOCKED" % \
+                   (self.table, pick, marks['5'])
+        return "UPDATE %(t)s SET status=%(1)s, updated=%(2)s, lease_owner=%(3)s, lease_expires=%(4)s " \
+               "WHERE id in (%(pick)s) RETURNING %(columns)s" % dict(
+                   marks, t=self.table, pick=pick, columns=self.CLAIM_COLUMNS)
+
+    def _prepare_claim(self, conn):
+        # prepared statements belong to the session, so once per connection
+        key = id(self.pool.connect())
+        if key in self._prepared:
+            return
+        q = self._claim_query(['$1', '$2', '$3', '$4', '$5', '$2'], '$6', '$7', '$8',
+                              "coalesce($10[array_position($9, coalesce(host, ''))], 0)")
+        conn.execute("PREPARE %s (text, bigint, text, bigint, text, text[], integer, integer, text[], integer[]) "
+                     "AS %s" % (self.claim_statement, q))
+        self._prepared.add(key)
+
+    def _claimed(self, result):
+        rows, self._next_due = result
+        return [dict(self._standby_task(row), status=self.TASK_HOLD) for row in rows]
+
+    def _reap_leases(self, conn):
+        q = "UPDATE %s SET status=?, updated=?, lease_owner=null, lease_expires=null " \
+            "WHERE %s and lease_expires < ? and (lease_owner is null or lease_owner != ?)" % \
+            (self.table, self._leased_clause())
+        _time = int(time.time())
+        return conn.execute(q, (self.TASK_STANDBY, _time, _time, self.owner)).rowcount
+
+    def _reaped(self, expired):
+        if expired:
+            log.msg("Requeued %s tasks with an expired lease" % expired)
+            self._send_tasks_updated(None, None)
+
+    def _vacuum(self, conn, pages):
+        if self.dialect == 'sqlite':
+            return FileDownloaderTaskStorage._vacuum(self, conn, pages)
+        # autovacuum takes care of it, VACUUM can't run in a transaction anyway
+        return 0
+
+    def _add_blob_ref(self, conn, path, step, link=None):
+        if link is not None:
+            link()
+        conn.execute("insert into %s (path, refcount, created) values (?, 0, ?) on conflict (path) do nothing"
+                     % self.blob_table, (path, int(time.time())))
+        conn.execute("update %s set refcount=refcount + ? where path=?" % self.blob_table, (step, path))
+
+    def _add_http_cache_row(self, conn, url):
+        conn.execute("insert into %s (fetch_uri) values (?) on conflict (fetch_uri) do nothing"
+                     % self.http_cache_table, (url,))
+
+    def _lock_http_cache_row(self, conn, url):
+        if self.dialect == 'sqlite':
+            return FileDownloaderTaskStorage._lock_http_cache_row(self, conn, url)
+        return conn.execute("select result_url from %s where fetch_uri=? for update" % self.http_cache_table,
+                            (url,)).fetchone()[0]
+
+    def _outbox_add(self, conn, bodies):
+        q = "insert into %s (body, created, node) values (?, ?, ?) returning id" % self.outbox_table
+        _time = int(time.time())
+        return [conn.execute(q, (self.pool.dbapi.Binary(body), _time, self.node)).fetchone()[0] for body in bodies]
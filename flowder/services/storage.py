@@ -1,12 +1,21 @@
+import os
 import json
 import time
+import uuid
+import socket
 import sqlite3
 
 from zope.interface import implementer
+from twisted.internet import defer, task
 from twisted.application import service
 
 from pygear.logging import log
+from pygear.twisted.signal import get_signal_manager
+
 from flowder import signals
+from flowder.dbwriter import SQLiteWriter
+from flowder.hostqueue import get_url_host
+from flowder.taskindex import TaskIndex
 from flowder.interfaces import ITaskStorage
 
 
@@ -23,9 +32,15 @@ class FileDownloaderTaskStorage(service.Service):
     RESULT_RETRY = 'R'
     RESULT_SUCCESS = 'S'
 
-    tasks = list()  # tasks list - get from DB
+    SCHEMA_VERSION = 10
+
+    # sqlite allows 999 parameters per statement
+    MAX_STATEMENT_ARGS = 500
+    # PRAGMA auto_vacuum value
+    INCREMENTAL_VACUUM = 2
 
-    def __init__(self, app, database=None, table="task_list"):
+    def __init__(self, app, database=None, table="task_list", url_cache=None, owner=None, lease_ttl=60,
+                 shared=False, convert_auto_vacuum=False, node=None):
         """
         if the project is ae and dbspath from settings is dbs:
         dbpath = os.path.join(dbsdir, '%s.db' % project)
@@ -36,31 +51,323 @@ class FileDownloaderTaskStorage(service.Service):
         self.app = app
         self.database = database or ':memory:'
         self.table = table
+        self.blob_table = '%s_blobs' % table
+        self.outbox_table = '%s_outbox' % table
+        self.archive_table = '%s_archive' % table
+        self.http_cache_table = '%s_http_cache' % table
+        self.url_cache = url_cache
+        # non-done tasks, the storage keeps it in step with the table
+        self.tasks = TaskIndex(self.TASK_STANDBY, self.TASK_DONE)
+
+        # claimed tasks are leased to `owner` for `lease_ttl` seconds and
+        # renewed while it's alive; expired leases go back to standby. The
+        # token keeps a restart (maybe with the same pid) from taking the
+        # leases of the previous run for its own
+        self.owner = '%s/%s' % (owner or '%s:%s' % (socket.gethostname(), os.getpid()), uuid.uuid4().hex)
+        self.lease_ttl = lease_ttl
+        # other processes add and claim tasks in the same database
+        self.shared = shared
+        # stays the same across restarts, unlike `owner`; a node only replays
+        # its own outbox messages
+        self.node = node or socket.gethostname()
+        # rewrite a file made before incremental vacuum at startup
+        self.convert_auto_vacuum = convert_auto_vacuum
+        self._last_id = 0
+        self._renew = None
+        self._reap = None
 
         self.conn = None
         self.ready = False
 
+    @classmethod
+    def from_config(cls, app, config, database=None, url_cache=None, owner=None, node=None):
+        return cls(app, database, url_cache=url_cache, owner=owner,
+                   lease_ttl=config.getint('lease_ttl', 60),
+                   shared=config.getboolean('db_shared', False),
+                   convert_auto_vacuum=config.getboolean('db_convert_auto_vacuum', False), node=node)
+
     def startService(self):
         log.msg("Start connecting to Database ...")
-        self.start()
+        self.signal_manager = get_signal_manager(self.app)
+        service.Service.startService(self)
+        d = self.start()
+        d.addCallback(self.start_leases)
+        return d
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for loop in (self._renew, self._reap):
+            if loop is not None and loop.running:
+                loop.stop()
+
+    def start_leases(self, _=None):
+        self._renew = task.LoopingCall(self.renew_leases)
+        self._renew.start(self.lease_ttl / 3.0, now=False)
+        self._reap = task.LoopingCall(self.reap_leases)
+        self._reap.start(self.lease_ttl / 2.0)
 
     def start(self):
         self.create_connection()
-        self.create_or_update_table()
+        return self.create_or_update_table()
 
     def create_connection(self):
+        # about check_same_thread: http://twistedmatrix.com/trac/ticket/4040
         self.conn = sqlite3.connect(self.database, check_same_thread=False)
         self.ready = True
 
     def create_or_update_table(self):
-        # about check_same_thread: http://twistedmatrix.com/trac/ticket/4040
+        d = self.runMigration(self.migrate)
+        d.addCallback(self.load_tasks)
+        # the Bloom filter can't see the URLs other processes fetch, so on a
+        # shared database it stays cold and only the LRU answers, for URLs
+        # known to be fetched
+        if self.url_cache is not None and not self.shared:
+            d.addCallback(self.warm_url_cache)
+        return d
+
+    def migrate(self, conn):
+        """
+        Upgrade the task table in place, one schema version at a time.
+        The current version of every table is kept in `schema_version`.
+        """
+        self._init_auto_vacuum(conn)
+        version = self._schema_version(conn)
+        while version < self.SCHEMA_VERSION:
+            version += 1
+            log.msg("Migrating %s to schema version %s ..." % (self.table, version))
+            getattr(self, '_migration_%s' % version)(conn)
+            self._set_schema_version(conn, version)
+            conn.commit()
+        self._check_auto_vacuum(conn)
+        return version
+
+    def _schema_version(self, conn):
+        conn.execute("create table if not exists schema_version (name text primary key, version integer)")
+        row = conn.execute("select version from schema_version where name=?", (self.table,)).fetchone()
+        return row[0] if row else 0
+
+    def _set_schema_version(self, conn, version):
+        conn.execute("delete from schema_version where name=?", (self.table,))
+        conn.execute("insert into schema_version (name, version) values (?, ?)", (self.table, version))
+
+    def _migration_1(self, conn):
         q = "create table if not exists %s (id integer primary key, job_id text, status text, " \
             "fetch_uri text, result_url text, settings text, " \
             "created text, updated text, " \
             "result_type text, result_message text)" % self.table
+        conn.execute(q)
+
+    def _migration_2(self, conn):
+        """
+        Store created/updated as integers and index the hot lookups
+        """
+        tmp_table = '%s_v2' % self.table
+        # py2's sqlite3 commits before every DDL statement, so a crash may
+        # have come after the drop below, leaving the rows in the new table only
+        if self._table_exists(conn, tmp_table) and not self._table_has_rows(conn, self.table):
+            log.msg("Resuming the interrupted rebuild of %s" % self.table)
+            conn.execute("drop table if exists %s" % self.table)
+        else:
+            conn.execute("drop table if exists %s" % tmp_table)
+            conn.execute("create table %s (id integer primary key, job_id text, status text, "
+                         "fetch_uri text, result_url text, settings text, "
+                         "created integer, updated integer, "
+                         "result_type text, result_message text)" % tmp_table)
+            conn.execute("insert into %s select id, job_id, status, fetch_uri, result_url, settings, "
+                         "cast(created as integer), cast(updated as integer), result_type, result_message "
+                         "from %s" % (tmp_table, self.table))
+            conn.execute("drop table %s" % self.table)
+        conn.execute("alter table %s rename to %s" % (tmp_table, self.table))
+
+        # set_task_* and remove
+        conn.execute("create index if not exists %(t)s_job_id on %(t)s (job_id)" % {'t': self.table})
+        # _tasks: only non-done rows are indexed, already in dispatch order
+        conn.execute("create index if not exists %(t)s_active on %(t)s (created, id) where status != '%(done)s'"
+                     % {'t': self.table, 'done': self.TASK_DONE})
+        # check_url_already_fetched
+        conn.execute("create index if not exists %(t)s_fetch_uri on %(t)s "
+                     "(fetch_uri, status, result_type, result_url)" % {'t': self.table})
+
+    @staticmethod
+    def _table_exists(conn, table):
+        q = "select 1 from sqlite_master where type='table' and name=?"
+        return conn.execute(q, (table,)).fetchone() is not None
+
+    def _table_has_rows(self, conn, table):
+        return self._table_exists(conn, table) and conn.execute("select 1 from %s limit 1" % table).fetchone()
+
+    def _add_column(self, conn, column, table=None):
+        # every DDL statement commits on its own, so a crashed migration may
+        # have added some of its columns already
+        table = table or self.table
+        name = column.split()[0]
+        if name not in [row[1] for row in conn.execute("PRAGMA table_info(%s)" % table)]:
+            conn.execute("alter table %s add column %s" % (table, column))
+
+    def _migration_3(self, conn):
+        """
+        Reference counts of the content addressed result files
+        """
+        conn.execute("create table if not exists %s (path text primary key, refcount integer not null, "
+                     "created integer)" % self.blob_table)
+        conn.execute("create index if not exists %(t)s_unreferenced on %(t)s (path) where refcount <= 0"
+                     % {'t': self.blob_table})
+
+    def _migration_4(self, conn):
+        """
+        Keep the host of every task, so claims can skip hosts that already
+        have enough tasks queued
+        """
+        self._add_column(conn, "host text")
+        q = "select id, fetch_uri from %s where status != '%s'" % (self.table, self.TASK_DONE)
+        rows = conn.execute(q).fetchall()
+        conn.executemany("update %s set host=? where id=?" % self.table,
+                         ((get_url_host(fetch_uri), id) for id, fetch_uri in rows))
+
+    def _migration_5(self, conn):
+        """
+        Result messages not confirmed by the broker yet
+        """
+        conn.execute("create table if not exists %s (id integer primary key, body blob not null, "
+                     "created integer)" % self.outbox_table)
+
+    def _migration_6(self, conn):
+        """
+        Failed attempts of every task and when it may run again
+        """
+        self._add_column(conn, "attempts integer not null default 0")
+        self._add_column(conn, "next_attempt_at integer not null default 0")
+
+    def _migration_7(self, conn):
+        """
+        Leases of the claimed tasks, so the tasks of a process that died
+        are found without touching any other row
+        """
+        self._add_column(conn, "lease_owner text")
+        self._add_column(conn, "lease_expires integer")
+        # claimed before leases existed, nobody is working on them any more
+        conn.execute("update %s set lease_expires=0 where status in (?, ?)" % self.table,
+                     (self.TASK_HOLD, self.TASK_RUNNING))
+        conn.execute("create index if not exists %(t)s_lease_expires on %(t)s (lease_expires) where %(leased)s"
+                     % {'t': self.table, 'leased': self._leased_clause()})
+        conn.execute("create index if not exists %(t)s_lease_owner on %(t)s (lease_owner) where %(leased)s"
+                     % {'t': self.table, 'leased': self._leased_clause()})
+
+    def _migration_8(self, conn):
+        """
+        Archive of the tasks done long ago, so the task table only holds
+        recent ones, and incremental vacuum to give the freed pages back
+        """
+        conn.execute("create table if not exists %s (id integer primary key, task_id integer, job_id text, "
+                     "fetch_uri text, result_url text, settings text, created integer, updated integer, "
+                     "result_type text, result_message text, host text, attempts integer)" % self.archive_table)
+        # check_url_already_fetched, result type inlined like the statuses
+        conn.execute("create index if not exists %(a)s_fetch_uri on %(a)s (fetch_uri) where result_type = '%(success)s'"
+                     % {'a': self.archive_table, 'success': self.RESULT_SUCCESS})
+        # archive_tasks, oldest done first
+        conn.execute("create index if not exists %(t)s_done on %(t)s (updated) where status = '%(done)s'"
+                     % {'t': self.table, 'done': self.TASK_DONE})
+
+    def _migration_9(self, conn):
+        """
+        Validators and freshness of the last response of every fetched URL
+        """
+        conn.execute("create table if not exists %s (fetch_uri text primary key, result_url text, etag text, "
+                     "last_modified text, expires integer, updated integer)" % self.http_cache_table)
+
+    def _migration_10(self, conn):
+        """
+        Node of every outbox message, so nodes sharing the database only
+        replay their own
+        """
+        self._add_column(conn, "node text", self.outbox_table)
+        # written when every node had a database of its own
+        conn.execute("update %s set node=? where node is null" % self.outbox_table, (self.node,))
+        conn.execute("create index if not exists %(o)s_node on %(o)s (node, id)" % {'o': self.outbox_table})
+
+    def _init_auto_vacuum(self, conn):
+        # free pages go back to the file with incremental vacuum, which a
+        # new file gets for free before its first table
+        if not conn.execute("select 1 from sqlite_master limit 1").fetchone():
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    def _check_auto_vacuum(self, conn):
+        """
+        An older file only switches to incremental vacuum with a full
+        VACUUM, which rewrites all of it; that's only done when asked for
+        """
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == self.INCREMENTAL_VACUUM:
+            return
+        if not self.convert_auto_vacuum:
+            log.msg("%s doesn't give free pages back, set db_convert_auto_vacuum for one start or run "
+                    "'PRAGMA auto_vacuum = INCREMENTAL; VACUUM;' on it while flowder is stopped" % self.database)
+            return
+        log.msg("Rewriting %s for incremental vacuum, this takes a while on a large file ..." % self.database)
+        start = time.time()
+        conn.commit()
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        log.msg("Rewrote %s in %.1fs" % (self.database, time.time() - start))
+
+    def _leased_clause(self):
+        # inlined the same way everywhere so sqlite matches the partial indexes
+        return "status in ('%s', '%s')" % (self.TASK_HOLD, self.TASK_RUNNING)
+
+    def runInteraction(self, func, *args, **kwargs):
+        """
+        Run `func(conn, *args, **kwargs)` and commit; returns a Deferred
+        """
+        d = defer.maybeDeferred(func, self.conn, *args, **kwargs)
+        d.addCallbacks(self._commit_result, self._rollback_result)
+        return d
+
+    def runLazyInteraction(self, func, *args, **kwargs):
+        """
+        Same as `runInteraction` for backends where the returned Deferred may
+        fire before the change is durable
+        """
+        return self.runInteraction(func, *args, **kwargs)
+
+    def runMigration(self, func, *args, **kwargs):
+        """
+        Same as `runInteraction`, for `func` committing itself or running
+        statements that can't be in a transaction
+        """
+        return self.runInteraction(func, *args, **kwargs)
+
+    def runQuery(self, q, args=()):
+        return defer.maybeDeferred(self._run_query, self.conn, q, args)
+
+    def runOperation(self, q, args=(), lazy=False):
+        run = self.runLazyInteraction if lazy else self.runInteraction
+        return run(self._run_operation, q, args)
+
+    @staticmethod
+    def _run_query(conn, q, args):
+        return conn.execute(q, args).fetchall()
+
+    @staticmethod
+    def _run_operation(conn, q, args):
+        return conn.execute(q, args).rowcount
+
+    def _commit_result(self, result):
+        self.commit()
+        return result
+
+    def _rollback_result(self, failure):
+        # what `func` ran before it raised isn't committed with the next one
+        self.conn.rollback()
+        return failure
+
+    def commit(self):
+        try:
+            self.conn.commit()
+        except Exception as e:
+            log.err(e.message)
 
-        self.conn.execute(q)
-        self._update_tasks()
+    def _send_tasks_updated(self, result, job_id, **kwargs):
+        self.signal_manager.send_catch_log(signal=signals.tasks_updated, job_id=job_id, **kwargs)
+        return result
 
     def add(self, task_info):
         task = task_info.copy()
@@ -72,55 +379,111 @@ class FileDownloaderTaskStorage(service.Service):
 
         args = (
             job_id, status,
-            fetch_uri, settings,
+            fetch_uri, get_url_host(fetch_uri), settings,
             _time, _time
         )
         q = "insert into %s (job_id, status, " \
-            "fetch_uri, settings, " \
-            "created, updated) values (?,?,?,?,?,?)" % self.table
-        self.conn.execute(q, args)
-        self.commit()
-        self._update_tasks()
-        self.signal_manager.send_catch_log(signal=signals.tasks_updated, job_id=job_id, task_info=task_info)
-
-    def commit(self):
-        try:
-            self.conn.commit()
-        except Exception as e:
-            log.err(e.message)
+            "fetch_uri, host, settings, " \
+            "created, updated) values (?,?,?,?,?,?,?)" % self.table
+        d = self.runOperation(q, args)
+        d.addCallback(self._index_tasks, [self._new_task(job_id, fetch_uri, settings)])
+        d.addCallback(self._send_tasks_updated, job_id, task_info=task_info)
+        return d
+
+    def add_many(self, tasks):
+        """
+        Insert `tasks` in one transaction and report them with a single
+        `tasks_updated` signal
+        """
+        _time = int(time.time())
+        args = [(task['job_id'], self.TASK_STANDBY,
+                 task['fetch_uri'], get_url_host(task['fetch_uri']), task['settings'],
+                 _time, _time) for task in tasks]
+        q = "insert into %s (job_id, status, " \
+            "fetch_uri, host, settings, " \
+            "created, updated) values (?,?,?,?,?,?,?)" % self.table
+        d = self.runInteraction(lambda conn: conn.executemany(q, args).rowcount)
+        d.addCallback(self._index_tasks, [self._new_task(task['job_id'], task['fetch_uri'], task['settings'])
+                                          for task in tasks])
+        d.addCallback(self._send_tasks_updated, None, count=len(args))
+        return d
+
+    def _new_task(self, job_id, fetch_uri, settings):
+        return {"job_id": str(job_id), "status": self.TASK_STANDBY, "fetch_uri": fetch_uri,
+                "host": get_url_host(fetch_uri), "result_url": None, "settings": settings,
+                "attempts": 0, "next_attempt_at": 0}
+
+    def _index_tasks(self, result, tasks):
+        for task in tasks:
+            self.tasks.add(task)
+        return result
+
+    def _unindex_task(self, result, job_id):
+        self.tasks.remove(job_id)
+        return result
 
     def remove(self, job_id):
-        q = "select id from %s where job_id=?" % self.table
-        c = self.conn.execute(q, (str(job_id),))
+        d = self.runInteraction(self._remove, job_id)
+        d.addCallback(self._forget_result)
+        d.addCallback(self._unindex_task, str(job_id))
+        d.addCallback(self._send_tasks_updated, job_id)
+        return d
+
+    def _remove(self, conn, job_id):
+        q = "select id, fetch_uri, result_url from %s where job_id=?" % self.table
+        c = conn.execute(q, (str(job_id),))
         val = c.fetchone()
         if not val:
             raise IndexError("Given job id is not valid or job doesn't exits!")
-        id = val[0]
+        id, fetch_uri, result_url = val
         q = "delete from %s where id=?" % self.table
-        c = self.conn.execute(q, (id,))
-        if not c.rowcount:  # record vanished, so let's try again
-            self.conn.rollback()
-            return self.remove(job_id)
-        self.commit()
-        self.signal_manager.send_catch_log(signal=signals.tasks_updated, job_id=job_id)
+        conn.execute(q, (id,))
+        if result_url:
+            self._add_blob_ref(conn, result_url, -1)
+            return fetch_uri
 
-    def count(self):
-        return len(self)
+    def _forget_result(self, fetch_uri):
+        # the file of the released reference may be collected soon
+        if fetch_uri is not None and self.url_cache is not None:
+            self.url_cache.discard(fetch_uri)
 
-    def _update_tasks(self):
-        self.tasks = (i for i in self._tasks())
+    def count(self):
+        """
+        Number of tasks not done yet, without counting the table
+        """
+        return self.count_active()
 
-    def __len__(self):
-        q = "select count(*) from %s" % self.table
-        return self.conn.execute(q).fetchone()[0]
+    def count_active(self):
+        """
+        Number of tasks not done yet
+        """
+        return defer.succeed(len(self.tasks))
 
-    def _tasks(self):
-        q = "select id, job_id, status,  " \
-            "fetch_uri, result_url, settings from %s WHERE status!= ? order by created asc, id asc limit 50" % \
-            self.table
-        return ({"id": id, "job_id": job_id, 'status': status,
-                 "fetch_uri": fetch_uri, "result_url": result_url, "settings": settings}
-                for id, job_id, status, fetch_uri, result_url, settings in self.conn.execute(q, (self.TASK_DONE,)))
+    def load_tasks(self, _=None):
+        """
+        Fill the task index from the table; only done once at startup
+        """
+        # as a write, so rows added meanwhile are indexed by their own add
+        # (in commit order) and not twice
+        d = self.runInteraction(self._run_query, self._tasks_query(), ())
+        d.addCallback(self._load_tasks)
+        return d
+
+    def _tasks_query(self):
+        # status is inlined so sqlite can match the partial `active` index
+        return "select id, job_id, status, fetch_uri, host, result_url, settings, attempts, next_attempt_at " \
+               "from %s WHERE status != '%s' order by created asc, id asc" % (self.table, self.TASK_DONE)
+
+    def _load_tasks(self, rows):
+        self.tasks.load({"id": id, "job_id": job_id, 'status': status, "fetch_uri": fetch_uri,
+                         "host": host if host is not None else get_url_host(fetch_uri),
+                         "result_url": result_url, "settings": settings,
+                         "attempts": attempts, "next_attempt_at": next_attempt_at}
+                        for id, job_id, status, fetch_uri, host, result_url, settings, attempts, next_attempt_at
+                        in rows)
+        log.msg("Loaded %s unfinished tasks" % len(self.tasks))
+        self._last_id = max([self._last_id] + [row[0] for row in rows])
+        self._send_tasks_updated(None, None)
 
     @staticmethod
     def encode(obj):
@@ -141,58 +504,473 @@ class FileDownloaderTaskStorage(service.Service):
         q += " WHERE job_id=?;"
 
     def set_task_running(self, job_id):
-        q = "UPDATE %s SET status=?, updated=? WHERE job_id=?;" % self.table
-        c = self.conn.execute(q, (self.TASK_RUNNING, int(time.time()), str(job_id),))
-        self.commit()
-        self.signal_manager.send_catch_log(signal=signals.tasks_updated, job_id=job_id)
+        self.tasks.set_status(str(job_id), self.TASK_RUNNING)
+        q = "UPDATE %s SET status=?, updated=? WHERE job_id=? and lease_owner=?;" % self.table
+        d = self.runOperation(q, (self.TASK_RUNNING, int(time.time()), str(job_id), self.owner), lazy=True)
+        d.addCallback(self._send_tasks_updated, job_id)
+        return d
 
     def set_task_finished(self, job_id, result_type='', result_message=''):
-        q = "UPDATE %s SET status=?, updated=?, result_type=?, result_message=? WHERE job_id=?;" % self.table
-        c = self.conn.execute(q, (
-            self.TASK_DONE, int(time.time()), str(result_type), str(result_message), str(job_id)))
-        self.commit()
-        self.signal_manager.send_catch_log(signal=signals.tasks_updated, job_id=job_id)
+        self.tasks.set_status(str(job_id), self.TASK_DONE)
+        q = "UPDATE %s SET status=?, updated=?, result_type=?, result_message=? " \
+            "WHERE job_id=? and lease_owner=?;" % self.table
+        d = self.runOperation(q, (
+            self.TASK_DONE, int(time.time()), str(result_type), str(result_message), str(job_id), self.owner),
+            lazy=True)
+        d.addCallback(self._send_tasks_updated, job_id)
+        return d
 
     def set_task_standby(self, job_id, result_type='', result_message=''):
-        q = "UPDATE %s SET status=?, updated=?, result_type=?, result_message=? WHERE job_id=?;" % self.table
-        c = self.conn.execute(q, (
-            self.TASK_STANDBY, int(time.time()), str(result_type), str(result_message), str(job_id),))
-        self.commit()
-        self.signal_manager.send_catch_log(signal=signals.tasks_updated, job_id=job_id)
+        self.tasks.set_status(str(job_id), self.TASK_STANDBY)
+        q = "UPDATE %s SET status=?, updated=?, result_type=?, result_message=? " \
+            "WHERE job_id=? and lease_owner=?;" % self.table
+        d = self.runOperation(q, (
+            self.TASK_STANDBY, int(time.time()), str(result_type), str(result_message), str(job_id), self.owner),
+            lazy=True)
+        d.addCallback(self._send_tasks_updated, job_id)
+        return d
+
+    def set_task_retry(self, job_id, next_attempt_at, result_type='', result_message=''):
+        """
+        Back to standby after a failed attempt, not to be claimed before
+        `next_attempt_at`
+        """
+        task = self.tasks.get(str(job_id))
+        attempts = task.get('attempts', 0) + 1 if task is not None else None
+        self.tasks.set_status(str(job_id), self.TASK_STANDBY, attempts=attempts, next_attempt_at=next_attempt_at)
+        q = "UPDATE %s SET status=?, updated=?, result_type=?, result_message=?, " \
+            "attempts=attempts+1, next_attempt_at=? WHERE job_id=? and lease_owner=?;" % self.table
+        d = self.runOperation(q, (
+            self.TASK_STANDBY, int(time.time()), str(result_type), str(result_message), next_attempt_at,
+            str(job_id), self.owner), lazy=True)
+        d.addCallback(self._send_tasks_updated, job_id)
+        return d
+
+    def next_due(self):
+        """
+        When the next task waiting for a retry may be claimed
+        """
+        return self.tasks.next_due()
 
     def set_task_hold(self, job_id):
-        q = "UPDATE %s SET status=?, updated=? WHERE job_id=?;" % self.table
-        c = self.conn.execute(q, (self.TASK_HOLD, int(time.time()), str(job_id),))
-        self.commit()
-        self.signal_manager.send_catch_log(signal=signals.tasks_updated, job_id=job_id)
+        self.tasks.set_status(str(job_id), self.TASK_HOLD)
+        _time = int(time.time())
+        q = "UPDATE %s SET status=?, updated=?, lease_owner=?, lease_expires=? WHERE job_id=?;" % self.table
+        d = self.runOperation(q, (self.TASK_HOLD, _time, self.owner, _time + self.lease_ttl, str(job_id),),
+                              lazy=True)
+        d.addCallback(self._send_tasks_updated, job_id)
+        return d
+
+    def claim_tasks(self, limit, exclude_hosts=(), per_host=None, queued=None):
+        """
+        Move up to `limit` standby tasks to hold in one go and return them,
+        one host after the other, skipping the tasks of `exclude_hosts`.
+        With `per_host` no more tasks of a host are taken than that, less
+        the ones `queued` counts for it.
+
+        Tasks are picked from the index and leased to this process in the
+        table. Alone on the database the index is authoritative and the
+        lease is written behind; when it's shared the claim waits for the
+        lease to run (not for the commit) and drops the tasks another
+        process took first.
+        """
+        tasks = self.tasks.claim(limit, self.TASK_HOLD, exclude_hosts, per_host, queued)
+        if not tasks:
+            return defer.succeed(tasks)
+        d = self.runLazyInteraction(self._lease_tasks, [task['job_id'] for task in tasks])
+        if not self.shared:
+            d.addErrback(lambda f: log.err("Leasing claimed tasks failed: %s" % f.getErrorMessage()))
+            return defer.succeed(tasks)
+        d.addCallbacks(self._leased, self._lease_failed, (tasks,), errbackArgs=(tasks,))
+        return d
+
+    def _lease_tasks(self, conn, job_ids):
+        _time = int(time.time())
+        leased = set()
+        for start in range(0, len(job_ids), self.MAX_STATEMENT_ARGS):
+            chunk = tuple(job_ids[start:start + self.MAX_STATEMENT_ARGS])
+            marks = ','.join('?' * len(chunk))
+            q = "UPDATE %s SET status=?, updated=?, lease_owner=?, lease_expires=? " \
+                "WHERE status=? and job_id in (%s)" % (self.table, marks)
+            conn.execute(q, (self.TASK_HOLD, _time, self.owner, _time + self.lease_ttl, self.TASK_STANDBY) + chunk)
+            if not self.shared:
+                continue
+            q = "select job_id from %s where %s and lease_owner=? and job_id in (%s)" % \
+                (self.table, self._leased_clause(), marks)
+            leased.update(job_id for job_id, in conn.execute(q, (self.owner,) + chunk))
+        return leased
+
+    def _leased(self, leased, tasks):
+        claimed = []
+        for task in tasks:
+            if task['job_id'] in leased:
+                claimed.append(task)
+            else:
+                # done or claimed by another process since we loaded it
+                self.tasks.remove(task['job_id'])
+        return claimed
+
+    def _lease_failed(self, failure, tasks):
+        for task in tasks:
+            self.tasks.set_status(task['job_id'], self.TASK_STANDBY)
+        return failure
+
+    def renew_leases(self):
+        """
+        Push back the lease expiry of every task this process holds
+        """
+        q = "UPDATE %s SET lease_expires=? WHERE %s and lease_owner=?" % (self.table, self._leased_clause())
+        d = self.runOperation(q, (int(time.time()) + self.lease_ttl, self.owner), lazy=True)
+        d.addErrback(lambda f: log.err("Renewing task leases failed: %s" % f.getErrorMessage()))
+        return d
+
+    def reap_leases(self):
+        """
+        Put the tasks whose lease expired back to standby, and pick up the
+        tasks other processes added when the database is shared
+        """
+        d = self.runLazyInteraction(self._reap_leases)
+        d.addCallback(self._reaped)
+        d.addErrback(lambda f: log.err("Reaping task leases failed: %s" % f.getErrorMessage()))
+        return d
+
+    def _reap_leases(self, conn):
+        columns = "id, job_id, fetch_uri, host, result_url, settings, attempts, next_attempt_at"
+        where = "%s and lease_expires < ? and (lease_owner is null or lease_owner != ?)" % self._leased_clause()
+        args = (int(time.time()), self.owner)
+        expired = conn.execute("select %s from %s where %s" % (columns, self.table, where), args).fetchall()
+        if expired:
+            q = "UPDATE %s SET status=?, updated=?, lease_owner=null, lease_expires=null WHERE %s" % \
+                (self.table, where)
+            conn.execute(q, (self.TASK_STANDBY, int(time.time())) + args)
+        added = []
+        if self.shared:
+            q = "select %s from %s where id > ? and status=? order by id" % (columns, self.table)
+            added = conn.execute(q, (self._last_id, self.TASK_STANDBY)).fetchall()
+        return expired, added
+
+    def _reaped(self, result):
+        expired, added = result
+        for row in expired:
+            self.tasks.add(self._standby_task(row))
+        for row in added:
+            self._last_id = max(self._last_id, row[0])
+            # tasks added by this process are indexed already
+            if row[1] not in self.tasks:
+                self.tasks.add(self._standby_task(row))
+        if expired:
+            log.msg("Requeued %s tasks with an expired lease" % len(expired))
+        if expired or added:
+            self._send_tasks_updated(None, None)
+
+    def _standby_task(self, row):
+        id, job_id, fetch_uri, host, result_url, settings, attempts, next_attempt_at = row
+        return {"id": id, "job_id": job_id, 'status': self.TASK_STANDBY, "fetch_uri": fetch_uri,
+                "host": host if host is not None else get_url_host(fetch_uri),
+                "result_url": result_url, "settings": settings,
+                "attempts": attempts, "next_attempt_at": next_attempt_at}
+
+    def release_leases(self):
+        """
+        Give the tasks held by this process back on a clean stop, only
+        its own rows are touched
+        """
+        for task in list(self.tasks):
+            if task['status'] in (self.TASK_HOLD, self.TASK_RUNNING):
+                self.tasks.set_status(task['job_id'], self.TASK_STANDBY)
+        q = "UPDATE %s SET status=?, updated=?, lease_owner=null, lease_expires=null WHERE %s and lease_owner=?" % \
+            (self.table, self._leased_clause())
+        return self.runOperation(q, (self.TASK_STANDBY, int(time.time()), self.owner))
+
+    def warm_url_cache(self, _=None):
+        """
+        Fill the Bloom filter with every fetched URL and the LRU with the
+        latest results
+        """
+        d = self.runInteraction(self._load_url_cache)
+        d.addCallback(self._warm_url_cache)
+        return d
+
+    def _load_url_cache(self, conn):
+        # runs wherever the backend runs its statements, off the reactor
+        bloom = self.url_cache.new_bloom()
+        q = "select fetch_uri from %s where status=? and result_type=? " \
+            "and result_url IS NOT NULL AND result_url != ''" % self.table
+        for url, in conn.execute(q, (self.TASK_DONE, self.RESULT_SUCCESS)):
+            bloom.add(url)
+        q = "select fetch_uri from %s where result_type = '%s' " \
+            "and result_url IS NOT NULL AND result_url != ''" % (self.archive_table, self.RESULT_SUCCESS)
+        for url, in conn.execute(q):
+            bloom.add(url)
+
+        q = "select fetch_uri, result_url from %s where status=? and result_type=? " \
+            "and result_url IS NOT NULL AND result_url != '' order by id desc limit ?" % self.table
+        latest = conn.execute(q, (self.TASK_DONE, self.RESULT_SUCCESS, self.url_cache.lru.maxsize)).fetchall()
+        return bloom, latest
+
+    def _warm_url_cache(self, result):
+        bloom, latest = result
+        self.url_cache.warm_up(bloom, reversed(latest))
+        log.msg("URL cache warmed up with %s fetched URLs" % bloom.count)
 
     def check_url_already_fetched(self, url):
-        output = None
+        if self.url_cache is not None:
+            try:
+                result_url = self.url_cache.get(url)
+            except KeyError:
+                pass
+            else:
+                if result_url is None:
+                    return defer.succeed(None)
+                return defer.succeed({'fetch_uri': url, 'result_url': result_url})
+
         q = "SELECT * from %s where fetch_uri=? and status=? and result_type=? and result_url IS NOT NULL AND result_url != '' LIMIT 1" \
             % self.table
-        result = self.conn.execute(q, (url, self.TASK_DONE, self.RESULT_SUCCESS)).fetchone()
-        if result:
+        d = self.runQuery(q, (url, self.TASK_DONE, self.RESULT_SUCCESS))
+        d.addCallback(self._check_archived_url, url)
+        d.addCallback(self._parse_fetched_url)
+        if self.url_cache is not None:
+            d.addCallback(self._cache_fetched_url, url)
+        return d
+
+    def _check_archived_url(self, rows, url):
+        if rows:
+            return rows
+        # same columns as the task table
+        q = "SELECT task_id, job_id, '%s', fetch_uri, result_url, settings, created, updated, result_type, " \
+            "result_message from %s where fetch_uri=? and result_type = '%s' " \
+            "and result_url IS NOT NULL AND result_url != '' order by id desc LIMIT 1" % \
+            (self.TASK_DONE, self.archive_table, self.RESULT_SUCCESS)
+        return self.runQuery(q, (url,))
+
+    def _cache_fetched_url(self, output, url):
+        if output:
+            self.url_cache.set(url, output['result_url'])
+        return output
+
+    @staticmethod
+    def _parse_fetched_url(rows):
+        output = None
+        if rows:
             keys = [
                 'id', 'job_id', 'status', 'fetch_uri',
                 'result_url', 'settings', 'created',
                 'updated', 'result_type', 'result_message'
             ]
-            output = dict(zip(keys, result))
+            output = dict(zip(keys, rows[0]))
 
         return output
 
-    def set_jobid_result_url(self, job_id, url):
+    def set_jobid_result_url(self, job_id, url, fetch_uri=None):
+        if fetch_uri is not None and self.url_cache is not None:
+            self.url_cache.set(fetch_uri, url)
         q = "UPDATE %s SET result_url=?  WHERE job_id=?;" % self.table
-        self.conn.execute(q, (str(url), str(job_id),))
-        self.commit()
-        self.signal_manager.send_catch_log(signal=signals.tasks_updated, job_id=job_id)
+        d = self.runOperation(q, (str(url), str(job_id),), lazy=True)
+        d.addCallback(self._send_tasks_updated, job_id)
+        return d
+
+    def get_http_cache(self, url):
+        """
+        The cached response of `url`: its result file, validators and until
+        when it's fresh; None when there's none
+        """
+        # only fetched URLs have one
+        if self.url_cache is not None and not self.url_cache.maybe_fetched(url):
+            return defer.succeed(None)
+        q = "select result_url, etag, last_modified, expires from %s where fetch_uri=?" % self.http_cache_table
+        d = self.runQuery(q, (url,))
+        d.addCallback(self._parse_http_cache)
+        return d
+
+    @staticmethod
+    def _parse_http_cache(rows):
+        if not rows:
+            return None
+        return dict(zip(('result_url', 'etag', 'last_modified', 'expires'), rows[0]))
+
+    def set_http_cache(self, url, result_url, etag=None, last_modified=None, expires=0):
+        """
+        Keep the response of `url`, which was stored as `result_url`. The
+        cache holds a reference to that file as long as it points to it.
+        """
+        return self.runLazyInteraction(self._set_http_cache, url, result_url, etag, last_modified, int(expires))
+
+    def _set_http_cache(self, conn, url, result_url, etag, last_modified, expires):
+        # the row is written first so the previous file is read under its
+        # lock, and concurrent updates count refs from each other's file
+        self._add_http_cache_row(conn, url)
+        previous = self._lock_http_cache_row(conn, url)
+        conn.execute("update %s set result_url=?, etag=?, last_modified=?, expires=?, updated=? where fetch_uri=?"
+                     % self.http_cache_table, (result_url, etag, last_modified, expires, int(time.time()), url))
+        if previous != result_url:
+            self._add_blob_ref(conn, result_url, 1)
+            if previous:
+                self._add_blob_ref(conn, previous, -1)
+
+    def _add_http_cache_row(self, conn, url):
+        conn.execute("insert or ignore into %s (fetch_uri) values (?)" % self.http_cache_table, (url,))
+
+    def _lock_http_cache_row(self, conn, url):
+        # sqlite has a single writer, the insert took the lock already
+        return conn.execute("select result_url from %s where fetch_uri=?" % self.http_cache_table,
+                            (url,)).fetchone()[0]
+
+    def add_blob_ref(self, path, link=None):
+        """
+        Count one more task referencing the result file `path`.
+
+        `link` is called right before, in the same transaction, to put the
+        file in place, so it can't race with `collect_blobs`.
+        """
+        return self.runLazyInteraction(self._add_blob_ref, path, 1, link)
+
+    def release_blob_ref(self, path):
+        return self.runLazyInteraction(self._add_blob_ref, path, -1)
+
+    def _add_blob_ref(self, conn, path, step, link=None):
+        if link is not None:
+            link()
+        conn.execute("insert or ignore into %s (path, refcount, created) values (?, 0, ?)" % self.blob_table,
+                     (path, int(time.time())))
+        conn.execute("update %s set refcount=refcount + ? where path=?" % self.blob_table, (step, path))
+
+    def collect_blobs(self, unlink, limit=1000):
+        """
+        Call `unlink` for, and forget, up to `limit` files no task references.
+        Returns the number of collected files.
+        """
+        return self.runInteraction(self._collect_blobs, unlink, limit)
+
+    def _collect_blobs(self, conn, unlink, limit):
+        q = "select path from %s where refcount <= 0 limit ?" % self.blob_table
+        paths = [row[0] for row in conn.execute(q, (limit,)).fetchall()]
+        for path in paths:
+            unlink(path)
+            conn.execute("delete from %s where path=?" % self.blob_table, (path,))
+        return len(paths)
+
+    def outbox_add(self, bodies):
+        """
+        Keep outgoing messages until `outbox_remove`; returns their ids.
+        Like the task status updates, this fires before the commit.
+        """
+        return self.runLazyInteraction(self._outbox_add, bodies)
+
+    def _outbox_add(self, conn, bodies):
+        q = "insert into %s (body, created, node) values (?, ?, ?)" % self.outbox_table
+        _time = int(time.time())
+        return [conn.execute(q, (sqlite3.Binary(body), _time, self.node)).lastrowid for body in bodies]
+
+    def outbox_remove(self, ids):
+        q = "delete from %s where id=?" % self.outbox_table
+        return self.runLazyInteraction(lambda conn: conn.executemany(q, ((id,) for id in ids)).rowcount)
+
+    def outbox_pending(self):
+        """
+        Every message of this node still in the outbox, oldest first
+        """
+        d = self.runQuery("select id, body from %s where node=? order by id" % self.outbox_table, (self.node,))
+        d.addCallback(lambda rows: [(id, bytes(body)) for id, body in rows])
+        return d
+
+    def archive_tasks(self, before, limit=1000):
+        """
+        Move up to `limit` tasks done before the `before` timestamp to the
+        archive table in one transaction; returns how many were moved
+        """
+        return self.runInteraction(self._archive_tasks, before, limit)
+
+    def _archive_tasks(self, conn, before, limit):
+        # the newest row stays, sqlite would give its id out again
+        q = "select id from %(t)s where status = '%(done)s' and updated < ? and id < (select max(id) from %(t)s) " \
+            "order by updated limit ?" % {'t': self.table, 'done': self.TASK_DONE}
+        ids = [id for id, in conn.execute(q, (before, limit)).fetchall()]
+        columns = "job_id, fetch_uri, result_url, settings, created, updated, result_type, result_message, " \
+                  "host, attempts"
+        for start in range(0, len(ids), self.MAX_STATEMENT_ARGS):
+            chunk = tuple(ids[start:start + self.MAX_STATEMENT_ARGS])
+            marks = ','.join('?' * len(chunk))
+            conn.execute("insert into %s (task_id, %s) select id, %s from %s where id in (%s)"
+                         % (self.archive_table, columns, columns, self.table, marks), chunk)
+            conn.execute("delete from %s where id in (%s)" % (self.table, marks), chunk)
+        return len(ids)
+
+    def vacuum(self, pages=1000):
+        """
+        Give up to `pages` free pages of the database file back to the file
+        system; returns how many were
+        """
+        return self.runInteraction(self._vacuum, pages)
+
+    def _vacuum(self, conn, pages):
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # only runs to the end once every row is fetched
+        conn.execute("PRAGMA incremental_vacuum(%d)" % pages).fetchall()
+        return free - conn.execute("PRAGMA freelist_count").fetchone()[0]
 
     def reset_all_tasks(self):
         """
         Update status
         """
+        self.tasks.set_all(self.TASK_STANDBY)
         q = "UPDATE %s SET status=?, updated=? WHERE status!=?" % self.table
         args = (self.TASK_STANDBY, int(time.time()), self.TASK_DONE)
-        c = self.conn.execute(q, args, )
-        self.commit()
-        return c.rowcount
+        return self.runOperation(q, args)
+
+
+class ThreadedTaskStorage(FileDownloaderTaskStorage):
+    """
+    Same task storage, but every statement runs on a dedicated SQLite writer
+    thread and writes are group committed, so the reactor never waits on
+    disk. All the public methods return Deferreds.
+
+    New tasks are only reported once committed. Status transitions report
+    back as soon as they ran: after a crash they are at most one commit
+    interval behind, and such tasks are simply run again.
+    """
+
+    def __init__(self, app, database=None, table="task_list", commit_interval=0.05, commit_size=100,
+                 url_cache=None, owner=None, lease_ttl=60, shared=False, convert_auto_vacuum=False, node=None):
+        FileDownloaderTaskStorage.__init__(self, app, database, table, url_cache, owner, lease_ttl, shared,
+                                           convert_auto_vacuum, node)
+        self.commit_interval = commit_interval
+        self.commit_size = commit_size
+        self.writer = None
+
+    @classmethod
+    def from_config(cls, app, config, database=None, url_cache=None, owner=None, node=None):
+        return cls(app, database,
+                   commit_interval=config.getint('db_commit_interval', 50) / 1000.0,  # in milliseconds
+                   commit_size=config.getint('db_commit_size', 100),
+                   url_cache=url_cache, owner=owner,
+                   lease_ttl=config.getint('lease_ttl', 60),
+                   shared=config.getboolean('db_shared', False),
+                   convert_auto_vacuum=config.getboolean('db_convert_auto_vacuum', False), node=node)
+
+    def create_connection(self):
+        self.writer = SQLiteWriter(self.database, self.commit_interval, self.commit_size)
+        self.writer.start()
+        self.ready = True
+
+    def stopService(self):
+        FileDownloaderTaskStorage.stopService(self)
+        self.ready = False
+        if self.writer is not None:
+            log.msg("Flushing pending database writes ...")
+            return self.writer.stop()
+
+    def runInteraction(self, func, *args, **kwargs):
+        return self.writer.write(func, *args, **kwargs)
+
+    def runLazyInteraction(self, func, *args, **kwargs):
+        return self.writer.execute(func, *args, **kwargs)
+
+    def runMigration(self, func, *args, **kwargs):
+        return self.writer.exclusive(func, *args, **kwargs)
+
+    def runQuery(self, q, args=()):
+        return self.writer.read(self._run_query, q, args)
+
+    def commit(self):
+        # group commits are handled by the writer thread
+        pass
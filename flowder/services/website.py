@@ -19,6 +19,7 @@ class Root(resource.Resource):
 
         self.putChild('', Home(self))
         self.putChild('jobs', Jobs(self))
+        self.putChild('metrics', Metrics(self))
         self.putChild(static_serve_path, File(storage_path))
 
         services = config.items('services', ())
@@ -28,7 +29,11 @@ class Root(resource.Resource):
 
     def request_permitted(self, request):
         # @TODO log not permitted requests
-        return request.getClientIP() in self.app.trusted_clients.keys()
+        return request.getClientIP() in self.trusted_clients
+
+    @property
+    def trusted_clients(self):
+        return self.IApp.getServiceNamed('trusted_clients')
 
     @property
     def launcher(self):
@@ -38,6 +43,10 @@ class Root(resource.Resource):
     def scheduler(self):
         return self.IApp.getServiceNamed('scheduler')
 
+    @property
+    def metrics(self):
+        return self.IApp.getServiceNamed('metrics')
+
     @property
     def poller(self):
         app = IServiceCollection(self.app, self.app)
@@ -60,3 +69,18 @@ class Jobs(resource.Resource):
 
     def render(self, txrequest):
         raise NotImplementedError()
+
+
+class Metrics(resource.Resource):
+    """
+    Application metrics in the Prometheus text format
+    """
+    isLeaf = True
+
+    def __init__(self, root):
+        resource.Resource.__init__(self)
+        self.root = root
+
+    def render_GET(self, txrequest):
+        txrequest.setHeader('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        return self.root.metrics.render()
@@ -5,4 +5,12 @@ Flowder internal signals
 request_received = object()
 request_added = object()
 tasks_updated = object()
-namespace_updated = object()
\ No newline at end of file
+namespace_updated = object()
+# job_id, result ('success', 'failed' or 'retry'), elapsed
+job_finished = object()
+# url, elapsed, size
+fetch_finished = object()
+# message
+message_published = object()
+# trace, stage timings of a job as exported by flowder.tracing
+job_traced = object()
@@ -0,0 +1,172 @@
+import os
+import sys
+import socket
+import signal
+from multiprocessing import cpu_count
+
+from twisted.application import service
+from twisted.internet import defer, reactor, protocol, task
+from twisted.internet.error import ProcessExitedAlready
+
+from pygear.logging import log
+
+
+WORKER_ID_ENV = 'FLOWDER_WORKER_ID'
+REST_FD_ENV = 'FLOWDER_REST_FD'
+# where workers find the shared REST socket
+REST_CHILD_FD = 3
+
+
+def get_worker_id():
+    """
+    Index of this worker process, or None when not started by a supervisor
+    """
+    worker_id = os.environ.get(WORKER_ID_ENV)
+    return int(worker_id) if worker_id is not None else None
+
+
+def get_workers(config):
+    workers = config.getint('workers', 1)
+    if not workers:
+        try:
+            workers = cpu_count()
+        except NotImplementedError:
+            workers = 1
+    return workers
+
+
+class AdoptedTCPServer(service.Service):
+    """
+    Serves `factory` on a listening socket inherited from the supervisor
+    """
+
+    def __init__(self, fd, factory):
+        self.fd = fd
+        self.factory = factory
+        self._port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self._port = reactor.adoptStreamPort(self.fd, socket.AF_INET, self.factory)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._port is not None:
+            return self._port.stopListening()
+
+
+class WorkerMonitor(service.Service):
+    """
+    Keeps a worker apart from the terminal's signals, which go to the
+    supervisor, and shuts it down if the supervisor goes away.
+    """
+    name = 'worker_monitor'
+
+    def __init__(self, check_interval=5):
+        self.check_interval = check_interval
+        self.parent_pid = None
+        self._check = None
+
+    def startService(self):
+        service.Service.startService(self)
+        os.setpgrp()
+        self.parent_pid = os.getppid()
+        self._check = task.LoopingCall(self.check_parent)
+        self._check.start(self.check_interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._check is not None and self._check.running:
+            self._check.stop()
+
+    def check_parent(self):
+        if os.getppid() != self.parent_pid:
+            log.err("Supervisor %s is gone, shutting down" % self.parent_pid)
+            self._check.stop()
+            # same path as a TERM sent by the supervisor
+            os.kill(os.getpid(), signal.SIGTERM)
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+
+    def __init__(self, supervisor, worker_id):
+        self.supervisor = supervisor
+        self.worker_id = worker_id
+        self.ended = defer.Deferred()
+
+    def connectionMade(self):
+        log.msg("Worker %s started, pid %s" % (self.worker_id, self.transport.pid))
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+        self.supervisor.worker_ended(self, reason)
+
+
+class WorkerSupervisor(service.Service):
+    """
+    Runs `workers` flowder processes, each with its own reactor, launcher
+    slots and database shard, and restarts them when they die.
+
+    The REST socket is bound once here and shared by every worker; jobs
+    coming from AMQP are spread between the workers by the broker.
+    """
+    name = 'supervisor'
+
+    def __init__(self, config, workers):
+        self.workers = workers
+        self.rest_port = config.getint('rest_port', 4000)
+        self.rest_bind = config.get('rest_bind', '0.0.0.0')
+        self.restart_delay = config.getfloat('worker_restart_delay', 1)
+        self.processes = {}
+        self.socket = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.rest_bind, self.rest_port))
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(False)
+
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+
+    def spawn(self, worker_id):
+        env = os.environ.copy()
+        env[WORKER_ID_ENV] = str(worker_id)
+        env[REST_FD_ENV] = str(REST_CHILD_FD)
+        # every worker runs in the foreground without a pid file of its own
+        args = [sys.executable, '-m', 'flowder.cli', '--pidfile=']
+        process = WorkerProcess(self, worker_id)
+        reactor.spawnProcess(process, sys.executable, args, env=env,
+                             childFDs={0: 0, 1: 1, 2: 2, REST_CHILD_FD: self.socket.fileno()})
+        self.processes[worker_id] = process
+
+    def worker_ended(self, process, reason):
+        if self.processes.get(process.worker_id) is not process:
+            return
+        del self.processes[process.worker_id]
+        if self.running:
+            log.err("Worker %s died: %s, restarting" % (process.worker_id, reason.getErrorMessage()))
+            reactor.callLater(self.restart_delay, self._respawn, process.worker_id)
+
+    def _respawn(self, worker_id):
+        if self.running and worker_id not in self.processes:
+            self.spawn(worker_id)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        processes = list(self.processes.values())
+        for process in processes:
+            try:
+                process.transport.signalProcess(signal.SIGTERM)
+            except ProcessExitedAlready:
+                pass
+        d = defer.DeferredList([process.ended for process in processes])
+        d.addBoth(self._close_socket)
+        return d
+
+    def _close_socket(self, _):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
@@ -0,0 +1,168 @@
+import time
+import heapq
+from collections import OrderedDict
+
+
+class TaskIndex(object):
+    """
+    In-memory index of the tasks that are not done yet.
+
+    Tasks are kept in creation order, standby ones also per host so they
+    can be handed out round-robin across hosts without scanning the tasks
+    of hosts that are excluded. Standby tasks with a `next_attempt_at` in
+    the future wait in a heap until they are due. It's filled from the
+    database once at startup and then kept up to date by the storage on
+    every change.
+    """
+
+    def __init__(self, standby_status='S', done_status='D', clock=time.time):
+        self.standby_status = standby_status
+        self.done_status = done_status
+        self.clock = clock
+        self.tasks = OrderedDict()
+        self.standby = OrderedDict()
+        # job_id -> next_attempt_at of the standby tasks not due yet
+        self.delayed = {}
+        self._due = []
+        self.counts = {}
+        self.loaded = False
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, job_id):
+        return job_id in self.tasks
+
+    def __iter__(self):
+        return iter(self.tasks.values())
+
+    def get(self, job_id):
+        return self.tasks.get(job_id)
+
+    def count(self, status):
+        return self.counts.get(status, 0)
+
+    def load(self, tasks):
+        """
+        Add `tasks` read from the database, oldest first. Tasks indexed
+        already are more recent than their row and are kept as they are.
+        """
+        for task in tasks:
+            if task['job_id'] not in self.tasks:
+                self.add(task)
+        self.loaded = True
+
+    def add(self, task):
+        if task['status'] == self.done_status:
+            return
+        self.remove(task['job_id'])
+        self.tasks[task['job_id']] = task
+        self._link(task)
+
+    def remove(self, job_id):
+        task = self.tasks.pop(job_id, None)
+        if task is not None:
+            self._unlink(task)
+        return task
+
+    def set_status(self, job_id, status, **fields):
+        task = self.tasks.get(job_id)
+        if task is None:
+            return
+        if status == self.done_status:
+            self.remove(job_id)
+            return
+        self._unlink(task)
+        task['status'] = status
+        task.update(fields)
+        self._link(task)
+
+    def set_all(self, status):
+        for task in list(self.tasks.values()):
+            self.set_status(task['job_id'], status)
+
+    def next_due(self):
+        """
+        When the next delayed task is due, None without delayed tasks
+        """
+        while self._due and self.delayed.get(self._due[0][1]) != self._due[0][0]:
+            heapq.heappop(self._due)
+        return self._due[0][0] if self._due else None
+
+    def _promote_due(self):
+        now = self.clock()
+        while self._due and self._due[0][0] <= now:
+            due, job_id = heapq.heappop(self._due)
+            if self.delayed.get(job_id) == due:
+                del self.delayed[job_id]
+                self._queue(self.tasks[job_id])
+
+    def claim(self, limit, status, exclude_hosts=(), per_host=None, queued=None):
+        """
+        Move up to `limit` due standby tasks to `status` and return them,
+        one host after the other. Hosts that gave a task move to the back.
+        With `per_host` a host gives at most that many tasks, less the ones
+        `queued` counts for it already.
+        """
+        self._promote_due()
+        queued = queued or {}
+        room = {}
+        claimed = []
+        while len(claimed) < limit and self.standby:
+            hosts = []
+            for host in self.standby:
+                if host in exclude_hosts:
+                    continue
+                if per_host is not None:
+                    if host not in room:
+                        room[host] = per_host - queued.get(host, 0)
+                    if room[host] <= 0:
+                        continue
+                hosts.append(host)
+                if len(hosts) + len(claimed) >= limit:
+                    break
+            if not hosts:
+                break
+            for host in hosts:
+                queue = self.standby.pop(host)
+                job_id, task = queue.popitem(last=False)
+                if queue:
+                    self.standby[host] = queue
+                if per_host is not None:
+                    room[host] -= 1
+                self.counts[self.standby_status] -= 1
+                task['status'] = status
+                self.counts[status] = self.counts.get(status, 0) + 1
+                claimed.append(task)
+        return claimed
+
+    def _link(self, task):
+        status = task['status']
+        self.counts[status] = self.counts.get(status, 0) + 1
+        if status == self.standby_status:
+            due = task.get('next_attempt_at') or 0
+            if due > self.clock():
+                self.delayed[task['job_id']] = due
+                heapq.heappush(self._due, (due, task['job_id']))
+            else:
+                self._queue(task)
+
+    def _queue(self, task):
+        host = task.get('host') or ''
+        queue = self.standby.get(host)
+        if queue is None:
+            queue = self.standby[host] = OrderedDict()
+        queue[task['job_id']] = task
+
+    def _unlink(self, task):
+        status = task['status']
+        self.counts[status] -= 1
+        if self.delayed.pop(task['job_id'], None) is not None:
+            return
+        if status == self.standby_status:
+            host = task.get('host') or ''
+            queue = self.standby.get(host)
+            if queue is not None:
+                queue.pop(task['job_id'], None)
+                if not queue:
+                    del self.standby[host]
@@ -0,0 +1,130 @@
+import json
+import time
+import random
+
+from twisted.internet import defer
+
+from flowder import signals
+
+
+class Trace(object):
+    """
+    Timings of the stages of one job. A stage lasts from its call until
+    the Deferred it returned fired, stages may overlap.
+    """
+
+    def __init__(self, job_id, clock=time.time):
+        self.job_id = job_id
+        self.clock = clock
+        self.start = clock()
+        # (stage, start offset, duration)
+        self.spans = []
+
+    def track(self, stage, d):
+        """
+        Time the Deferred `d` of `stage`, started now; returns `d`
+        """
+        d.addBoth(self._ended, stage, self.clock())
+        return d
+
+    def wrap(self, stage, func):
+        """
+        `func` timed as `stage` every time it's called
+        """
+        def traced(*args, **kwargs):
+            start = self.clock()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                self._ended(None, stage, start)
+                raise
+            if isinstance(result, defer.Deferred):
+                return result.addBoth(self._ended, stage, start)
+            return self._ended(result, stage, start)
+        return traced
+
+    def _ended(self, result, stage, start):
+        self.spans.append((stage, start - self.start, self.clock() - start))
+        return result
+
+    def to_dict(self, **fields):
+        record = {'job_id': self.job_id, 'start': self.start, 'duration': self.clock() - self.start,
+                  'stages': [{'stage': stage, 'start': offset, 'duration': duration}
+                             for stage, offset, duration in self.spans]}
+        record.update(fields)
+        return record
+
+
+class NullTrace(object):
+    """
+    Trace of a job that isn't sampled
+    """
+    spans = ()
+
+    def track(self, stage, d):
+        return d
+
+    def wrap(self, stage, func):
+        return func
+
+
+NULL_TRACE = NullTrace()
+
+
+class Tracer(object):
+    """
+    Starts a trace for `sample_rate` of the jobs and hands the finished
+    ones to every exporter
+    """
+
+    def __init__(self, exporters=(), sample_rate=1.0, clock=time.time):
+        self.exporters = list(exporters)
+        self.sample_rate = sample_rate
+        self.clock = clock
+
+    def start(self, job_id):
+        if not self.exporters or random.random() >= self.sample_rate:
+            return NULL_TRACE
+        return Trace(job_id, self.clock)
+
+    def finish(self, trace, **fields):
+        if trace is NULL_TRACE:
+            return
+        record = trace.to_dict(**fields)
+        for exporter in self.exporters:
+            exporter.export(record)
+
+    def close(self):
+        for exporter in self.exporters:
+            exporter.close()
+
+
+class JSONLinesExporter(object):
+    """
+    Appends every trace to `path`, one JSON object per line
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+
+    def export(self, record):
+        self.file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class SignalExporter(object):
+    """
+    Sends every trace as `signals.job_traced`, for consumers in the process
+    """
+
+    def __init__(self, signal_manager):
+        self.signal_manager = signal_manager
+
+    def export(self, record):
+        self.signal_manager.send_catch_log(signal=signals.job_traced, trace=record)
+
+    def close(self):
+        pass
@@ -8,6 +8,7 @@ from twisted.names import client
 from pygear.logging import log
 from pygear.core.six.moves.urllib.parse import urlparse, urljoin
 
+from .acl import TrustedClients
 from .interfaces import ITaskStorage
 
 csv.register_dialect('pipes', delimiter='|')
@@ -16,6 +17,7 @@ default_scheme = 'http'
 
 client_scheme_re = re.compile(r'^(%s)' % '|'.join(client_callback_schemes))
 ip_re = re.compile(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$")
+cidr_re = re.compile(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}/\d{1,2}$")
 ip_scheme_re = re.compile(r"^(%s)://(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})" % '|'.join(client_callback_schemes))
 
 
@@ -25,7 +27,7 @@ def get_tasks_db(config, app):
 
 def prepare_url(url):
     if not client_scheme_re.match(url):
-        url = default_scheme + url
+        url = '%s://%s' % (default_scheme, url)
     return url
 
 
@@ -35,42 +37,67 @@ def get_interface_ip(eth):
 
 
 @defer.inlineCallbacks
-def parse_clients_list(file_path):
+def parse_clients_list(file_path, resolver=client):
+    """
+    Read the `host|user|pass` rows of `file_path` into a TrustedClients.
+    Hosts are IPs, `a.b.c.d/n` networks or names resolved with `resolver`.
+    """
     trusted_clients = None
     # @TODO create a service to read trusted clients from DB
     try:
         trusted_clients = open(file_path, 'r').readlines()
         trusted_clients = map(lambda c: c.replace('\n', ''), trusted_clients)
     except IOError:
-        _clients = []
         log.warn("Trusted clinets list not found.")
 
-    clients_list = {}
+    clients_list = TrustedClients()
+    names = []
     if trusted_clients:
         for row in csv.reader(trusted_clients, dialect='pipes', quotechar='!'):
+            if not row:
+                continue
             _host, _user, _pass = row
-            if ip_re.match(_host):
-                _ip = _host
+            details = {'host': _host, 'user': _user, 'pass': _pass}
+            if ip_re.match(_host) or cidr_re.match(_host):
+                clients_list.add(_host, details)
             else:
-                _host = prepare_url(_host)
-                parsed_url = urlparse(_host)
-                _ip = yield client.getHostByName(parsed_url.netloc)
-
-            clients_list[_ip] = {'host': _host, 'user': _user, 'pass': _pass}
-        defer.returnValue(clients_list)
-
-
-def get_callback_auth_details(url, trusted_clients):
-    match = ip_scheme_re.match(url)
-    if not match or len(match.groups()) < 2:
-        ip = client.getHostByName(url)
-    else:
-        scheme, ip = match.groups()
-
-    for client_ip, details in trusted_clients.iteritems():
-        if ip == client_ip:
-            return details['user'], details['pass']
-    return None
+                hostname = urlparse(prepare_url(_host)).hostname
+                clients_list.add_host(hostname, details)
+                names.append((hostname, details))
+
+    results = yield defer.DeferredList([resolver.getHostByName(hostname) for hostname, _ in names],
+                                       consumeErrors=True)
+    for (hostname, details), (success, result) in zip(names, results):
+        if success:
+            clients_list.add(result, details)
+        else:
+            log.err("Trusted client %s not resolved: %s" % (hostname, result.getErrorMessage()))
+    defer.returnValue(clients_list)
+
+
+def get_callback_auth_details(url, trusted_clients, resolver=client):
+    """
+    Deferred firing with the `(user, pass)` of the trusted client `url`
+    points to, or None. Clients known by name don't need a DNS lookup.
+    """
+    hostname = urlparse(prepare_url(url)).hostname
+    if not hostname:
+        return defer.succeed(None)
+    details = trusted_clients.get_host(hostname)
+    if details is None and ip_re.match(hostname):
+        details = trusted_clients.get(hostname)
+    if details is not None or ip_re.match(hostname):
+        return defer.succeed(_auth_details(details))
+
+    d = resolver.getHostByName(hostname)
+    d.addCallback(lambda ip: _auth_details(trusted_clients.get(ip)))
+    return d
+
+
+def _auth_details(details):
+    if details is None:
+        return None
+    return details['user'], details['pass']
 
 
 def get_serve_uri(config):
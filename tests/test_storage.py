@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_storage
+----------------------------------
+
+The same tests against every task storage backend. PostgreSQL runs when
+psycopg2 is installed and FLOWDER_TEST_POSTGRES_DSN points to a database
+the tests may create and drop tables in.
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import pytest
+
+pytest.importorskip('twisted')
+pytest.importorskip('pygear')
+
+from twisted.application.service import Application
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from pygear.twisted.interfaces import ISignalManager
+from pygear.twisted.signal import SignalManager
+
+from flowder.cache import URLResultCache
+from flowder.exceptions import WriterStopped
+from flowder.services.storage import FileDownloaderTaskStorage, ThreadedTaskStorage
+from flowder.services.sqlstorage import AdbapiTaskStorage
+
+
+def new_tasks(count, host='example.com'):
+    return [{'job_id': 'job%s' % i, 'fetch_uri': 'http://%s/%s' % (host, i), 'settings': '{}'}
+            for i in range(count)]
+
+
+class StorageTests(object):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        app = Application("test")
+        app.setComponent(ISignalManager, SignalManager())
+        self.storage = self.create_storage(app)
+        self.storage.setServiceParent(app)
+        yield self.storage.startService()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.storage.stopService()
+        shutil.rmtree(self.tmp_dir)
+
+    def create_storage(self, app, shared=False):
+        raise NotImplementedError
+
+    @defer.inlineCallbacks
+    def start_shared_storage(self):
+        # another process on the same database
+        app = Application("shared")
+        app.setComponent(ISignalManager, SignalManager())
+        storage = self.create_storage(app, shared=True)
+        storage.node = "other-node"
+        storage.url_cache = URLResultCache(maxsize=10, capacity=100)
+        yield storage.startService()
+        self.addCleanup(storage.stopService)
+        defer.returnValue(storage)
+
+    @defer.inlineCallbacks
+    def test_add_and_count(self):
+        yield self.storage.add(new_tasks(1)[0])
+        yield self.storage.add_many(new_tasks(3)[1:])
+        self.assertEqual((yield self.storage.count()), 3)
+        self.assertEqual((yield self.storage.count_active()), 3)
+
+    @defer.inlineCallbacks
+    def test_claim_holds_tasks_once(self):
+        yield self.storage.add_many(new_tasks(5))
+        first = yield self.storage.claim_tasks(3)
+        second = yield self.storage.claim_tasks(3)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        claimed = first + second
+        self.assertEqual(sorted(task['job_id'] for task in claimed), ['job%s' % i for i in range(5)])
+        self.assertEqual(set(task['status'] for task in claimed), set([self.storage.TASK_HOLD]))
+        self.assertEqual((yield self.storage.claim_tasks(3)), [])
+
+    @defer.inlineCallbacks
+    def test_claim_skips_excluded_hosts(self):
+        yield self.storage.add_many(new_tasks(2, 'a.example.com') + [
+            {'job_id': 'other', 'fetch_uri': 'http://b.example.com/', 'settings': '{}'}])
+        claimed = yield self.storage.claim_tasks(10, exclude_hosts=['a.example.com'])
+        self.assertEqual([task['job_id'] for task in claimed], ['other'])
+
+    @defer.inlineCallbacks
+    def test_claim_caps_tasks_per_host(self):
+        yield self.storage.add_many(new_tasks(4, 'a.example.com') + [
+            {'job_id': 'b%s' % i, 'fetch_uri': 'http://b.example.com/%s' % i, 'settings': '{}'} for i in range(2)])
+        claimed = yield self.storage.claim_tasks(10, per_host=2, queued={'a.example.com': 1})
+        self.assertEqual(sorted(task['job_id'] for task in claimed), ['b0', 'b1', 'job0'])
+
+    @defer.inlineCallbacks
+    def test_finished_task_is_not_claimed_again(self):
+        yield self.storage.add_many(new_tasks(1))
+        claimed = yield self.storage.claim_tasks(1)
+        yield self.storage.set_task_running(claimed[0]['job_id'])
+        yield self.storage.set_task_finished(claimed[0]['job_id'], self.storage.RESULT_SUCCESS)
+        self.assertEqual((yield self.storage.claim_tasks(1)), [])
+        self.assertEqual((yield self.storage.count_active()), 0)
+
+    @defer.inlineCallbacks
+    def test_retry_waits_until_due(self):
+        yield self.storage.add_many(new_tasks(1))
+        claimed = yield self.storage.claim_tasks(1)
+        yield self.storage.set_task_retry(claimed[0]['job_id'], 2 ** 31 - 1, self.storage.RESULT_RETRY, 'timeout')
+        self.assertEqual((yield self.storage.claim_tasks(1)), [])
+        self.assertEqual(self.storage.next_due(), 2 ** 31 - 1)
+
+    @defer.inlineCallbacks
+    def test_expired_lease_is_reaped(self):
+        yield self.storage.add_many(new_tasks(1))
+        yield self.storage.claim_tasks(1)
+        # held by a process that died
+        yield self.storage.runOperation("update %s set lease_owner=?, lease_expires=0" % self.storage.table,
+                                        ('dead',))
+        yield self.storage.reap_leases()
+        self.assertEqual(len((yield self.storage.claim_tasks(1))), 1)
+
+    @defer.inlineCallbacks
+    def test_restart_reaps_previous_leases(self):
+        yield self.storage.add_many(new_tasks(1))
+        yield self.storage.claim_tasks(1)
+        # the process dies holding the task and comes back with the same pid
+        yield self.storage.stopService()
+        app = Application("restarted")
+        app.setComponent(ISignalManager, SignalManager())
+        self.storage = self.create_storage(app)
+        yield self.storage.startService()
+        yield self.storage.runOperation("update %s set lease_expires=0" % self.storage.table)
+        yield self.storage.reap_leases()
+        self.assertEqual(len((yield self.storage.claim_tasks(1))), 1)
+
+    @defer.inlineCallbacks
+    def test_release_leases(self):
+        yield self.storage.add_many(new_tasks(2))
+        yield self.storage.claim_tasks(2)
+        yield self.storage.release_leases()
+        self.assertEqual(len((yield self.storage.claim_tasks(2))), 2)
+
+    @defer.inlineCallbacks
+    def test_remove(self):
+        yield self.storage.add_many(new_tasks(2))
+        yield self.storage.remove('job0')
+        claimed = yield self.storage.claim_tasks(2)
+        self.assertEqual([task['job_id'] for task in claimed], ['job1'])
+
+    @defer.inlineCallbacks
+    def test_failed_interaction_leaves_nothing(self):
+        def add_and_fail(conn):
+            conn.execute("insert into %s (job_id, status) values ('partial', ?)" % self.storage.table,
+                         (self.storage.TASK_STANDBY,))
+            raise ValueError("failed halfway")
+
+        yield self.storage.add_many(new_tasks(1))
+        yield self.assertFailure(self.storage.runInteraction(add_and_fail), ValueError)
+        yield self.storage.add_many(new_tasks(2)[1:])
+        rows = yield self.storage.runQuery("select job_id from %s order by job_id" % self.storage.table)
+        self.assertEqual([row[0] for row in rows], ['job0', 'job1'])
+
+    @defer.inlineCallbacks
+    def test_outbox(self):
+        ids = yield self.storage.outbox_add([b'first', b'second'])
+        yield self.storage.outbox_remove(ids[:1])
+        self.assertEqual((yield self.storage.outbox_pending()), [(ids[1], b'second')])
+
+    @defer.inlineCallbacks
+    def test_outbox_of_another_node(self):
+        other = yield self.start_shared_storage()
+        ids = yield self.storage.outbox_add([b'mine'])
+        yield other.outbox_add([b'theirs'])
+        self.assertEqual((yield self.storage.outbox_pending()), [(ids[0], b'mine')])
+
+    @defer.inlineCallbacks
+    def test_blob_refs(self):
+        yield self.storage.add_blob_ref('a/b')
+        yield self.storage.add_blob_ref('a/b')
+        yield self.storage.release_blob_ref('a/b')
+        unlinked = []
+        self.assertEqual((yield self.storage.collect_blobs(unlinked.append)), 0)
+        yield self.storage.release_blob_ref('a/b')
+        self.assertEqual((yield self.storage.collect_blobs(unlinked.append)), 1)
+        self.assertEqual(unlinked, ['a/b'])
+
+    @defer.inlineCallbacks
+    def test_check_url_already_fetched(self):
+        yield self.storage.add_many(new_tasks(1))
+        claimed = yield self.storage.claim_tasks(1)
+        job_id, fetch_uri = claimed[0]['job_id'], claimed[0]['fetch_uri']
+        self.assertEqual((yield self.storage.check_url_already_fetched(fetch_uri)), None)
+        yield self.storage.set_jobid_result_url(job_id, 'a/b')
+        yield self.storage.set_task_finished(job_id, self.storage.RESULT_SUCCESS)
+        fetched = yield self.storage.check_url_already_fetched(fetch_uri)
+        self.assertEqual((fetched['job_id'], fetched['result_url']), (job_id, 'a/b'))
+
+    @defer.inlineCallbacks
+    def test_http_cache(self):
+        url = 'http://example.com/a.png'
+        self.assertEqual((yield self.storage.get_http_cache(url)), None)
+        yield self.storage.set_http_cache(url, 'a/b', '"v1"', None, 100)
+        yield self.storage.set_http_cache(url, 'a/b', '"v2"', 'Mon, 01 Jan 2024 00:00:00 GMT', 200)
+        self.assertEqual((yield self.storage.get_http_cache(url)),
+                         {'result_url': 'a/b', 'etag': '"v2"', 'last_modified': 'Mon, 01 Jan 2024 00:00:00 GMT',
+                          'expires': 200})
+        # the cache let go of the file it no longer points to
+        yield self.storage.set_http_cache(url, 'a/c', expires=300)
+        unlinked = []
+        yield self.storage.collect_blobs(unlinked.append)
+        self.assertEqual(unlinked, ['a/b'])
+
+    @defer.inlineCallbacks
+    def test_remove_forgets_cached_result(self):
+        self.storage.url_cache = URLResultCache(maxsize=10, capacity=100)
+        yield self.storage.add_many(new_tasks(1))
+        claimed = yield self.storage.claim_tasks(1)
+        job_id, fetch_uri = claimed[0]['job_id'], claimed[0]['fetch_uri']
+        yield self.storage.set_jobid_result_url(job_id, 'a/b', fetch_uri)
+        yield self.storage.set_task_finished(job_id, self.storage.RESULT_SUCCESS)
+        yield self.storage.remove(job_id)
+        self.assertNotIn(fetch_uri, self.storage.url_cache.lru)
+        self.assertEqual((yield self.storage.check_url_already_fetched(fetch_uri)), None)
+
+    @defer.inlineCallbacks
+    def test_shared_database(self):
+        first = yield self.start_shared_storage()
+        second = yield self.start_shared_storage()
+        yield first.add_many(new_tasks(6))
+        yield second.reap_leases()
+        claimed = []
+        for _ in range(3):
+            # a claim drops the tasks the other one leased first
+            rounds = yield defer.gatherResults([first.claim_tasks(4), second.claim_tasks(4)])
+            claimed.extend((storage, task) for storage, tasks in zip((first, second), rounds) for task in tasks)
+        self.assertEqual(sorted(task['job_id'] for _, task in claimed), ['job%s' % i for i in range(6)])
+
+        # fetched by one, the other has to find it
+        storage, task = claimed[0]
+        yield storage.set_jobid_result_url(task['job_id'], 'a/b', task['fetch_uri'])
+        yield storage.set_task_finished(task['job_id'], storage.RESULT_SUCCESS)
+        # those are written behind, a durable write returns after them
+        yield storage.runOperation("select 1")
+        other = second if storage is first else first
+        fetched = yield other.check_url_already_fetched(task['fetch_uri'])
+        self.assertEqual(fetched['result_url'], 'a/b')
+
+    @defer.inlineCallbacks
+    def test_archive_done_tasks(self):
+        yield self.storage.add_many(new_tasks(3))
+        claimed = yield self.storage.claim_tasks(2)
+        for task in claimed:
+            yield self.storage.set_jobid_result_url(task['job_id'], 'a/%s' % task['job_id'])
+            yield self.storage.set_task_finished(task['job_id'], self.storage.RESULT_SUCCESS)
+        yield self.storage.runOperation("update %s set updated=0" % self.storage.table)
+        self.assertEqual((yield self.storage.archive_tasks(1, limit=10)), 2)
+        self.assertEqual((yield self.storage.count()), 1)
+        fetched = yield self.storage.check_url_already_fetched(claimed[0]['fetch_uri'])
+        self.assertEqual(fetched['result_url'], 'a/%s' % claimed[0]['job_id'])
+        self.assertTrue((yield self.storage.vacuum()) >= 0)
+
+
+class TestFileDownloaderTaskStorage(StorageTests, unittest.TestCase):
+
+    def create_storage(self, app, shared=False):
+        return FileDownloaderTaskStorage(app, os.path.join(self.tmp_dir, 'tasks.db'), shared=shared)
+
+
+class TestThreadedTaskStorage(StorageTests, unittest.TestCase):
+
+    def create_storage(self, app, shared=False):
+        return ThreadedTaskStorage(app, os.path.join(self.tmp_dir, 'tasks.db'), shared=shared)
+
+    @defer.inlineCallbacks
+    def test_resume_interrupted_rebuild(self):
+        # stopped in schema version 2 after the old table was dropped
+        path = os.path.join(self.tmp_dir, 'interrupted.db')
+        conn = sqlite3.connect(path)
+        conn.execute("create table schema_version (name text primary key, version integer)")
+        conn.execute("insert into schema_version values ('task_list', 1)")
+        conn.execute("create table task_list_v2 (id integer primary key, job_id text, status text, fetch_uri text, "
+                     "result_url text, settings text, created integer, updated integer, result_type text, "
+                     "result_message text)")
+        conn.execute("insert into task_list_v2 (job_id, status, fetch_uri, settings, created, updated) "
+                     "values ('job0', 'S', 'http://example.com/0', '{}', 1, 1)")
+        conn.commit()
+        conn.close()
+
+        storage = ThreadedTaskStorage(Application("test"), path)
+        storage.app.setComponent(ISignalManager, SignalManager())
+        yield storage.startService()
+        claimed = yield storage.claim_tasks(1)
+        yield storage.stopService()
+        self.assertEqual([task['job_id'] for task in claimed], ['job0'])
+
+
+    @defer.inlineCallbacks
+    def test_write_after_stop_fails(self):
+        yield self.storage.stopService()
+        yield self.assertFailure(self.storage.set_task_finished('job0', self.storage.RESULT_SUCCESS), WriterStopped)
+
+    @defer.inlineCallbacks
+    def test_resume_interrupted_migration(self):
+        path = os.path.join(self.tmp_dir, 'interrupted.db')
+        conn = sqlite3.connect(path)
+        old = FileDownloaderTaskStorage(None, path)
+        old._schema_version(conn)
+        for version in range(1, 7):
+            getattr(old, '_migration_%s' % version)(conn)
+        old._set_schema_version(conn, 6)
+        # stopped in schema version 7 after its first column
+        conn.execute("alter table task_list add column lease_owner text")
+        conn.commit()
+        conn.close()
+
+        storage = ThreadedTaskStorage(Application("test"), path)
+        storage.app.setComponent(ISignalManager, SignalManager())
+        yield storage.startService()
+        yield storage.add_many(new_tasks(1))
+        claimed = yield storage.claim_tasks(1)
+        yield storage.stopService()
+        self.assertEqual([task['job_id'] for task in claimed], ['job0'])
+
+
+class TestAdbapiTaskStorageSQLite(StorageTests, unittest.TestCase):
+
+    def create_storage(self, app, shared=False):
+        return AdbapiTaskStorage(app, 'sqlite3', {'database': os.path.join(self.tmp_dir, 'tasks.db')})
+
+
+class TestAdbapiTaskStoragePostgreSQL(StorageTests, unittest.TestCase):
+
+    def setUp(self):
+        if not os.environ.get('FLOWDER_TEST_POSTGRES_DSN'):
+            raise unittest.SkipTest("FLOWDER_TEST_POSTGRES_DSN is not set")
+        try:
+            import psycopg2  # noqa
+        except ImportError:
+            raise unittest.SkipTest("psycopg2 is not installed")
+        return StorageTests.setUp(self)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for table in (self.storage.blob_table, self.storage.outbox_table, self.storage.archive_table,
+                      self.storage.http_cache_table, self.storage.table):
+            yield self.storage.runOperation("drop table %s" % table)
+        yield self.storage.runOperation("delete from schema_version where name=?", (self.storage.table,))
+        yield StorageTests.tearDown(self)
+
+    def create_storage(self, app, shared=False):
+        return AdbapiTaskStorage(app, 'psycopg2', {'dsn': os.environ['FLOWDER_TEST_POSTGRES_DSN']},
+                                 table='test_tasks', min_connections=1, max_connections=2)